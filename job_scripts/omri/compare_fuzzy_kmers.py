@@ -4,6 +4,8 @@ import os
 import sys
 import math
 import time
+import functools
+import itertools
 import numpy as np
 import logging
 import re
@@ -12,14 +14,18 @@ from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 import queue
+import shutil
+import tempfile
 import multiprocessing
-import psutil
+from multiprocessing import shared_memory
 import sqlite3
+import json
+import csv
+import atexit
+import threading
+from mypyli.kmers import encode_kmers
 #import matplotlib.pyplot as plt
 
-import objgraph
-from pympler import tracker, muppy, summary
-
 #from matplotlib import rcParams
 #rcParams.update({'figure.autolayout': True})
 
@@ -54,6 +60,138 @@ Performance Testing:
 
 """
 
+class Profiler(object):
+    """
+    Opt-in instrumentation: named timers and counters, and the RSS of this process and its workers sampled on a
+    background thread. Nothing is recorded (and no thread is started) until enable is called, so the hooks left
+    in the code cost an attribute check when profiling is off.
+
+    Counters and timers are only kept for the main process (workers are separate processes). The profile is
+    written at exit as JSON, or as CSV if the path ends in .csv.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+        self.rss_samples = []
+
+        self._start_time = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._path = None
+
+    def enable(self, path, interval=1.0):
+        """ Starts recording and sampling RSS every interval seconds. The profile is written to path at exit """
+        if self.enabled:
+            return
+
+        self.enabled = True
+        self._path = path
+        self._start_time = time.time()
+
+        if interval > 0:
+            self._sampler = threading.Thread(target=self._sample_rss, args=(interval,), name="ProfilerRSS", daemon=True)
+            self._sampler.start()
+
+        atexit.register(self.finish)
+
+    def timed(self, name):
+        """ Decorator that adds each call of the function to the timer called name """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add_time(name, time.perf_counter() - start)
+
+            return wrapper
+        return decorator
+
+    def add_time(self, name, seconds):
+        if self.enabled:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @staticmethod
+    def _rss(pid):
+        """ Returns the resident set size of a process in bytes (None if it can't be read) """
+        try:
+            with open("/proc/{}/statm".format(pid)) as IN:
+                return int(IN.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _sample_rss(self, interval):
+        """ Records the RSS of the main process and every live worker until finish is called """
+        processes = [("MainProcess", os.getpid())]
+        while not self._stop.is_set():
+            elapsed = time.time() - self._start_time
+            for name, pid in processes + [(child.name, child.pid) for child in multiprocessing.active_children()]:
+                rss = self._rss(pid)
+                if rss is not None:
+                    self.rss_samples.append((elapsed, name, pid, rss))
+
+            self._stop.wait(interval)
+
+    def peak_rss(self):
+        """ Returns a dict of {process name: peak sampled RSS} """
+        peaks = {}
+        for _, name, _, rss in self.rss_samples:
+            peaks[name] = max(peaks.get(name, 0), rss)
+        return peaks
+
+    def finish(self):
+        """ Stops sampling and writes the profile """
+        if not self.enabled:
+            return
+
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+        elapsed = time.time() - self._start_time
+        if self._path.endswith(".csv"):
+            with open(self._path, 'w', newline='') as OUT:
+                writer = csv.writer(OUT)
+                writer.writerow(["kind", "name", "time", "value", "calls"])
+                writer.writerow(["elapsed", "total", "", elapsed, ""])
+                for name, (calls, seconds) in sorted(self.timers.items()):
+                    writer.writerow(["timer", name, "", seconds, calls])
+                for name, value in sorted(self.counters.items()):
+                    writer.writerow(["counter", name, "", value, ""])
+                for name, rss in sorted(self.peak_rss().items()):
+                    writer.writerow(["peak_rss", name, "", rss, ""])
+                for sample_time, name, pid, rss in self.rss_samples:
+                    writer.writerow(["rss", "{}:{}".format(name, pid), round(sample_time, 3), rss, ""])
+        else:
+            with open(self._path, 'w') as OUT:
+                json.dump({
+                    'elapsed': elapsed,
+                    'timers': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.timers.items()},
+                    'counters': self.counters,
+                    'peak_rss': self.peak_rss(),
+                    'rss_samples': [{'time': round(sample_time, 3), 'process': name, 'pid': pid, 'rss': rss} for sample_time, name, pid, rss in self.rss_samples]
+                    }, OUT, indent=2)
+
+        LOG.info("Wrote profile to {}".format(self._path))
+        self.enabled = False
+
+
+# hooks throughout the module report here; enabled with -profile
+PROFILER = Profiler()
+
+
 class Database(object):
     """ Serves as the base class for database objects """
 
@@ -72,6 +210,19 @@ class Database(object):
         #conn.execute("PRAGMA main.journal_mode = WAL")
         #conn.exeucte("PRAGMA main.temp_store = MEMORY")
 
+    @staticmethod
+    def init_bulk_load(conn, cache_mb=1024, mmap_mb=4096):
+        """ 
+        Pragmas for loading lots of rows: a write-ahead log (so commits don't rewrite the journal), 
+        a large page cache, and memory mapped reads. The WAL journal mode is kept by the database file.
+        """
+        # journal and sync pragmas can't be changed inside a transaction
+        conn.commit()
+        conn.execute("PRAGMA main.journal_mode = WAL")
+        conn.execute("PRAGMA main.synchronous = NORMAL")
+        conn.execute("PRAGMA main.cache_size = -{}".format(int(cache_mb * 1024)))
+        conn.execute("PRAGMA main.mmap_size = {}".format(int(mmap_mb * 2**20)))
+
     @staticmethod
     def _sql_results_to_file(fh, cursor):
         """ Writes results to a tab delimited file """
@@ -114,7 +265,7 @@ class Database(object):
     def lookup_param(self, key):
         """ Lookup a param in the Params table by a given key. Returns a list for keys that have multiple values, a single value for keys that have one value, or None for keys that are not in the database """
 
-        results = self.dbc.execute("SELECT value FROM Params WHERE key = '{}'".format(key)).fetchall()
+        results = self.dbc.execute("SELECT value FROM Params WHERE key = ?", (key,)).fetchall()
 
         if len(results) == 0:
             return None
@@ -137,19 +288,407 @@ class Database(object):
             return all_results
 
 
+class KmerIndex(object):
+    """
+    Stores the kmer locations of each genome as a sorted array in its own .npy file (memory mapped when read).
+
+    Rows are (kmer, contig, start, strand) sorted by kmer, contig, and start so all the locations of a kmer
+    are a contiguous slice that can be found with a binary search. Conserved kmers across N genomes are 
+    found with a merge of the sorted kmer columns instead of a GROUP BY over one big table.
+
+    Genomes are added in ingest epochs (one per count_kmers call). kmers.npy holds the sorted unique kmers
+    of every indexed epoch and delta_<epoch>.npy holds the kmers first seen in that epoch, so work that
+    only depends on the kmer set (like fuzzifying) can be done for new kmers only.
+    """
+
+    INDEX_DTYPE = np.dtype([("kmer", np.uint64), ("contig", np.int64), ("start", np.int64), ("strand", np.int8)])
+
+    # locations returned by queries (same columns as the ConservedKmers table)
+    CONSERVED_DTYPE = np.dtype([("kmer", np.uint64), ("genome", np.int64), ("contig", np.int64), ("start", np.int64), ("strand", np.int8)])
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def path(self, genome_id):
+        return os.path.join(self.index_dir, "genome_{}.npy".format(genome_id))
+
+    def delta_path(self, epoch):
+        return os.path.join(self.index_dir, "delta_{}.npy".format(epoch))
+
+    def kmers_path(self):
+        return os.path.join(self.index_dir, "kmers.npy")
+
+    def _ids_with_prefix(self, prefix):
+        return sorted(int(f[len(prefix):-4]) for f in os.listdir(self.index_dir) if re.fullmatch(prefix + r"\d+\.npy", f))
+
+    def genome_ids(self):
+        """ Returns the ids of all the genomes in the index """
+        return self._ids_with_prefix("genome_")
+
+    def epochs(self):
+        """ Returns the ingest epochs that have a delta file """
+        return self._ids_with_prefix("delta_")
+
+    def clear(self):
+        for genome_id in self.genome_ids():
+            os.remove(self.path(genome_id))
+        for epoch in self.epochs():
+            os.remove(self.delta_path(epoch))
+        if os.path.isfile(self.kmers_path()):
+            os.remove(self.kmers_path())
+
+    def _save(self, path, array):
+        """ Writes to a temp file first so a partial array is never read """
+        tmp = path + ".tmp.npy"
+        np.save(tmp, array)
+        os.rename(tmp, path)
+
+    def write_genome(self, genome_id, runs):
+        """ Merges runs of locations (KCounter.LOCATION_DTYPE arrays) for a genome into its sorted index file """
+        locations = np.concatenate(runs) if runs else np.empty(0, dtype=KCounter.LOCATION_DTYPE)
+
+        order = np.lexsort((locations["start"], locations["contig"], locations["kmer"]))
+
+        index = np.empty(len(locations), dtype=self.INDEX_DTYPE)
+        for field in self.INDEX_DTYPE.names:
+            index[field] = locations[field][order]
+
+        self._save(self.path(genome_id), index)
+
+    def add_epoch(self, epoch, genome_ids):
+        """ 
+        Records the kmers first seen in an ingest epoch (made of genome_ids) and rebuilds kmers.npy.
+
+        The delta only depends on earlier deltas so an interrupted or lost epoch can simply be recorded again.
+        """
+        new = self.scan_kmers(genome_ids)
+        delta = new[~self._contains(self._load_deltas(lambda other: other < epoch), new)]
+        self._save(self.delta_path(epoch), delta)
+
+        self._save(self.kmers_path(), self._load_deltas(lambda other: True))
+
+        return delta
+
+    def _load_deltas(self, use_epoch):
+        """ Returns the sorted kmers of the deltas of the epochs where use_epoch(epoch) is True """
+        deltas = [np.load(self.delta_path(epoch)) for epoch in self.epochs() if use_epoch(epoch)]
+        if not deltas:
+            return np.array([], dtype=np.uint64)
+        return np.sort(np.concatenate(deltas))
+
+    def delta_kmers(self, since_epoch):
+        """ Returns the sorted kmers first seen in an epoch after since_epoch """
+        return self._load_deltas(lambda epoch: epoch > since_epoch)
+
+    def load(self, genome_id):
+        """ Returns the (memory mapped) index of a genome """
+        return np.load(self.path(genome_id), mmap_mode="r")
+
+    @staticmethod
+    def _unique_sorted(kmers):
+        if len(kmers) == 0:
+            return np.array(kmers, dtype=np.uint64)
+        return kmers[np.concatenate(([True], kmers[1:] != kmers[:-1]))]
+
+    def unique_kmers(self, genome_id):
+        """ Returns the sorted unique kmers of a genome """
+        return self._unique_sorted(np.ascontiguousarray(self.load(genome_id)["kmer"]))
+
+    def all_kmers(self):
+        """ Returns the sorted unique kmers of all indexed epochs """
+        if os.path.isfile(self.kmers_path()):
+            return np.load(self.kmers_path())
+        return np.array([], dtype=np.uint64)
+
+    def scan_kmers(self, genome_ids=None):
+        """ Returns the sorted unique kmers in any (or the given) genomes by reading every genome index """
+        if genome_ids is None:
+            genome_ids = self.genome_ids()
+
+        kmers = [self.unique_kmers(genome_id) for genome_id in genome_ids]
+        if not kmers:
+            return np.array([], dtype=np.uint64)
+        return self._unique_sorted(np.sort(np.concatenate(kmers)))
+
+    @staticmethod
+    def _contains(sorted_values, queries):
+        """ Returns a mask of the queries found in a sorted array """
+        indices = np.searchsorted(sorted_values, queries)
+        found = indices < len(sorted_values)
+        found[found] = sorted_values[indices[found]] == queries[found]
+        return found
+
+    def _rows_with_kmers(self, genome_id, kmers):
+        """ Returns (index rows, position of the kmer in kmers) for all the locations of the (sorted) kmers in a genome """
+        index = self.load(genome_id)
+        column = np.ascontiguousarray(index["kmer"])
+
+        starts = np.searchsorted(column, kmers, side="left")
+        ends = np.searchsorted(column, kmers, side="right")
+        counts = ends - starts
+
+        # expand each [start, end) range into row numbers
+        kmer_indices = np.repeat(np.arange(len(kmers)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        return index[starts[kmer_indices] + offsets], kmer_indices
+
+    def conserved_kmers(self, genome_ids):
+        """ 
+        Returns the sorted kmers found in all of the genomes. 
+        
+        This is a merge of the sorted kmer columns: the kmers of the smallest genome are 
+        checked against each other genome with a binary search, dropping misses as it goes.
+        """
+        genome_ids = sorted(genome_ids, key=lambda genome_id: len(self.load(genome_id)))
+        if not genome_ids:
+            return np.array([], dtype=np.uint64)
+
+        conserved = self.unique_kmers(genome_ids[0])
+        for genome_id in genome_ids[1:]:
+            conserved = conserved[self._contains(np.ascontiguousarray(self.load(genome_id)["kmer"]), conserved)]
+
+        return conserved
+
+    def conserved_locations(self, genome_ids, links=None):
+        """ 
+        Returns every location (CONSERVED_DTYPE) of the kmers conserved in all of the genomes.
+
+        links are optional (kmers, groups) arrays sorted by kmer (Ex: kmer to fuzzy kmer). If given, 
+        groups that have a member kmer in every genome are conserved and the kmer column of the 
+        result is the group.
+        """
+        if links is None:
+            conserved = self.conserved_kmers(genome_ids)
+            link_kmers = groups = conserved
+        else:
+            link_kmers, groups = links
+
+            # groups present in each genome, intersected across genomes
+            conserved = None
+            for genome_id in genome_ids:
+                present = self._contains(self.unique_kmers(genome_id), link_kmers)
+                genome_groups = self._unique_sorted(np.sort(groups[present]))
+                conserved = genome_groups if conserved is None else conserved[self._contains(genome_groups, conserved)]
+
+            if conserved is None:
+                conserved = np.array([], dtype=np.uint64)
+
+            keep = self._contains(conserved, groups)
+            link_kmers = link_kmers[keep]
+            groups = groups[keep]
+
+        # unique kmers (sorted) that need locations and which links they expand to
+        kmers = self._unique_sorted(link_kmers)
+        link_starts = np.searchsorted(link_kmers, kmers, side="left")
+        link_counts = np.searchsorted(link_kmers, kmers, side="right") - link_starts
+
+        results = []
+        for genome_id in genome_ids:
+            rows, kmer_indices = self._rows_with_kmers(genome_id, kmers)
+
+            # one result per (location, link)
+            counts = link_counts[kmer_indices]
+            repeat = np.repeat(np.arange(len(rows)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+            result = np.empty(len(repeat), dtype=self.CONSERVED_DTYPE)
+            result["kmer"] = groups[link_starts[kmer_indices][repeat] + offsets]
+            result["genome"] = genome_id
+            for field in ["contig", "start", "strand"]:
+                result[field] = rows[field][repeat]
+
+            results.append(result)
+
+        return np.concatenate(results) if results else np.empty(0, dtype=self.CONSERVED_DTYPE)
+
+
+class AmpliconEngine(object):
+    """
+    Finds potential amplicons (pairs of conserved kmers on the same contig and strand within an amplicon length) in memory.
+
+    Hits (KmerIndex.CONSERVED_DTYPE) are sorted by genome, contig, strand, and start. Each hit's window of partners is then
+    a contiguous run of hits found with a binary search for both ends, which is the sweep of two pointers done for every hit 
+    at once. Support for each (kmer1, kmer2) pair is counted in a dict as the genomes are swept one at a time.
+
+    A partner is downstream of the first kmer on the + strand and upstream of it on the - strand (same as the SQL it replaces).
+    """
+
+    PAIR_DTYPE = np.dtype([("kmer1", np.uint64), ("kmer2", np.uint64), ("start1", np.int64), ("start2", np.int64), ("genome", np.int64), ("contig", np.int64), ("strand", np.int8)])
+
+    def __init__(self, hits, min_len, max_len, chunk_size=2**22):
+        self.min_len = int(min_len)
+        self.max_len = int(max_len)
+
+        # max number of pairs to expand at once
+        self.chunk_size = chunk_size
+
+        order = np.lexsort((hits["start"], hits["strand"], hits["contig"], hits["genome"]))
+        self.hits = hits[order]
+
+        genomes = self.hits["genome"]
+        self.genome_bounds = np.flatnonzero(np.concatenate(([True], genomes[1:] != genomes[:-1], [True])))
+
+    def _windows(self, hits):
+        """ Returns the [first, last) partner indices for each hit of one genome """
+        if len(hits) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        contigs = hits["contig"]
+        strands = hits["strand"]
+        new_group = np.concatenate(([True], (contigs[1:] != contigs[:-1]) | (strands[1:] != strands[:-1])))
+        group = np.cumsum(new_group) - 1
+
+        # one sorted key so windows never run into the neighbouring (contig, strand) group
+        span = int(hits["start"].max()) + self.max_len + 1
+        group_start = group * span
+        keys = group_start + hits["start"]
+
+        plus = strands == 1
+        lo = np.where(plus, keys + self.min_len, keys - self.max_len)
+        hi = np.where(plus, keys + self.max_len, keys - self.min_len)
+        lo = np.maximum(lo, group_start)
+
+        first = np.searchsorted(keys, lo, side="left")
+        last = np.searchsorted(keys, hi, side="right")
+        return first, np.maximum(last, first)
+
+    def iter_pairs(self):
+        """ Yields PAIR_DTYPE arrays of every candidate pair, a genome at a time (big genomes in chunks of about chunk_size pairs) """
+        for bound_indx in range(len(self.genome_bounds) - 1):
+            hits = self.hits[self.genome_bounds[bound_indx]:self.genome_bounds[bound_indx + 1]]
+            first, last = self._windows(hits)
+            counts = last - first
+
+            # split the hits so each chunk expands to about chunk_size pairs
+            splits = np.searchsorted(np.cumsum(counts), np.arange(self.chunk_size, counts.sum(), self.chunk_size), side="right")
+            for chunk_start, chunk_end in zip(np.concatenate(([0], splits)), np.concatenate((splits, [len(hits)]))):
+                chunk_counts = counts[chunk_start:chunk_end]
+                a = np.repeat(np.arange(chunk_start, chunk_end), chunk_counts)
+                offsets = np.arange(len(a)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+                b = first[a] + offsets
+
+                # no self matches
+                keep = hits["kmer"][a] != hits["kmer"][b]
+                a = a[keep]
+                b = b[keep]
+
+                pairs = np.empty(len(a), dtype=self.PAIR_DTYPE)
+                pairs["kmer1"] = hits["kmer"][a]
+                pairs["kmer2"] = hits["kmer"][b]
+                pairs["start1"] = hits["start"][a]
+                pairs["start2"] = hits["start"][b]
+                for field in ["genome", "contig", "strand"]:
+                    pairs[field] = hits[field][a]
+
+                yield pairs
+
+    def support(self):
+        """ Returns a dict of {(kmer1, kmer2): [number of genomes, number of occurrences]} """
+        support = {}
+        last_genome = {}
+        for pairs in self.iter_pairs():
+            if len(pairs) == 0:
+                continue
+            genome = int(pairs["genome"][0])
+
+            # count each distinct pair in the chunk once
+            order = np.lexsort((pairs["kmer2"], pairs["kmer1"]))
+            kmer1 = pairs["kmer1"][order]
+            kmer2 = pairs["kmer2"][order]
+            starts = np.flatnonzero(np.concatenate(([True], (kmer1[1:] != kmer1[:-1]) | (kmer2[1:] != kmer2[:-1]))))
+            counts = np.diff(np.append(starts, len(order)))
+
+            for key, count in zip(zip(kmer1[starts].tolist(), kmer2[starts].tolist()), counts.tolist()):
+                if key in support:
+                    stats = support[key]
+                    stats[1] += count
+                    if last_genome[key] != genome:
+                        stats[0] += 1
+                        last_genome[key] = genome
+                else:
+                    support[key] = [1, count]
+                    last_genome[key] = genome
+
+        return support
+
+    def amplicons(self, min_genomes):
+        """ Yields (pairs, num_genomes, num_total) arrays for the pairs found in at least min_genomes genomes """
+        support = self.support()
+        for pairs in self.iter_pairs():
+            stats = [support[key] for key in zip(pairs["kmer1"].tolist(), pairs["kmer2"].tolist())]
+            stats = np.array(stats, dtype=np.int64).reshape(-1, 2)
+
+            keep = stats[:, 0] >= min_genomes
+            if keep.any():
+                yield pairs[keep], stats[keep, 0], stats[keep, 1]
+
+
+def kmer_id_to_name(kmer_id, k, alphabet="ACGT"):
+    """ Converts a kmer id back to its sequence (use alphabet="ACGTN" for fuzzy kmer ids) """
+    letters = []
+    for _ in range(k):
+        kmer_id, digit = divmod(kmer_id, len(alphabet))
+        letters.append(alphabet[digit])
+
+    return "".join(reversed(letters))
+
+
+@functools.lru_cache(maxsize=None)
+def fuzzy_masks(k, mismatches, stable_bp):
+    """
+    Returns a read-only (patterns, k) array with a 1 at every position that becomes an N.
+
+    There is one pattern for each way of placing exactly 'mismatches' Ns outside the
+    first and last stable_bp positions. Patterns are cached per parameter set.
+    """
+    combos = list(itertools.combinations(range(stable_bp, k - stable_bp), mismatches))
+
+    masks = np.zeros((len(combos), k), dtype=np.int64)
+    for row, positions in enumerate(combos):
+        masks[row, list(positions)] = 1
+
+    masks.setflags(write=False)
+    return masks
+
+def fuzzy_ids_to_names(fuzzy_ids, k):
+    """ Converts an array of base-5 fuzzy kmer ids to a list of strings (vectorized kmer_id_to_name) """
+    fuzzy_ids = np.asarray(fuzzy_ids, dtype=np.int64)
+    powers = 5 ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    digits = (fuzzy_ids[:, None] // powers) % 5
+
+    letters = np.frombuffer(b"ACGTN", dtype=np.uint8)[digits]
+    return [row.tobytes().decode() for row in letters]
+
+
 class MainDatabase(Database):
     """
     Represents the main kmer database.
 
-    Tables are Genomes, Contigs, Sequences, Locations, FuzzyKmers, and KmerToFuzzy
+    Tables are Genomes, Contigs, Sequences, FuzzyKmers, and KmerToFuzzy.
+    Kmer locations are stored in a KmerIndex in the <database>.kmers directory.
+
+    Each call to count_kmers is an ingest epoch and each genome records the epoch it was added in.
+    The fuzzy_epoch param is the last epoch whose new kmers have been fuzzified so adding genomes
+    only fuzzifies the kmers they introduce.
     """
 
-    def __init__(self, database, k, threads, mismatches=1, stable_bp=2):
+    # bp of sequence counted by a KCounter at a time
+    CHUNK_SIZE = 500000
+
+    # kmers fuzzified by a worker at a time
+    FUZZY_BATCH_SIZE = 500000
+
+    def __init__(self, database, k, threads, mismatches=1, stable_bp=2, bulk=False):
         self.database_f = database
         self.k = k
         self.threads = threads
         self.mismatches = mismatches
 
+        # bulk mode uses WAL and a bigger cache and defers building the KmerToFuzzy index
+        self.bulk = bulk
+
         # stables are # bases at beginning and end that cannot be mismatches
         self.stable_bp = stable_bp
 
@@ -161,6 +700,93 @@ class MainDatabase(Database):
             self.init_database(self.dbc)
             self.make_SQL_tables()
 
+        if self.bulk:
+            self.init_bulk_load(self.dbc)
+
+        self.index = KmerIndex(self.database_f + ".kmers")
+        self._upgrade_database()
+
+    def _upgrade_database(self):
+        """ 
+        Upgrades databases made by older versions in place. 
+        
+        Ingest epochs are added if they are missing (all existing genomes become epoch 0) and kmer locations 
+        still in the Locations table are moved into the KmerIndex.
+        """
+        columns = [row[1] for row in self.dbc.execute("PRAGMA table_info(Genomes)")]
+        if "epoch" not in columns:
+            LOG.info("Adding ingest epochs to the database...")
+            self.dbc.execute("ALTER TABLE Genomes ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0")
+            self.dbc.commit()
+
+        if self.dbc.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Locations'").fetchone():
+            self._migrate_locations()
+
+    def _migrate_locations(self):
+        """ 
+        Writes a KmerIndex file for each genome from the Locations table of a database made before the index 
+        existed and then drops the Kmers and Locations tables. 
+        
+        Genomes that already have an index file are skipped so an interrupted migration picks up where it stopped.
+        """
+        LOG.info("Moving kmer locations from the Locations table to the kmer index...")
+        self.dbc.execute("CREATE INDEX IF NOT EXISTS locations_contig_indx ON Locations (contig)")
+
+        indexed = set(self.index.genome_ids())
+        for genome_id, genome_name in self.dbc.execute("SELECT id, name FROM Genomes ORDER BY id").fetchall():
+            if genome_id in indexed:
+                continue
+
+            LOG.info("Writing kmer index for {}.".format(genome_name))
+            cursor = self.dbc.execute("""
+                    SELECT Locations.kmer, Locations.contig, Locations.start, CAST(Locations.strand AS INTEGER) 
+                    FROM Locations JOIN Contigs ON Locations.contig = Contigs.id 
+                    WHERE Contigs.genome = ?
+                    """, (genome_id,))
+
+            runs = []
+            for batch in self._iter_sql_results(cursor, 100000):
+                batch = np.array(batch, dtype=np.int64)
+
+                locations = np.empty(len(batch), dtype=KCounter.LOCATION_DTYPE)
+                locations["genome"] = genome_id
+                for indx, field in enumerate(["kmer", "contig", "start", "strand"]):
+                    locations[field] = batch[:, indx]
+                runs.append(locations)
+
+            self.index.write_genome(genome_id, runs)
+
+        self.dbc.execute("DROP TABLE Locations")
+        self.dbc.execute("DROP TABLE IF EXISTS Kmers")
+        self.dbc.commit()
+
+        self._index_epochs()
+
+    def _set_param(self, key, value):
+        """ Replaces all values of a param with a single value """
+        self.dbc.execute("DELETE FROM Params WHERE key = ?", (key,))
+        self.dbc.execute("INSERT INTO Params (key, value) VALUES (?, ?)", (key, value))
+
+    def current_epoch(self):
+        """ Returns the most recent ingest epoch (-1 for an empty database) """
+        epoch = self.dbc.execute("SELECT MAX(epoch) FROM Genomes").fetchone()[0]
+        return -1 if epoch is None else epoch
+
+    def genomes_by_epoch(self):
+        """ Returns a dict of {epoch: [genome ids]} """
+        epochs = {}
+        for genome_id, epoch in self.dbc.execute("SELECT id, epoch FROM Genomes ORDER BY id"):
+            epochs.setdefault(epoch, []).append(genome_id)
+        return epochs
+
+    def _index_epochs(self):
+        """ Records kmer deltas for any epochs that don't have one yet (Ex: if counting was interrupted) """
+        indexed = set(self.index.epochs())
+        for epoch, genome_ids in sorted(self.genomes_by_epoch().items()):
+            if epoch not in indexed:
+                LOG.info("Recording new kmers for ingest epoch {}...".format(epoch))
+                delta = self.index.add_epoch(epoch, genome_ids)
+                LOG.info("Epoch {} added {} new kmers.".format(epoch, len(delta)))
 
     def check_recount(self):
         """ Returns True if kmers need to be recounted """
@@ -194,7 +820,8 @@ class MainDatabase(Database):
         # create table that holds the genome names
         self.dbc.execute("""CREATE TABLE Genomes (
                         id INTEGER PRIMARY KEY NOT NULL,
-                        name TEXT
+                        name TEXT,
+                        epoch INTEGER NOT NULL DEFAULT 0
                         );
                         """)
 
@@ -215,33 +842,19 @@ class MainDatabase(Database):
                         );
                         """)
 
-        # create table that holds all the unique Kmers that are stored in locations
-        # id is an integer that results from converting ACGT to base4 and then converting to base10
-        self.dbc.execute("""CREATE TABLE Kmers (
-                        id INTEGER PRIMARY KEY ON CONFLICT IGNORE NOT NULL,
-                        name TEXT
-                        );
-                        """)
-
-        # create table to hold each location (could add a genome field to make lookups ever easier)
-        self.dbc.execute("""CREATE TABLE Locations (
-                        id INTEGER PRIMARY KEY NOT NULL,
-                        genome INTEGER NOT NULL,
-                        contig INTEGER NOT NULL,
-                        start INTEGER,
-                        strand INTEGER,
-                        kmer INTEGER NOT NULL,
-                        FOREIGN KEY (genome) REFERENCES Genomes(id)
-                        FOREIGN KEY(contig) REFERENCES Contigs(id)
-                        FOREIGN KEY(kmer) REFERENCES Kmers(id)
-                        );
-                        """)
+        # kmers and their locations are kept in the KmerIndex (not SQL)
+        # kmer ids are the integer that results from converting ACGT to base4 and then converting to base10
 
         #
         ## Create some tables to aid in calculation of conserved kmers
         ## These tables will be populated after kmer counting
         #
 
+        self._make_fuzzy_tables()
+
+    def _make_fuzzy_tables(self):
+        """ Makes the FuzzyKmers and KmerToFuzzy tables """
+
         # create a table of fuzzy kmers 
         self.dbc.execute("""CREATE TABLE FuzzyKmers (
                         id INTEGER PRIMARY KEY ON CONFLICT IGNORE NOT NULL,
@@ -250,15 +863,15 @@ class MainDatabase(Database):
                         """)
 
         # create a many to many table that relates each kmer with all the fuzzy kmers it could be a part of
+        # uniqueness is enforced by an index (not a table constraint) so bulk loads can drop it and build it once at the end
         self.dbc.execute("""CREATE TABLE KmerToFuzzy (
                         id INTEGER PRIMARY KEY NOT NULL,
                         kmer INT,
                         fuzzy INT,
-                        UNIQUE(kmer, fuzzy) ON CONFLICT IGNORE
-                        FOREIGN KEY(kmer) REFERENCES Kmers(id)
                         FOREIGN KEY(fuzzy) REFERENCES FuzzyKmers(id)
                         );
                         """)
+        self.dbc.execute("CREATE UNIQUE INDEX kmer_to_fuzzy_indx ON KmerToFuzzy (kmer, fuzzy)")
 
 
 
@@ -272,11 +885,14 @@ class MainDatabase(Database):
                 for kmer in cls._recurse_all_kmers(k, curseq + nt):
                     yield kmer
 
+    @PROFILER.timed("count")
     def count_kmers(self, fastas, recalculate=False):
         """
         The counter here should do nothing but update the database.
 
-        In multiple other threads the counter should be running counting kmers and should return multiple lists of tuples. The first contains all the unique kmers that need to be in kmers and the second contains Locations for the counted segment.
+        In multiple other threads the counter should be running counting kmers and should return an array of locations for each counted segment. The locations of each genome are merged into its sorted KmerIndex file.
+
+        All genomes added by one call make up a new ingest epoch. The kmers they introduce are recorded once counting is finished.
         """
 
         if self.check_recount():
@@ -285,18 +901,26 @@ class MainDatabase(Database):
                 self.dbc.execute("DELETE FROM Genomes")
                 self.dbc.execute("DELETE FROM Contigs")
                 self.dbc.execute("DELETE FROM Sequences")
-                self.dbc.execute("DELETE FROM Kmers")
+                self.dbc.execute("DELETE FROM Params WHERE key = 'fuzzy_epoch'")
+                self.index.clear()
 
             else:
                 raise ValueError("Kmers need to be recounted (current params don't match database params) but -force was not supplied.")
 
+        # finish recording any epoch that was interrupted before starting a new one
+        self._index_epochs()
+        epoch = self.current_epoch() + 1
+
         input_queue = multiprocessing.Queue()
         results_queue = multiprocessing.Queue(15)
 
+        # each sequence chunk gives at most one location per base; a block for each result in the queue or in progress
+        pool = SharedArrayPool(15 + self.threads, self.CHUNK_SIZE * KCounter.LOCATION_DTYPE.itemsize)
+
         # spawn workers
         workers = []
         for indx in range(self.threads):
-            worker = KCounter("Counter{}".format(indx), self.k, input_queue, results_queue)
+            worker = KCounter("Counter{}".format(indx), self.k, input_queue, results_queue, pool)
             worker.start()
             workers.append(worker)
 
@@ -311,7 +935,7 @@ class MainDatabase(Database):
                 LOG.info("Counting kmers for {}".format(genome_name))
 
             # add fasta to the database and get the genome index
-            genome_id = self._add_genome(genome_name)
+            genome_id = self._add_genome(genome_name, epoch)
 
             with open(fasta, 'r') as IN:
                 # keep track of how much goes in the pipeline so I'll know how much to expect out
@@ -323,20 +947,20 @@ class MainDatabase(Database):
                     contig_id = self._add_contig(record.description, genome_id, str(record.seq))
 
                     # split the sequence up into pieces and put the pieces into the input queue
-                    for indx in range(0, len(record.seq), 500000):
-                        input_queue.put((genome_id, contig_id, indx, str(record.seq[indx:indx+500000])))
+                    for indx in range(0, len(record.seq), self.CHUNK_SIZE):
+                        input_queue.put((genome_id, contig_id, indx, str(record.seq[indx:indx+self.CHUNK_SIZE])))
                         num_batches += 1
 
 
             # get result batches 
+            runs = []
             for bat_num in range(num_batches):
                 LOG.debug("Getting batch {} of {}".format(bat_num+1, num_batches))
-                kmers, locations = results_queue.get()
-        
-                LOG.debug("Adding kmers to database.")
-                self._add_kmers(kmers)
-                LOG.debug("Adding locations to database.")
-                self._add_locations(locations)
+                runs.append(pool.unpack(results_queue.get()))
+                PROFILER.count("kmer_locations", len(runs[-1]))
+
+            LOG.debug("Writing kmer index for {}.".format(genome_name))
+            self.index.write_genome(genome_id, runs)
             self.dbc.commit()
 
         for _ in workers:
@@ -346,15 +970,26 @@ class MainDatabase(Database):
             LOG.debug("Waiting for {} to join...".format(worker.name))
             worker.join()
 
+        pool.close()
+
+        self._index_epochs()
+
     #
     ## Populating fuzzy kmer table
     #
+    @PROFILER.timed("fuzzify")
     def generate_fuzzy_kmers(self, recalculate=False):
         """ Populates the FuzzyKmer and KmerToFuzzy tables 
         
-        Checks first if any new genomes have been added and skips this step if none have.
+        Only kmers first seen in ingest epochs after the fuzzy_epoch param are fuzzified so 
+        adding genomes does not rescan the whole database. This step is skipped if no genomes have been added.
 
         Fuzzy kmers can be recalculated using recalculate=True
+
+        In bulk mode, an empty KmerToFuzzy is loaded without its index (links arrive sorted by kmer so the
+        table itself is the staging table) and the index is built, deduplicating if needed, in one pass at the end.
+
+        Returns the number of links generated.
         """
 
         refuzzify = self.check_refuzzify()
@@ -365,534 +1000,195 @@ class MainDatabase(Database):
                 LOG.info("Recalculating fuzzy kmers from scratch...")
                 self.dbc.execute("DELETE FROM FuzzyKmers")
                 self.dbc.execute("DELETE FROM KmerToFuzzy")
+                self.dbc.execute("DELETE FROM Params WHERE key = 'fuzzy_epoch'")
+                self._set_param("mismatches", self.mismatches)
+                self._set_param("stable_bp", self.stable_bp)
  
             else:
                 raise ValueError("Fuzzy Kmers need to be recalculated(current params don't match database params) which would erase original data but -force was not supplied.")
 
+        fuzzy_epoch = self.lookup_param("fuzzy_epoch")
+        fuzzy_epoch = -1 if fuzzy_epoch is None else int(fuzzy_epoch)
+        current_epoch = self.current_epoch()
 
-        # this step takes a long time on huge tables so I want to skip it if possible
-        # I think I want to bypass this in the interest of ensuring the fuzzy kmers get calculated when they should
-        """
-        if refuzzify is False and self.changed is False:
-            LOG.info("No database changes detected. Skipping updating fuzzy kmers.")
-            return
-        """
-            
-        # select kmers that do not have an entry in the KmersToFuzzy table (ones that have not yet been processed)
-        LOG.info("Selecting kmers to fuzzify...")
-        cursor = self.dbc.execute("SELECT Kmers.id, Kmers.name from Kmers LEFT JOIN KmerToFuzzy ON kmers.id = KmerToFuzzy.kmer WHERE KmerToFuzzy.kmer is NULL")
+        if fuzzy_epoch >= current_epoch:
+            LOG.info("No genomes added since fuzzy kmers were last generated. Skipping updating fuzzy kmers.")
+            return 0
+
+        # select kmers that were first seen after the last fuzzified epoch
+        LOG.info("Selecting kmers added after epoch {} to fuzzify...".format(fuzzy_epoch))
+        kmers = self.index.delta_kmers(fuzzy_epoch)
+
+        if self.bulk:
+            self._begin_bulk_fuzzy()
 
         LOG.info("Fuzzifying and inserting fuzzy kmers into database...")
         result_num = 0
-        for fuzzy_kmers, links in lazy_imap(self.threads, self._generate_fuzzy_entries, self._iter_sql_results(cursor, 500000)):
+        num_links = 0
+        # each batch returns (kmers, fuzzy ids) arrays with a link for each mask pattern
+        block_size = 2 * self.FUZZY_BATCH_SIZE * len(fuzzy_masks(self.k, int(self.mismatches), int(self.stable_bp))) * 8
+        for link_kmers, link_fuzzy in lazy_imap(self.threads, self._generate_fuzzy_entries, self._iter_kmer_batches(kmers, self.FUZZY_BATCH_SIZE), block_size=block_size):
 
             result_num += 1
+            num_links += len(link_kmers)
+            PROFILER.count("fuzzy_links", len(link_kmers))
             LOG.debug("After getting result {}".format(result_num))
-            get_memory_usage(verbose=True)
 
-            LOG.debug("Inserting {} elements into FuzzyKmers...".format(len(fuzzy_kmers)))
-            self.dbc.executemany("INSERT OR IGNORE INTO FuzzyKmers (id, name) VALUES (?, ?)", fuzzy_kmers)
-            LOG.debug("Inserting {} elements into KmerToFuzzy...".format(len(links)))
-            self.dbc.executemany("INSERT INTO KmerToFuzzy (kmer, fuzzy) VALUES (?, ?)", links)
+            fuzzy_ids = KmerIndex._unique_sorted(np.sort(link_fuzzy))
+            LOG.debug("Inserting {} elements into FuzzyKmers...".format(len(fuzzy_ids)))
+            self.dbc.executemany("INSERT OR IGNORE INTO FuzzyKmers (id, name) VALUES (?, ?)", zip(fuzzy_ids.tolist(), fuzzy_ids_to_names(fuzzy_ids, self.k)))
+            LOG.debug("Inserting {} elements into KmerToFuzzy...".format(len(link_kmers)))
+            self.dbc.executemany("INSERT OR IGNORE INTO KmerToFuzzy (kmer, fuzzy) VALUES (?, ?)", zip(link_kmers.tolist(), link_fuzzy.tolist()))
 
-        self.dbc.commit()
-        
-    def _generate_fuzzy_entries(self, kmers):
-        """ Takes an iterable of kmers (id, name) and returns a list of fuzzy kmers ready to be inserted into the FuzzyKmer table and a list of links between FuzzyKmers and real kmers"""
-
-        #LOG.debug("Beginning fuzzifying batch...")
-        fuzzy_kmers = []
-        links = []
-        for kmer_id, kmer in kmers:
-            for fuzzy_kmer in self._fuzzify_kmer(kmer):
-                fuzzy_id_str = fuzzy_kmer.replace("A", "0").replace("C", "1").replace("G", "2").replace("T", "3").replace("N", "4")
-                fuzzy_id = int(fuzzy_id_str, 5)
-            
-                fuzzy_kmers.append((fuzzy_id, fuzzy_kmer))
-                links.append((kmer_id, fuzzy_id))
-
-        #LOG.debug("Done fuzzifying batch...")
-        return fuzzy_kmers, links
-
-    def _fuzzify_kmer(self, kmer, current_seq="", mismatches=0):
-        """ 
-        Generates all fuzzy kmers with a given number of mismatches (by self.mismatches)
-        will not generate fuzzy kmers with < self.mismatches because clusters with mismatch < N are included
+        if self.bulk:
+            self._finish_bulk_fuzzy()
 
-        However, for best primer finding, it may be useful (though computationally redundant) to have the most error free fuzzy representative. Therefore, I would recommend finding fuzzy kmers adding a progressive amounts of N's as appropriate results aren't found.
-
-        This is a slow point of my program right now. I need to speed up.  
-        """
-        # check if we are to the end
-        if len(current_seq) >= self.k - self.stable_bp:
-            # only yield is the appropriate number of mismatches have been allowed
-            if mismatches == self.mismatches:
-                yield "".join((current_seq, kmer))
-
-            return
-        
-        # skip if we are still in the stable start
-        elif len(current_seq) < self.stable_bp:
-            pass
-
-        else:
-            
-            # check if the current base can be fuzzy (not too many previous errors)
-            if mismatches < self.mismatches:
-                # run the ambiguous result
-                for result in self._fuzzify_kmer(kmer[1:], current_seq+"N", mismatches+1):
-                    yield result
- 
-            # base cannot be fuzzy, already enough errors
-            else:
-                # once again, not sure why I can't just return this...
-                yield "".join((current_seq, kmer))
-                return
-        
-        # run the next iteration if not returned
-        for result in self._fuzzify_kmer(kmer[1:], current_seq+kmer[0], mismatches):
-            yield result
-
-
-    #
-    ## Database Commands
-    #
-
-    def genome_in_database(self, genome_name):
-        """ Checks if a genome is present in the Genomes table """
-        cursor = self.dbc.execute("SELECT 1 FROM Genomes WHERE name = '{}' LIMIT 1".format(genome_name))
-        results = cursor.fetchone()
-        if results:
-            return True
-        else:
-            return False
-
-    def _change_sync(self, value):
-        """ Switches pragma sync to either OFF or NORMAL """
-        if value in ["OFF", "NORMAL"]:
-            self.dbc.execute("PRAGMA synchronous = {}".format(value))
-        else:
-            raise ValueError("{} is not an appropriate sync mode.".format(value))
-
-    def _add_genome(self, genome_name):
-        """ Adds a genome name and returns genome id in database """
-
-        cursor = self.dbc.execute("INSERT INTO Genomes (name) VALUES (?)", (genome_name,))
-        return cursor.lastrowid
-
-    def _add_contig(self, contig_name, genome_id, sequence):
-        """ Adds a contig and its sequence and returns the contig id in the database """
-        
-        # add the contig
-        cursor = self.dbc.execute("INSERT INTO Contigs (name, genome) VALUES (?, ?)", (contig_name, genome_id))
-        contig_id = cursor.lastrowid
-
-        # add the sequence
-        self.dbc.execute("INSERT INTO Sequences (contig, seq) VALUES (?, ?)", (contig_id, sequence))
-
-        return contig_id
-
-    def _add_kmers(self, kmers):
-        """ Insert ignore new kmers from a list of kmer iterables """
-        self.dbc.executemany('INSERT OR IGNORE INTO Kmers (id, name) VALUES (?, ?)', kmers)
-
-    def _add_locations(self, locations):
-        """ Insert new locations from a list of location tuples """
-        self.dbc.executemany('INSERT INTO Locations (genome, contig, start, strand, kmer) VALUES (?, ?, ?, ?, ?)', locations)
-
-
-    #
-    ## Run-specific commands 
-    #
-
-    def prepare_run_db(self):
-        self.open_database
-
-    def find_conserved_kmers(self, genomes=None, fuzzy=False):
-        """ Finds conserved kmers in all (default) or a specific set of genomes (specified by genomes argument) 
-        It would be nice to somehow filter out duplicates where duplicates = :
-            1. kmers that are consecutive in all genomes
-            2. fuzzy kmers that are logical duplicates (each perfectly matching kmer has something like 16 logical duplicates).
-        """
-        
-        # make a temporary table with only the genomes we want to include
-        # If genomes not specified, this table will be an exact clone of Genomes
-        self.dbc.execute(""" DROP TABLE IF EXISTS SubGen """)
-        self.dbc.execute("""CREATE TEMPORARY TABLE SubGen (
-                        id INTEGER PRIMARY KEY NOT NULL,
-                        name STRING
-                        );
-                        """)
-        if genomes:
-            self.dbc.execute("""INSERT INTO SubGen (id, name)
-                            SELECT id, name FROM Genomes
-                            WHERE Genomes.id IN ({ph})
-                            """.format(ph=",".join(["?"]*len(genomes))), genomes)
-        else:
-            self.dbc.execute("""INSERT INTO SubGen (id, name)
-                            SELECT id, name FROM Genomes
-                            """)
- 
-        return
-
-        # Make a temporary table to hold the conserved Kmers
-        self.dbc.execute("DROP TABLE IF EXISTS ConservedKmers")
-
-        self.dbc.execute("""
-                CREATE TABLE ConservedKmers (
-                id INTEGER PRIMARY KEY NOT NULL,
-                kmer INTEGER NOT NULL,
-                genome INTEGER NOT NULL,
-                contig INTEGER NOT NULL,
-                start INTEGER NOT NULL,
-                strand INTEGER NOT NULL
-                );
-                """)
-
-
-        if fuzzy:
-            # select fuzzy kmers that are present in all genomes
-            LOG.debug("Finding conserved fuzzy kmers...")
-
-            self.dbc.execute("""
-                    -- Insert results into the temp table
-                    INSERT INTO ConservedKmers (kmer, genome, contig, start, strand) 
-                    
-                    -- Select from Location
-                    SELECT cons_kmer, Contigs.genome, Locations.contig, Locations.start, Locations.strand 
-                    FROM Locations 
-
-                    -- join Contigs to be able to join SubGen
-                    INNER JOIN Contigs 
-                        ON Contigs.id = Locations.contig 
-                    
-                    -- join SubGen to check genome number
-                    INNER JOIN SubGen
-                        ON Contigs.genome = SubGen.id
-
-
-                    -- join with a select that checks  all genomes represented
-                    INNER JOIN (
-                            SELECT FuzzyKmers.id cons_kmer, KmerToFuzzy.kmer as fkmer
-                            FROM FuzzyKmers
-
-                            -- join KmerToFuzzy to get the kmers each fuzzy represents
-                            INNER JOIN KmerToFuzzy
-                                ON FuzzyKmers.id = KmerToFuzzy.fuzzy
-
-                            -- join locations to get counts
-                            INNER JOIN Locations
-                                ON KmerToFuzzy.kmer = Locations.kmer
-
-                            -- join contigs to get genomes
-                            INNER JOIN Contigs 
-                                ON Locations.contig = Contigs.id 
-
-                            -- group by fuzzy kmer
-                            GROUP BY FuzzyKmers.id
-
-                            -- contrain to all genomes represented
-                            HAVING COUNT(DISTINCT Contigs.genome) = (SELECT COUNT(*) FROM SubGen)) 
-                        ON Locations.kmer = fkmer
-
-               """)
-
-
-        else:
-
-            # select kmers that are present in all genomes
-            LOG.debug("Finding conserved kmers...")
-
-            self.dbc.execute("""
-                    -- insert results into temp table
-                    INSERT INTO ConservedKmers (kmer, genome, contig, start, strand) 
-                    
-                    -- select from locations
-                    SELECT Locations.kmer, Contigs.genome, Locations.contig, Locations.start, Locations.strand 
-                    FROM Locations 
-
-                    -- join contigs to be able to join SubGen
-                    INNER JOIN Contigs 
-                        ON Contigs.id = Locations.contig 
-
-                    -- join subgen to limit to only required genomes
-                    INNER JOIN SubGen
-                        ON Contigs.genome = SubGen.id
-
-                    -- join to select that check for kmers in all genomes
-                    INNER JOIN (
-                            SELECT Locations.kmer ckmer 
-                            FROM Locations 
-
-                            -- join contigs to get genome
-                            JOIN Contigs 
-                                ON Locations.contig = Contigs.id
-
-                            -- collapse around kmers
-                            GROUP BY Locations.kmer 
-
-                            -- contrain to only kmers found in all genomes
-                            HAVING COUNT(DISTINCT Contigs.genome) = (SELECT COUNT(*) FROM SubGen)) 
-                        ON Locations.kmer = ckmer
-                """)
-
-        self.database.commit()
-        #cursor = self.dbc.execute("SELECT * FROM ConservedKmers")
-        #print(cursor.fetchall())
-
-    def find_potential_amplicons(self, kmer_table="Kmers", min_genomes=1, min_dist=100, max_dist=400):
-        """ Finds all potential amplicons from conserved kmers """
-
-        LOG.info("Making amplicons table...")
-
-        # -- create temporary table 
-        self.dbc.execute("""
-                -- make temporary table
-                CREATE TEMPORARY TABLE temp_amplicons AS 
-                
-                -- populate it from this select
-                SELECT A.kmer AS kmer1, B.kmer AS kmer2, A.start as start1, B.start as start2, A.genome AS genome, A.contig AS contig, A.strand AS strand 
-                
-                FROM ConservedKmers A 
-                
-                -- self join to compare pairwise
-                INNER JOIN ConservedKmers B 
-                    ON (
-                        -- contig and strand must be the same
-                        A.contig = B.contig AND 
-                        A.strand = B.strand AND 
-                        
-                        -- distance must be appropriate and consistent with strand
-                        (
-                            (A.strand = '1' AND B.start - A.start BETWEEN {min_dist} AND {max_dist}) 
-                        OR 
-                            (A.strand = '-1' AND A.start - B.start BETWEEN {min_dist} AND {max_dist})
-                        )
-
-                        -- no self matches
-                        AND A.kmer != B.kmer
-                    )
-                """.format(min_dist=min_dist, max_dist=max_dist))
-
-        LOG.debug("temp_amplicons made... finishing table...")
-
-
-        # -- query temporary table
-        self.dbc.execute("DROP TABLE IF EXISTS Amplicons")
-        # this statement appends columns for num_genomes and num_total
-        self.dbc.execute("""
-                -- create a table
-                CREATE TABLE Amplicons AS 
-                
-                    -- populate it with the results from this select
-                    SELECT K1.name AS kmer1, K2.name AS kmer2, tmp_amp.start1, tmp_amp.start2, tmp_amp.genome, tmp_amp.contig, tmp_amp.strand, num_genomes, num_total 
-                    
-                    FROM temp_amplicons tmp_amp 
-                   
-                    -- join with some counts
-                    INNER JOIN 
-                        (SELECT temp_amplicons.kmer1 AS ta1, temp_amplicons.kmer2 AS ta2, COUNT(DISTINCT temp_amplicons.genome) AS num_genomes, COUNT(*) AS num_total 
-                    
-                        FROM temp_amplicons 
-                        
-                        -- group by amplicon
-                        GROUP BY temp_amplicons.kmer1, temp_amplicons.kmer2 
-                        
-                        -- require a minimum number of genomes
-                        HAVING num_genomes >= {min_genomes}) 
-                    
-                        -- merge counts with original table
-                        ON tmp_amp.kmer1 = ta1 AND tmp_amp.kmer2 = ta2 
-                    
-                    -- join with specified kmer table to get kmer1 sequence
-                    INNER JOIN {kmer_table} as K1 
-                        ON tmp_amp.kmer1 = K1.id 
-                    
-                    -- join with specified kmer table to get kmer2 sequence
-                    INNER JOIN {kmer_table} as K2 
-                        ON tmp_amp.kmer2 = K2.id 
-                        """.format(kmer_table=kmer_table, min_genomes=min_genomes))
-
-        # drop the temporary table
-        self.dbc.execute("DROP TABLE temp_amplicons")
-
-        # add an index to amplicons
-        self.dbc.execute("CREATE INDEX amplicon_indx on Amplicons (kmer1, kmer2)")
-
-        self.database.commit()
-
-    def get_amplicon_stats(self):
-
-        LOG.info("Checking amplicons and getting stats...")
-        cursor = self.dbc.execute("SELECT SubGen.name FROM SubGen ORDER BY SubGen.name")
-        genome_names = [str(itm[0]) for itm in cursor.fetchall()]
-
-      
-        # set some stats for writing amplicons
-        self.amp_write_genomes = len(genome_names)
-        self.amp_write_unique = len(genome_names)
-        self.amp_write_duplicates = 0
-        self.amp_write_N = 99
-
-
-        # make amplicon directory if it doesn't exist
-        if not os.path.isdir(self.amplicon_dir):
-            os.mkdir(self.amplicon_dir)
-
-        ordered_matches = "SELECT Amplicons.kmer1, Amplicons.kmer2 FROM Amplicons GROUP BY Amplicons.kmer1, Amplicons.kmer2 ORDER BY num_genomes DESC, num_total ASC"
-
-        cursor = self.dbc.execute(ordered_matches)
-
-        amplicon_stats = {}
-        for result in lazy_imap(self.threads, self.check_amplicon, self.generate_amp_packages(cursor)):
-            print(result)
-            amplicon_stats.update(result)
-
-
-        # sort the amplicons by num unique_genomes number (descending) and number of N's(ascending), and then num duplicates
-        sorted_amplicons = sorted(amplicon_stats, key=lambda amp_id: (-1 * amplicon_stats[amp_id]["num_unique"], amplicon_stats[amp_id]["fwd_N"] + amplicon_stats[amp_id]["rev_N"], amplicon_stats[amp_id]["num_duplicates"]))
-
-
-        with open(self.amplicon_stats_f, 'w') as STATS, open(self.amplicon_matr_f, 'w') as MATR:
-            # write headers to both files
-            STATS.write("\t".join(("amplicon", "num_genomes", "num_unique", "num_duplicates", "fwd_N", "rev_N")) + "\n")
-            MATR.write("\t".join(["amplicon"] + list(genome_names)) + "\n")
-
-            for amp in sorted_amplicons:
-                # k for key not length of kmer
-                write_stats = [str(amp)] + [str(amplicon_stats[amp][k]) for k in ["num_genomes", "num_unique", "num_duplicates", "fwd_N", "rev_N"]]
-                write_matr = [str(amp)]
-                for name in genome_names:
-                    try:
-                        write_matr.append(";".join(amplicon_stats[amp]["genome_clusters"][name]))
-                    except KeyError:
-                        write_matr.append("0")
-
-                STATS.write("\t".join(write_stats) + "\n")
-                MATR.write("\t".join(write_matr) + "\n")
-
-    def generate_amp_packages(self, cursor):
-        """ Generates so-called "amplicon packages" from a cursor that selects amplicons """
+        self._set_param("fuzzy_epoch", current_epoch)
+        self.dbc.commit()
 
-        amp_id = 0
-        for batch in self._iter_sql_results(cursor, 100):
-            for amp in batch:
-                amp_id += 1
-                k1, k2 = amp
+        return num_links
 
-                seqs = self.dbc.execute("""
-                        SELECT Genomes.name, Contigs.name, Amplicons.start1 as start, Amplicons.start2 + {k} as end, Amplicons.strand, SUBSTR(Sequences.seq, Amplicons.start1 + 1, Amplicons.start2 + {k} - Amplicons.start1) 
-                        
-                        FROM Amplicons 
-                        
-                        INNER JOIN Genomes 
-                            ON Amplicons.genome = Genomes.id 
-                        
-                        INNER JOIN Contigs 
-                            ON Amplicons.contig = Contigs.id 
-                        
-                        INNER JOIN Sequences 
-                            ON Amplicons.contig = Sequences.id WHERE Amplicons.kmer1 = '{k1}' 
-                            AND Amplicons.kmer2 = '{k2}'
-                        
-                        """.format(k=self.k, k1=k1, k2=k2)).fetchall()
-                yield (amp_id, k1, k2, seqs)
+    def _begin_bulk_fuzzy(self):
+        """ Drops the KmerToFuzzy index if the table is empty so it can be built once at the end """
 
-    def check_amplicon(self, amp_package):
-        """ Checks amplicons and returns a dict of amplicon stats """
-        
-        # unpack the package
-        amp_id, fwd_prim, rev_prim, db_sequences = amp_package
+        # adding to a big existing table is cheaper through the index than rebuilding it
+        has_index = self.dbc.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'kmer_to_fuzzy_indx'").fetchone()
+        empty = self.dbc.execute("SELECT 1 FROM KmerToFuzzy LIMIT 1").fetchone() is None
+        self._rebuild_fuzzy_index = bool(has_index) and empty
+        if self._rebuild_fuzzy_index:
+            self.dbc.execute("DROP INDEX kmer_to_fuzzy_indx")
 
-        amplicon_name = "amp{amp_id}_{fwd_prim}-{rev_prim}.fasta".format(amp_id=amp_id, fwd_prim=fwd_prim, rev_prim=rev_prim)
-        # initialize the results dict
-        amplicon_stats = {amplicon_name: {}}
+    def _finish_bulk_fuzzy(self):
+        """ Builds the KmerToFuzzy index dropped by _begin_bulk_fuzzy, removing duplicate links in one pass if there are any """
+        if not self._rebuild_fuzzy_index:
+            return
 
-        amplicon_stats[amplicon_name]["fwd_N"] = fwd_prim.count("N")
-        amplicon_stats[amplicon_name]["rev_N"] = rev_prim.count("N")
+        LOG.info("Indexing KmerToFuzzy...")
+        try:
+            self.dbc.execute("CREATE UNIQUE INDEX kmer_to_fuzzy_indx ON KmerToFuzzy (kmer, fuzzy)")
+        except sqlite3.IntegrityError:
+            LOG.info("Removing duplicate links from KmerToFuzzy...")
+            self.dbc.execute("DELETE FROM KmerToFuzzy WHERE id NOT IN (SELECT MIN(id) FROM KmerToFuzzy GROUP BY kmer, fuzzy)")
+            self.dbc.execute("CREATE UNIQUE INDEX kmer_to_fuzzy_indx ON KmerToFuzzy (kmer, fuzzy)")
+
+    def _iter_kmer_batches(self, kmers, batchsize):
+        """ Yields slices of an array of kmer ids in groups of batchsize """
+        for indx in range(0, len(kmers), batchsize):
+            yield kmers[indx:indx + batchsize]
+
+    def _generate_fuzzy_entries(self, kmers, chunksize=2**16):
+        """
+        Takes an array of kmer ids and returns (kmer ids, fuzzy ids) arrays linking each kmer to all of its fuzzy kmers.
 
-        #
-        ## convert database data to BioPython Sequence objects
-        #
-        full_seqs = []
-        inter_primer_only = {}
-        for db_data in db_sequences:
-            genome, contig, start, end, strand, seq = db_data
-            
-            header = "genome={genome};contig={contig};location=[{start}:{end}];strand={strand}".format(genome=genome, contig=contig, start=start, end=end, strand=strand)
-            seq_obj = SeqRecord(seq=Seq(seq), id=header, description="")
+        Only fuzzy kmers with exactly self.mismatches Ns are generated because clusters with mismatch < N are included.
 
-            # reverse complement if necessary
-            if strand == "-1":
-                seq_obj = seq_obj.reverse_complement()
+        Fuzzy ids are the kmer written in base 5 (A=0, C=1, G=2, T=3, N=4). Each kmer is expanded to its
+        base 5 digits once and every mask pattern from fuzzy_masks is applied to the whole chunk in a single
+        matrix product; swapping digit d for an N at a position with weight w adds (4 - d) * w to the id.
+        """
+        if 5 ** self.k > np.iinfo(np.int64).max:
+            raise ValueError("Fuzzy kmer ids for k={} do not fit in 64 bits (max k is 27).".format(self.k))
 
+        masks = fuzzy_masks(self.k, int(self.mismatches), int(self.stable_bp))
+        shifts = np.arange(2 * (self.k - 1), -1, -2, dtype=np.uint64)
+        weights = 5 ** np.arange(self.k - 1, -1, -1, dtype=np.int64)
 
-            # store one copy in full_seqs and one copy in inter_primer_only
-            full_seqs.append(seq_obj)
-            inter_primer_only[(genome, header)] = str(seq_obj[self.k:-self.k].seq)
- 
-        #
-        ## Place each sequence into a cluster based on uniqueness
-        #
-        clusters = {}
-        cluster_counts = {}
-        cluster = 0
-        for key1, seq1 in inter_primer_only.items():
+        kmers = np.asarray(kmers, dtype=np.uint64)
+        fuzzy_ids = np.empty((len(kmers), len(masks)), dtype=np.int64)
+        for indx in range(0, len(kmers), chunksize):
+            digits = ((kmers[indx:indx + chunksize, None] >> shifts) & np.uint64(3)).astype(np.int64)
+            fuzzy_ids[indx:indx + chunksize] = (digits @ weights)[:, None] + ((4 - digits) * weights) @ masks.T
 
-            # skip seqs that already have cluster assigned
-            if key1 in clusters:
-                continue
-            else:
-                cluster += 1
-                clusters[key1] = str(cluster)
-                cluster_counts[cluster] = 1
+        return np.repeat(kmers, len(masks)), fuzzy_ids.ravel()
 
-            for key2, seq2 in inter_primer_only.items():
-                if key1 is key2:
-                    continue
 
-                # skip seqs that have already been processed
-                elif key2 in clusters:
-                    continue
+    #
+    ## Database Commands
+    #
 
-                else:
-                    # check if the seqs are == 
-                    if seq1 == seq2:
-                        clusters[key2] = str(cluster)
-                        cluster_counts[cluster] += 1
+    def genome_in_database(self, genome_name):
+        """ Checks if a genome is present in the Genomes table """
+        cursor = self.dbc.execute("SELECT 1 FROM Genomes WHERE name = ? LIMIT 1", (genome_name,))
+        results = cursor.fetchone()
+        if results:
+            return True
+        else:
+            return False
 
-        # Find genomes that are parts of unique clusters
-        duplicated_genomes = 0
-        unique_genomes = set()     
-        genome_clusters = {}
-        for key in clusters:
-            genome, header = key
+    def _change_sync(self, value):
+        """ Switches pragma sync to either OFF or NORMAL """
+        if value in ["OFF", "NORMAL"]:
+            self.dbc.execute("PRAGMA synchronous = {}".format(value))
+        else:
+            raise ValueError("{} is not an appropriate sync mode.".format(value))
 
-            cluster = clusters[key]
+    def _add_genome(self, genome_name, epoch):
+        """ Adds a genome name and returns genome id in database """
 
-            if cluster_counts[int(cluster)] == 1:
-                unique_genomes.add(genome)
-            try:
-                genome_clusters[genome].append(clusters[key])
-                duplicated_genomes += 1
-            except KeyError:
-                genome_clusters[genome] = [clusters[key]]
+        cursor = self.dbc.execute("INSERT INTO Genomes (name, epoch) VALUES (?, ?)", (genome_name, epoch))
+        return cursor.lastrowid
 
-        amplicon_stats[amplicon_name]["num_genomes"] = len(genome_clusters)
-        amplicon_stats[amplicon_name]["num_unique"] = len(unique_genomes)
-        amplicon_stats[amplicon_name]["num_duplicates"] = duplicated_genomes
-        amplicon_stats[amplicon_name]["genome_clusters"] = genome_clusters
+    def _add_contig(self, contig_name, genome_id, sequence):
+        """ Adds a contig and its sequence and returns the contig id in the database """
+        
+        # add the contig
+        cursor = self.dbc.execute("INSERT INTO Contigs (name, genome) VALUES (?, ?)", (contig_name, genome_id))
+        contig_id = cursor.lastrowid
 
-        # check some standards to determine if this amp should be written
-        if amplicon_stats[amplicon_name]["num_genomes"] >= self.amp_write_genomes and \
-                amplicon_stats[amplicon_name]["num_unique"] >= self.amp_write_unique and \
-                amplicon_stats[amplicon_name]["num_duplicates"] <= self.amp_write_duplicates and \
-                amplicon_stats[amplicon_name]["fwd_N"] + amplicon_stats[amplicon_name]["rev_N"] <= self.amp_write_N:
+        # add the sequence
+        self.dbc.execute("INSERT INTO Sequences (contig, seq) VALUES (?, ?)", (contig_id, sequence))
 
-            with open(self.amplicon_dir + "/" + amplicon_name, 'w') as OUT:
-                SeqIO.write(full_seqs, OUT, "fasta")
+        return contig_id
 
-        return amplicon_stats
+
+    #
+    ## Consistency checks
+    #
+
+    def check_consistency(self):
+        """ Checks that the genomes, kmer index, epoch deltas, and fuzzy kmers agree. Returns a list of problems (empty if consistent) """
+        problems = []
+
+        genomes = set(row[0] for row in self.dbc.execute("SELECT id FROM Genomes"))
+        indexed = set(self.index.genome_ids())
+        for genome_id in sorted(genomes - indexed):
+            problems.append("Genome {} has no kmer index file.".format(genome_id))
+        for genome_id in sorted(indexed - genomes):
+            problems.append("Kmer index file for genome {} has no entry in Genomes.".format(genome_id))
+
+        epochs = set(self.genomes_by_epoch())
+        deltas = set(self.index.epochs())
+        for epoch in sorted(epochs - deltas):
+            problems.append("Ingest epoch {} has no kmer delta (run main again to record it).".format(epoch))
+        for epoch in sorted(deltas - epochs):
+            problems.append("Kmer delta for epoch {} has no genomes.".format(epoch))
+
+        # deltas should partition kmers.npy which should be every kmer in the genome indexes
+        all_kmers = self.index.all_kmers()
+        delta_kmers = self.index.delta_kmers(-1)
+        if len(KmerIndex._unique_sorted(delta_kmers)) != len(delta_kmers):
+            problems.append("Kmer deltas overlap.")
+        if not np.array_equal(delta_kmers, all_kmers):
+            problems.append("Kmer deltas ({}) do not match the kmer set ({}).".format(len(delta_kmers), len(all_kmers)))
+        if not (epochs - deltas) and not np.array_equal(self.index.scan_kmers(sorted(genomes & indexed)), all_kmers):
+            problems.append("Kmer set does not match the kmers in the genome indexes.")
+
+        fuzzy_epoch = self.lookup_param("fuzzy_epoch")
+        if fuzzy_epoch is not None:
+            fuzzy_epoch = int(fuzzy_epoch)
+            if fuzzy_epoch > self.current_epoch():
+                problems.append("Fuzzy kmers were generated through epoch {} but the latest epoch is {}.".format(fuzzy_epoch, self.current_epoch()))
+
+            fuzzified = np.array([row[0] for row in self.dbc.execute("SELECT DISTINCT kmer FROM KmerToFuzzy ORDER BY kmer")], dtype=np.uint64)
+            expected = all_kmers[~KmerIndex._contains(self.index.delta_kmers(fuzzy_epoch), all_kmers)]
+            if len(fuzzy_masks(self.k, int(self.mismatches), int(self.stable_bp))) and not np.array_equal(fuzzified, expected):
+                problems.append("{} kmers have fuzzy kmers but {} kmers from epochs up to {} should.".format(len(fuzzified), len(expected), fuzzy_epoch))
+
+            orphans = self.dbc.execute("SELECT COUNT(*) FROM KmerToFuzzy LEFT JOIN FuzzyKmers ON KmerToFuzzy.fuzzy = FuzzyKmers.id WHERE FuzzyKmers.id IS NULL").fetchone()[0]
+            if orphans:
+                problems.append("{} KmerToFuzzy links point to missing fuzzy kmers.".format(orphans))
+
+        return problems
 
 
 class DatabaseRun(Database):
@@ -935,6 +1231,7 @@ class DatabaseRun(Database):
 
 
         self.dbc = self.open_database(main_db_f)
+        self.index = KmerIndex(main_db_f + ".kmers")
 
     def _attach_run_db(self, force):
         """ Attached the run_specific db and checks if the file exists."""
@@ -948,7 +1245,7 @@ class DatabaseRun(Database):
                 raise ValueError("Run databse already exists. Refusing to overwrite without the -force option. It is recommended to just specify a different -prefix")
 
         # attach the run_specific database
-        self.dbc.execute("ATTACH '{}' AS run_specific".format(self.run_database_f))
+        self.dbc.execute("ATTACH ? AS run_specific", (self.run_database_f,))
  
         # make params table if it doesn't exist
         exists = self.dbc.execute("SELECT name FROM run_specific.sqlite_master WHERE type='table' AND name='Params'").fetchone()
@@ -967,7 +1264,7 @@ class DatabaseRun(Database):
     def lookup_param(self, key):
         """ Lookup a param in the Params table by a given key. Returns a list for keys that have multiple values, a single value for keys that have one value, or None for keys that are not in the database """
 
-        results = self.dbc.execute("SELECT value FROM run_specific.Params WHERE key = '{}'".format(key)).fetchall()
+        results = self.dbc.execute("SELECT value FROM run_specific.Params WHERE key = ?", (key,)).fetchall()
 
         if len(results) == 0:
             return None
@@ -1012,7 +1309,7 @@ class DatabaseRun(Database):
         """ Process the run recalculating as few steps as possible """
 
         #self._attach_run_db(force)
-        self.dbc.execute("ATTACH '{}' as run_specific".format(self.run_database_f))
+        self.dbc.execute("ATTACH ? AS run_specific", (self.run_database_f,))
 
         # set genomes = to all genomes in the database if none were specified
         if genomes is None:
@@ -1037,6 +1334,7 @@ class DatabaseRun(Database):
 
         self.get_amplicon_stats()
 
+    @PROFILER.timed("conserved")
     def find_conserved_kmers(self):
         """ Finds conserved kmers in all (default) or a specific set of genomes (specified by genomes argument) 
         It would be nice to somehow filter out duplicates where duplicates = :
@@ -1057,13 +1355,6 @@ class DatabaseRun(Database):
         if type(genomes) != list:
             genomes = [genomes]
 
-        command = """
-                        INSERT INTO SubGen (id, name)
-                        SELECT id, name FROM Genomes
-                        WHERE Genomes.name IN ('{placeholder}')
-                        """.format(placeholder="', '".join([genome for genome in genomes]))
- 
-
         cursor = self.dbc.execute("""
                         INSERT INTO SubGen (id, name)
                         SELECT id, name FROM Genomes
@@ -1085,188 +1376,220 @@ class DatabaseRun(Database):
         # lookup the fuzzy value from the params table
         fuzzy = self.lookup_param("fuzzy")
 
+        genome_ids = [row[0] for row in self.dbc.execute("SELECT id FROM run_specific.SubGen")]
 
         if fuzzy:
             # select fuzzy kmers that are present in all genomes
             LOG.debug("Finding conserved fuzzy kmers...")
+        else:
+            # select kmers that are present in all genomes
+            LOG.debug("Finding conserved kmers...")
 
-            cursor = self.dbc.execute("""
-                    -- Insert results into the temp table
-                    INSERT INTO ConservedKmers (kmer, genome, contig, start, strand) 
-
-                    -- Select from Location
-                    SELECT cons_kmer, Locations.genome, Locations.contig, Locations.start, Locations.strand 
-                    FROM Locations 
-
-                    -- join SubGen to check genome number
-                    INNER JOIN SubGen
-                        ON Locations.genome = SubGen.id
-
+        conserved = self.index.conserved_locations(genome_ids, links=self._conserved_links())
+        PROFILER.count("conserved_locations", len(conserved))
 
-                    -- join with a select that checks  all genomes represented
-                    INNER JOIN (
-                            SELECT FuzzyKmers.id cons_kmer, KmerToFuzzy.kmer as fkmer
-                            FROM FuzzyKmers
+        self.dbc.executemany("INSERT INTO ConservedKmers (kmer, genome, contig, start, strand) VALUES (?, ?, ?, ?, ?)", conserved.tolist())
 
-                            -- join KmerToFuzzy to get the kmers each fuzzy represents
-                            INNER JOIN KmerToFuzzy
-                                ON FuzzyKmers.id = KmerToFuzzy.fuzzy
+        self.dbc.commit()
 
-                            -- join locations to get counts
-                            INNER JOIN Locations
-                                ON KmerToFuzzy.kmer = Locations.kmer
+    def _conserved_links(self, groups=None):
+        """ 
+        Returns the (kmers, groups) links sorted by kmer used to find conserved kmers (optionally only for some sorted groups) 
+        
+        KmerToFuzzy is read in batches so only the link arrays are held in memory, never the whole table as tuples.
+        """
+        if self.lookup_param("fuzzy"):
+            if groups is None:
+                links = np.empty((self.dbc.execute("SELECT COUNT(*) FROM KmerToFuzzy").fetchone()[0], 2), dtype=np.uint64)
+                filled = 0
+            else:
+                kept = [np.zeros((0, 2), dtype=np.uint64)]
 
-                            -- group by fuzzy kmer
-                            GROUP BY FuzzyKmers.id
+            cursor = self.dbc.execute("SELECT kmer, fuzzy FROM KmerToFuzzy ORDER BY kmer")
+            for batch in self._iter_sql_results(cursor, 100000):
+                if groups is None:
+                    links[filled:filled + len(batch)] = batch
+                    filled += len(batch)
+                else:
+                    batch = np.array(batch, dtype=np.uint64)
+                    kept.append(batch[KmerIndex._contains(groups, batch[:, 1])])
 
-                            -- contrain to all genomes represented
-                            HAVING COUNT(DISTINCT Locations.genome) = (SELECT COUNT(*) FROM SubGen)) 
-                        ON Locations.kmer = fkmer
+            if groups is not None:
+                links = np.concatenate(kept)
 
-               """)
+            return links[:, 0], links[:, 1]
+        elif groups is not None:
+            return groups, groups
         else:
+            return None
 
-            # select kmers that are present in all genomes
-            LOG.debug("Finding conserved kmers...")
+    def _run_genome_ids(self):
+        return [row[0] for row in self.dbc.execute("SELECT id FROM run_specific.SubGen ORDER BY id")]
 
-            self.dbc.execute("""
-                    -- insert results into temp table
-                    INSERT INTO ConservedKmers (kmer, genome, contig, start, strand) 
-                    
-                    -- select from locations
-                    SELECT Locations.kmer, Contigs.genome, Locations.contig, Locations.start, Locations.strand 
-                    FROM Locations 
+    def add_genomes(self, genomes):
+        """ 
+        Adds genomes to a finished run, updating conserved kmers and amplicons for the new genomes only.
 
-                    -- join contigs to be able to join SubGen
-                    INNER JOIN Contigs 
-                        ON Contigs.id = Locations.contig 
+        Kmers conserved in the larger set are the ones already conserved that are also in every new genome. 
+        The existing ConservedKmers rows are filtered to those and only the new genomes' locations are looked up.
+        Amplicons are then found again from the updated conserved kmers and their output files are rewritten.
+        """
+        self.dbc.execute("ATTACH ? AS run_specific", (self.run_database_f,))
+
+        current = self.lookup_param("genomes")
+        if type(current) != list:
+            current = [current]
+        genomes = [genome for genome in genomes if genome not in current]
+        if not genomes:
+            LOG.info("All genomes are already part of this run.")
+            return
 
-                    -- join subgen to limit to only required genomes
-                    INNER JOIN SubGen
-                        ON Contigs.genome = SubGen.id
+        rows = self.dbc.execute("SELECT id, name, epoch FROM Genomes WHERE name IN ({})".format(",".join(["?"]*len(genomes))), genomes).fetchall()
+        missing = set(genomes) - set(row[1] for row in rows)
+        if missing:
+            raise ValueError("Genomes not found in the main database: {}".format(", ".join(sorted(missing))))
 
-                    -- join to select that check for kmers in all genomes
-                    INNER JOIN (
-                            SELECT Locations.kmer ckmer 
-                            FROM Locations 
+        if self.lookup_param("fuzzy"):
+            fuzzy_epoch = super().lookup_param("fuzzy_epoch")
+            if fuzzy_epoch is None or max(row[2] for row in rows) > fuzzy_epoch:
+                raise ValueError("Fuzzy kmers have not been generated for all of the new genomes. Run the main command with -fuzzy first.")
 
-                            -- join contigs to get genome
-                            JOIN Contigs 
-                                ON Locations.contig = Contigs.id
+        new_ids = [row[0] for row in rows]
+        LOG.info("Adding {} genomes to the run...".format(len(new_ids)))
 
-                            -- collapse around kmers
-                            GROUP BY Locations.kmer 
+        conserved = np.array([row[0] for row in self.dbc.execute("SELECT DISTINCT kmer FROM ConservedKmers ORDER BY kmer")], dtype=np.uint64)
+        new_locations = self.index.conserved_locations(new_ids, links=self._conserved_links(conserved))
+        still_conserved = KmerIndex._unique_sorted(np.sort(new_locations["kmer"]))
+        LOG.info("{} of {} conserved kmers are in the new genomes.".format(len(still_conserved), len(conserved)))
 
-                            -- contrain to only kmers found in all genomes
-                            HAVING COUNT(DISTINCT Contigs.genome) = (SELECT COUNT(*) FROM SubGen)) 
-                        ON Locations.kmer = ckmer
-                """)
+        self.dbc.execute("CREATE TEMPORARY TABLE StillConserved (kmer INTEGER PRIMARY KEY)")
+        self.dbc.executemany("INSERT INTO StillConserved (kmer) VALUES (?)", [(kmer,) for kmer in still_conserved.tolist()])
 
-        self.dbc.commit()
+        self.dbc.execute("DELETE FROM ConservedKmers WHERE kmer NOT IN (SELECT kmer FROM StillConserved)")
+        self.dbc.executemany("INSERT INTO ConservedKmers (kmer, genome, contig, start, strand) VALUES (?, ?, ?, ?, ?)", new_locations.tolist())
 
-    def find_potential_amplicons(self):
-        """ Finds all potential amplicons from conserved kmers 
-        
-        TODO: Add k to length calculations to get actual length
-        """
+        self.dbc.executemany("INSERT INTO SubGen (id, name) VALUES (?, ?)", [(row[0], row[1]) for row in rows])
+        for genome in genomes:
+            self.add_params_to_database(genomes=genome)
 
-        # lookup fuzzy so we know which table to use
-        fuzzy = self.lookup_param("fuzzy")
-        if fuzzy:
-            kmer_table = "FuzzyKmers"
-        else:
-            kmer_table = "Kmers"
+        self.dbc.execute("DROP TABLE StillConserved")
+        self.dbc.commit()
 
-        LOG.info("Making amplicons table...")
+        # amplicons are cheap to find from the conserved kmers so they are just redone
+        amplicons = self.dbc.execute("SELECT name FROM run_specific.sqlite_master WHERE type='table' AND name='Amplicons'").fetchone()
+        if amplicons:
+            LOG.info("Updating amplicons...")
+            self.dbc.execute("DROP TABLE run_specific.Amplicons")
+            self.find_potential_amplicons()
 
+            # the stats, matrix, and top amplicon FASTA files are rewritten for the new genome set
+            if os.path.isdir(self.amplicon_dir):
+                for fasta in os.listdir(self.amplicon_dir):
+                    if fasta.endswith(".fasta"):
+                        os.remove(os.path.join(self.amplicon_dir, fasta))
 
-        amp_min_len = self.lookup_param("amp_min_len")
-        amp_max_len = self.lookup_param("amp_max_len")
+            self.get_amplicon_stats()
 
+    def check_consistency(self):
+        """ Checks that the run's conserved kmers match a fresh calculation and its amplicons only use conserved kmers. Returns a list of problems (empty if consistent) """
+        problems = []
 
-        # I might could speed this up by breaking up the OR into two separate inserts
+        genomes = self.lookup_param("genomes")
+        if type(genomes) != list:
+            genomes = [genomes]
+        names = [row[0] for row in self.dbc.execute("SELECT name FROM run_specific.SubGen")]
+        if sorted(names) != sorted(genomes):
+            problems.append("Run genomes ({}) do not match the genomes param ({}).".format(len(names), len(genomes)))
+
+        expected = self.index.conserved_locations(self._run_genome_ids(), links=self._conserved_links())
+        expected = sorted(expected.tolist())
+        found = sorted(self.dbc.execute("SELECT kmer, genome, contig, start, strand FROM ConservedKmers").fetchall())
+        if found != expected:
+            problems.append("ConservedKmers has {} rows but {} are expected.".format(len(found), len(expected)))
+
+        amplicons = self.dbc.execute("SELECT name FROM run_specific.sqlite_master WHERE type='table' AND name='Amplicons'").fetchone()
+        if amplicons:
+            k = int(super().lookup_param("k"))
+            alphabet = "ACGTN" if self.lookup_param("fuzzy") else "ACGT"
+            conserved = set(kmer_id_to_name(row[0], k, alphabet) for row in self.dbc.execute("SELECT DISTINCT kmer FROM ConservedKmers"))
+            stale = [row for row in self.dbc.execute("SELECT DISTINCT kmer1, kmer2 FROM Amplicons") if row[0] not in conserved or row[1] not in conserved]
+            if stale:
+                problems.append("{} amplicons use kmers that are no longer conserved.".format(len(stale)))
+
+        return problems
+
+    @PROFILER.timed("amplicons")
+    def find_potential_amplicons(self):
+        """ Finds all potential amplicons from conserved kmers with an AmpliconEngine and writes the well supported ones to the Amplicons table
+        
+        Amplicons are written in the order they are checked (most genomes first, then fewest occurrences) and indexed on that order.
 
-        # -- create temporary table 
-        self.dbc.execute("""
-                -- make temporary table
-                CREATE TABLE run_specific.temp_amplicons AS 
-                
-                -- populate it from this select
-                SELECT A.kmer AS kmer1, B.kmer AS kmer2, A.start as start1, B.start as start2, A.genome AS genome, A.contig AS contig, A.strand AS strand 
-                
-                FROM ConservedKmers A 
-                
-                -- self join to compare pairwise
-                INNER JOIN ConservedKmers B 
-                    ON (
-                        -- contig and strand must be the same
-                        -- contig first because it is more specific than strand
-                        A.contig = B.contig AND 
-                        A.strand = B.strand AND 
-
-                        -- no self matches
-                        A.kmer != B.kmer AND
-                        
-                        -- distance must be appropriate and consistent with strand
-                        (
-                            (A.strand = '1' AND B.start - A.start BETWEEN {amp_min_len} AND {amp_max_len}) 
-                        OR 
-                            (A.strand = '-1' AND A.start - B.start BETWEEN {amp_min_len} AND {amp_max_len})
-                        )
+        TODO: Add k to length calculations to get actual length
+        """
 
-                   )
-                """.format(amp_min_len=amp_min_len, amp_max_len=amp_max_len))
+        LOG.info("Making amplicons table...")
 
-        LOG.debug("temp_amplicons made... finishing table...")
+        hits = np.array(self.dbc.execute("SELECT kmer, genome, contig, start, strand FROM ConservedKmers").fetchall(), dtype=np.int64).reshape(-1, 5)
+        conserved = np.empty(len(hits), dtype=KmerIndex.CONSERVED_DTYPE)
+        for indx, field in enumerate(KmerIndex.CONSERVED_DTYPE.names):
+            conserved[field] = hits[:, indx]
 
+        engine = AmpliconEngine(conserved, self.lookup_param("amp_min_len"), self.lookup_param("amp_max_len"))
 
         # get the number of genomes that must be present in the amplicon
         total_genomes = self.dbc.execute("SELECT COUNT(*) FROM run_specific.SubGen").fetchone()[0]
         amp_frac_genomes = self.lookup_param("amp_frac_genomes")
         min_num_genomes = math.ceil(total_genomes / amp_frac_genomes)
 
-        # this statement appends columns for num_genomes and num_total
+        results = list(engine.amplicons(min_num_genomes))
+        if results:
+            pairs = np.concatenate([result[0] for result in results])
+            num_genomes = np.concatenate([result[1] for result in results])
+            num_total = np.concatenate([result[2] for result in results])
+        else:
+            pairs = np.empty(0, dtype=AmpliconEngine.PAIR_DTYPE)
+            num_genomes = num_total = np.empty(0, dtype=np.int64)
+
+        order = np.lexsort((pairs["start1"], pairs["contig"], pairs["kmer2"], pairs["kmer1"], num_total, -num_genomes))
+        pairs = pairs[order]
+        num_genomes = num_genomes[order]
+        num_total = num_total[order]
+        LOG.debug("Found {} amplicon occurrences in at least {} genomes.".format(len(pairs), min_num_genomes))
+        PROFILER.count("amplicon_occurrences", len(pairs))
+
+        # lookup fuzzy so we know how to convert kmer ids to names
+        k = int(super().lookup_param("k"))
+        if self.lookup_param("fuzzy"):
+            to_names = lambda kmer_ids: fuzzy_ids_to_names(kmer_ids, k)
+        else:
+            to_names = lambda kmer_ids: KCounter.decode_kmers(kmer_ids, k)
+
         self.dbc.execute("""
-                -- create a table
-                CREATE TABLE run_specific.Amplicons AS 
-                
-                    -- populate it with the results from this select
-                    SELECT K1.name AS kmer1, K2.name AS kmer2, tmp_amp.start1, tmp_amp.start2, tmp_amp.genome, tmp_amp.contig, tmp_amp.strand, num_genomes, num_total 
-                    
-                    FROM temp_amplicons tmp_amp 
-                   
-                    -- join with some counts
-                    INNER JOIN 
-                        (SELECT temp_amplicons.kmer1 AS ta1, temp_amplicons.kmer2 AS ta2, COUNT(DISTINCT temp_amplicons.genome) AS num_genomes, COUNT(*) AS num_total 
-                    
-                        FROM temp_amplicons 
-                        
-                        -- group by amplicon
-                        GROUP BY temp_amplicons.kmer1, temp_amplicons.kmer2 
-                        
-                        -- require a minimum number of genomes
-                        HAVING num_genomes >= {min_num_genomes}) 
-                    
-                        -- merge counts with original table
-                        ON tmp_amp.kmer1 = ta1 AND tmp_amp.kmer2 = ta2 
-                    
-                    -- join with specified kmer table to get kmer1 sequence
-                    INNER JOIN {kmer_table} as K1 
-                        ON tmp_amp.kmer1 = K1.id 
-                    
-                    -- join with specified kmer table to get kmer2 sequence
-                    INNER JOIN {kmer_table} as K2 
-                        ON tmp_amp.kmer2 = K2.id 
-                        """.format(kmer_table=kmer_table, min_num_genomes=min_num_genomes))
+                CREATE TABLE run_specific.Amplicons (
+                kmer1 TEXT,
+                kmer2 TEXT,
+                start1 INTEGER,
+                start2 INTEGER,
+                genome INTEGER,
+                contig INTEGER,
+                strand INTEGER,
+                num_genomes INTEGER,
+                num_total INTEGER
+                );
+                """)
 
-        # drop the temporary table
-        #self.dbc.execute("DROP TABLE temp_amplicons")
+        for indx in range(0, len(pairs), 100000):
+            batch = slice(indx, indx + 100000)
+            rows = zip(to_names(pairs["kmer1"][batch]), to_names(pairs["kmer2"][batch]), pairs["start1"][batch].tolist(), pairs["start2"][batch].tolist(), pairs["genome"][batch].tolist(), pairs["contig"][batch].tolist(), pairs["strand"][batch].tolist(), num_genomes[batch].tolist(), num_total[batch].tolist())
+            self.dbc.executemany("INSERT INTO Amplicons VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
 
         # add an index to amplicons
         self.dbc.execute("CREATE INDEX run_specific.amplicon_indx on Amplicons (kmer1, kmer2)")
+        self.dbc.execute("CREATE INDEX run_specific.amplicon_order_indx on Amplicons (num_genomes DESC, num_total, kmer1, kmer2)")
 
         self.dbc.commit()
 
+    @PROFILER.timed("amplicon_stats")
     def get_amplicon_stats(self):
 
         LOG.info("Checking amplicons and getting stats...")
@@ -1274,12 +1597,29 @@ class DatabaseRun(Database):
         genome_names = [str(itm[0]) for itm in cursor.fetchall()]
 
       
-        ordered_matches = "SELECT rowid, Amplicons.kmer1, Amplicons.kmer2 FROM Amplicons GROUP BY Amplicons.kmer1, Amplicons.kmer2 ORDER BY num_genomes DESC, num_total ASC"
+        # every amplicon row with its sequence, ordered so the rows of each amplicon are together
+        ordered_matches = """
+                SELECT Amplicons.rowid, Amplicons.kmer1, Amplicons.kmer2, Genomes.name, Contigs.name, Amplicons.start1 as start, Amplicons.start2 + :k as end, Amplicons.strand, SUBSTR(Sequences.seq, Amplicons.start1 + 1, Amplicons.start2 + :k - Amplicons.start1) 
+
+                FROM Amplicons 
+
+                INNER JOIN Genomes 
+                    ON Amplicons.genome = Genomes.id 
 
-        cursor = self.dbc.execute(ordered_matches)
+                INNER JOIN Contigs 
+                    ON Amplicons.contig = Contigs.id 
+
+                INNER JOIN Sequences 
+                    ON Amplicons.contig = Sequences.id 
+
+                ORDER BY Amplicons.num_genomes DESC, Amplicons.num_total ASC, Amplicons.kmer1, Amplicons.kmer2, Amplicons.rowid
+                """
+
+        cursor = self.dbc.execute(ordered_matches, {'k': super().lookup_param("k")})
 
         amplicon_stats = {}
         for result in lazy_imap(self.threads, self.check_amplicon, self.generate_amp_packages(cursor)):
+            PROFILER.count("amplicons_checked")
             amplicon_stats.update(result)
 
 
@@ -1325,14 +1665,25 @@ class DatabaseRun(Database):
         LOG.info("Wrote top amplicon FASTA files to...  {}".format(self.amplicon_dir))
 
     def generate_amp_packages(self, cursor):
-        """ Generates so-called "amplicon packages" from a cursor that selects amplicons """
+        """ 
+        Generates so-called "amplicon packages" from a cursor that selects amplicon rows (rowid, kmer1, kmer2, and the 
+        get_amplicon_seqs columns) with the rows of each amplicon together. The amp_id is the first rowid of the amplicon.
+        """
+
+        package = None
+        for batch in self._iter_sql_results(cursor, 10000):
+            for row in batch:
+                amp_id, k1, k2 = row[:3]
 
-        for batch in self._iter_sql_results(cursor, 100):
-            for amp in batch:
-                amp_id, k1, k2 = amp
-                seqs = self.get_amplicon_seqs(amp_id)
+                if package is None or (k1, k2) != (package[1], package[2]):
+                    if package is not None:
+                        yield package
+                    package = (amp_id, k1, k2, [])
 
-                yield (amp_id, k1, k2, seqs)
+                package[3].append(row[3:])
+
+        if package is not None:
+            yield package
 
     def check_amplicon(self, amp_package):
         """ Checks amplicons and returns a dict of amplicon stats """
@@ -1454,7 +1805,7 @@ class DatabaseRun(Database):
 
         k = super().lookup_param("k")
         seqs = self.dbc.execute("""
-                SELECT Genomes.name, Contigs.name, Amplicons.start1 as start, Amplicons.start2 + {k} as end, Amplicons.strand, SUBSTR(Sequences.seq, Amplicons.start1 + 1, Amplicons.start2 + {k} - Amplicons.start1) 
+                SELECT Genomes.name, Contigs.name, Amplicons.start1 as start, Amplicons.start2 + :k as end, Amplicons.strand, SUBSTR(Sequences.seq, Amplicons.start1 + 1, Amplicons.start2 + :k - Amplicons.start1) 
                     
                 FROM Amplicons 
                         
@@ -1467,10 +1818,10 @@ class DatabaseRun(Database):
                 INNER JOIN Sequences 
                     ON Amplicons.contig = Sequences.id 
                             
-                WHERE Amplicons.kmer1 = (SELECT kmer1 FROM Amplicons WHERE rowid = '{rowid}' LIMIT 1) AND
-                    Amplicons.kmer2 = (SELECT kmer2 FROM Amplicons WHERE rowid = '{rowid}' LIMIT 1)
+                WHERE Amplicons.kmer1 = (SELECT kmer1 FROM Amplicons WHERE rowid = :rowid LIMIT 1) AND
+                    Amplicons.kmer2 = (SELECT kmer2 FROM Amplicons WHERE rowid = :rowid LIMIT 1)
                         
-                """.format(k=k, rowid=amp_id)).fetchall()
+                """, {'k': k, 'rowid': amp_id}).fetchall()
  
         return seqs
 
@@ -1479,14 +1830,23 @@ class KCounter(multiprocessing.Process):
 
     COMPLEMENT_MAP = {"A": "T", "T": "A", "G": "C", "C": "G"}
 
-    def __init__(self, name, k, input_queue, results_queue):
+    # one row per counted kmer; columns match the Locations table
+    LOCATION_DTYPE = np.dtype([("genome", np.int64), ("contig", np.int64), ("start", np.int64), ("strand", np.int8), ("kmer", np.uint64)])
+
+    def __init__(self, name, k, input_queue, results_queue, pool=None):
         super().__init__()
         self.name = name
         self.k = k
         self.input_queue = input_queue
         self.results_queue = results_queue
 
-        self.kmers = {}
+        # optional SharedArrayPool to pass locations back through shared memory
+        self.pool = pool
+
+        if k > 32:
+            raise ValueError("k must be <= 32 to fit kmer ids in 64 bits.")
+
+        # location arrays for each counted segment
         self.locations = []
 
     @classmethod
@@ -1519,43 +1879,142 @@ class KCounter(multiprocessing.Process):
             else:
                 print("Not tuple!")
 
+    @staticmethod
+    def encode_kmers(seq, k):
+        """ Returns arrays (positions, ids, reverse complement ids) for each kmer in seq that has only ACGT (see mypyli.kmers.encode_kmers) """
+        return encode_kmers(seq, k)
+
+    @staticmethod
+    def decode_kmers(kmer_ids, k):
+        """ Returns a list of kmer strings for an array of kmer ids """
+        shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+        codes = (np.asarray(kmer_ids, dtype=np.uint64)[:, None] >> shifts) & np.uint64(3)
+
+        letters = np.frombuffer(b"ACGT", dtype=np.uint8)[codes.astype(np.intp)]
+        return [kmer.decode() for kmer in np.ascontiguousarray(letters).view("S{}".format(k)).ravel()]
+
     def count_kmers(self, genome, contig, start, seq):
-        for indx in range(len(seq)+1 - self.k):
-            #kmers_counted += 1
-            kmer = seq[indx:indx+self.k]
+        positions, kmer_ids, rc_ids = self.encode_kmers(seq, self.k)
 
-            # check if there is an N in the kmer and discard it if so
-            if "N" in kmer:
-                continue
-               
-            # choose the < of the kmer and its RC
-            canonical = sorted((kmer, self._reverse_complement(kmer)))[0]
-        
-            # set strand based on whether or not rc was used
-            if canonical == kmer:
-                strand = "1"
-            else:
-                strand = "-1"
+        locations = np.empty(len(positions), dtype=self.LOCATION_DTYPE)
+        locations["genome"] = genome
+        locations["contig"] = contig
+        locations["start"] = start + positions
+        # strand is 1 if the kmer is <= its reverse complement (A < C < G < T so ids sort like the strings)
+        locations["strand"] = np.where(kmer_ids <= rc_ids, 1, -1)
+        locations["kmer"] = kmer_ids
 
-            kmer_id = self._kmer_to_id(kmer)
-            # add the location and the kmer 
-            self.locations.append((genome, contig, start+indx, strand, kmer_id))
-            self.kmers[kmer_id] = kmer
-        return
+        self.locations.append(locations)
 
     def dump_kmers_and_locations(self):
-        """ Dumps the kmers and locations to the output queue and clears the variables from memory """
-        # convert to kmer dict to a list of tuples
-        kmer_dump = [(k, v) for k, v in self.kmers.items()]
-
-        self.results_queue.put((kmer_dump, self.locations))
+        """ 
+        Dumps the locations (LOCATION_DTYPE array) to the output queue and clears them from memory 
+        
+        Kmers are only stored as ids in the locations (names are decoded with decode_kmers when needed).
+        """
+        locations = np.concatenate(self.locations) if self.locations else np.empty(0, dtype=self.LOCATION_DTYPE)
+        self.results_queue.put(self.pool.pack(locations) if self.pool else locations)
 
         # reset the variables
         self.locations = []
-        self.kmers = {}
        
 
-def lazy_imap(processes, function, iterable):
+class SharedArrayPool(object):
+    """
+    Passes numpy arrays from worker processes back to the main process through shared memory.
+
+    Pickling big arrays through a multiprocessing.Queue copies them through a pipe, so the main process
+    can spend more time unpickling than the workers spend computing. Instead, a worker packs a result 
+    (an array or a tuple of arrays) into one of a fixed number of shared memory blocks and only puts the
+    small handle from pack() on the queue. The main process copies the arrays out with unpack(), which
+    returns the block to the pool.
+
+    Workers wait for a free block before packing, so the pool bounds the results in flight like a bounded queue.
+    Results bigger than block_size get a one-off block. If /dev/shm doesn't have room for the pool, handles
+    just carry the arrays (the same as putting them on the queue).
+
+    Blocks are made before the workers are started and are inherited when they fork.
+    """
+
+    ALIGN = 64
+
+    def __init__(self, num_blocks, block_size):
+        self.block_size = int(block_size)
+        self.blocks = []
+        self.free = multiprocessing.Queue()
+
+        shm_dir = "/dev/shm"
+        if os.path.isdir(shm_dir) and shutil.disk_usage(shm_dir).free < num_blocks * self.block_size:
+            LOG.warning("Not enough space in {} for {} shared memory blocks of {} bytes. Results will be pickled instead.".format(shm_dir, num_blocks, self.block_size))
+            return
+
+        for indx in range(num_blocks):
+            self.blocks.append(shared_memory.SharedMemory(create=True, size=self.block_size))
+            self.free.put(indx)
+
+    @classmethod
+    def _layout(cls, arrays):
+        """ Returns the (dtype, shape, offset) of each array packed end to end and the total size """
+        layout = []
+        offset = 0
+        for array in arrays:
+            layout.append((array.dtype, array.shape, offset))
+            offset += -(-array.nbytes // cls.ALIGN) * cls.ALIGN
+        return layout, offset
+
+    def pack(self, result):
+        """ Copies an array or tuple of arrays into a shared block and returns a handle to put on a queue """
+        if not self.blocks:
+            return ("inline", result)
+
+        is_tuple = isinstance(result, tuple)
+        arrays = [np.ascontiguousarray(array) for array in (result if is_tuple else (result,))]
+        layout, size = self._layout(arrays)
+
+        if size > self.block_size:
+            LOG.debug("Result of {} bytes is bigger than a shared block. Using a one off block.".format(size))
+            indx = None
+            block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        else:
+            indx = self.free.get()
+            block = self.blocks[indx]
+
+        for array, (dtype, shape, offset) in zip(arrays, layout):
+            np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)[...] = array
+
+        handle = ("shm", indx, block.name, layout, is_tuple)
+        if indx is None:
+            block.close()
+
+        return handle
+
+    def unpack(self, handle):
+        """ Returns a copy of the result in a handle from pack and frees its block """
+        if handle[0] == "inline":
+            return handle[1]
+
+        _, indx, name, layout, is_tuple = handle
+        block = self.blocks[indx] if indx is not None else shared_memory.SharedMemory(name=name)
+
+        arrays = tuple(np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset).copy() for dtype, shape, offset in layout)
+
+        if indx is None:
+            block.close()
+            block.unlink()
+        else:
+            self.free.put(indx)
+
+        return arrays if is_tuple else arrays[0]
+
+    def close(self):
+        """ Releases all the blocks (call from the main process once the workers are done) """
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def lazy_imap(processes, function, iterable, block_size=None):
     """ 
      Analog of pool.imap that behaves lazily to save memory 
     
@@ -1571,18 +2030,51 @@ def lazy_imap(processes, function, iterable):
     If the workers move faster than the main thread, they will be mostly blocked waiting for an open slot in the results queue. 
 
     If the main thread works faster than the workers, it will be mostly blocked waiting for a result to appear.
+
+    If block_size is given, function must return an array or tuple of arrays (each result at most block_size bytes
+    to avoid one off blocks) and results are passed back through a SharedArrayPool with a block for each result
+    that can be in the results queue or in progress.
     """
 
     input_queue = multiprocessing.Queue()
     results_queue = multiprocessing.Queue(processes)
+    pool = SharedArrayPool(processes * 2, block_size) if block_size else None
 
     # spawn workers
     workers = []
     for indx in range(processes):
-        worker = ImapWorker("ImapWorker{}".format(indx), input_queue, results_queue, function)
+        worker = ImapWorker("ImapWorker{}".format(indx), input_queue, results_queue, function, pool)
         worker.start()
         workers.append(worker)
 
+    finished = False
+    try:
+        for result in _lazy_imap_results(processes, iterable, input_queue, results_queue):
+            yield pool.unpack(result) if pool else result
+        finished = True
+    finally:
+        if finished:
+            for _ in workers:
+                input_queue.put("STOP")
+
+            for worker in workers:
+                LOG.debug("Waiting for {} to join...".format(worker.name))
+                worker.join()
+        else:
+            # the consumer raised or stopped early; workers may be blocked on the queues so they are killed
+            for worker in workers:
+                worker.terminate()
+
+            for worker in workers:
+                worker.join()
+
+        # blocks are only unlinked once no worker can touch them
+        if pool:
+            pool.close()
+
+def _lazy_imap_results(processes, iterable, input_queue, results_queue):
+    """ Feeds the input queue of lazy_imap and yields raw results as they come in """
+
     # ensure the input type is an iterable 
     batch_iter = iter(iterable)
 
@@ -1612,23 +2104,17 @@ def lazy_imap(processes, function, iterable):
         yield results_queue.get()
         batches_in_progress -= 1
 
-    for _ in workers:
-        input_queue.put("STOP")
-
-    for worker in workers:
-        LOG.debug("Waiting for {} to join...".format(worker.name))
-        worker.join()
-
 class ImapWorker(multiprocessing.Process):
     """ A worker for the lazy_imap function """
     
-    def __init__(self, name, input_queue, results_queue, function):
+    def __init__(self, name, input_queue, results_queue, function, pool=None):
         super().__init__()
 
         self.name = name
         self.input_queue = input_queue
         self.results_queue = results_queue
         self.function = function
+        self.pool = pool
 
     def run(self):
         LOG.debug("Starting process {}".format(self.name)) 
@@ -1637,53 +2123,95 @@ class ImapWorker(multiprocessing.Process):
             # pull an item off the input queue
             itm = self.input_queue.get()
 
-            # check for poison pill
-            if itm == "STOP":
+            # check for poison pill (items may be numpy arrays so check the type first)
+            if isinstance(itm, str) and itm == "STOP":
                 LOG.debug("Returning from {}".format(self.name))
                 return
             else:
-                # run some function on the item and put the result in the results queue
+                # run some function on the item and put the result (or its shared memory handle) in the results queue
                 result = self.function(itm)
-                self.results_queue.put(result)
-
+                self.results_queue.put(self.pool.pack(result) if self.pool else result)
 
 
+def subcommand_main(args):
+    main_db = MainDatabase(args.db, args.k, args.threads, args.mismatches, args.stable, bulk=args.bulk)  
 
-def get_memory_usage(verbose=False):
-    """ Returns the memory usage of this process and all children """
-    # check memory usage
-    main = psutil.Process(os.getpid())
+    main_db.count_kmers(args.fastas, recalculate=args.force)
 
-    total_mem = main.get_memory_info()[0] / 2 ** 30
-    if verbose:
-        LOG.debug("Main mem = {}".format(total_mem))
-    for child in main.get_children():
-        total_mem += child.get_memory_info()[0] / 2 ** 30
-        if verbose:
-            LOG.debug("    Thread usage {}".format(child.get_memory_info()[0] / 2 ** 30))
+    if args.fuzzy:
+        main_db.generate_fuzzy_kmers(recalculate=args.force)
 
-    return total_mem
+    main_db.dbc.close()
 
+def subcommand_benchmark(args):
+    """ Fuzzifies a copy of the main database with and without bulk mode and reports rows/s for each """
+    params = MainDatabase.open_database(args.db)
+    k = int(params.execute("SELECT value FROM Params WHERE key = 'k'").fetchone()[0])
+    params.close()
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(args.db))) as tmp_dir:
+        for bulk in [False, True]:
+            copy_f = os.path.join(tmp_dir, "{}.db".format("bulk" if bulk else "default"))
+            shutil.copy(args.db, copy_f)
+            os.symlink(os.path.abspath(args.db + ".kmers"), copy_f + ".kmers")
+
+            main_db = MainDatabase(copy_f, k, args.threads, int(args.mismatches), int(args.stable), bulk=bulk)
+            if not bulk:
+                main_db.dbc.execute("PRAGMA journal_mode = DELETE")
+            main_db.dbc.execute("DROP TABLE FuzzyKmers")
+            main_db.dbc.execute("DROP TABLE KmerToFuzzy")
+            main_db.dbc.execute("DELETE FROM Params WHERE key = 'fuzzy_epoch'")
+            main_db._make_fuzzy_tables()
+            main_db.dbc.commit()
+
+            start = time.time()
+            main_db.generate_fuzzy_kmers(recalculate=True)
+            elapsed = time.time() - start
+
+            rows = sum(main_db.dbc.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0] for table in ["FuzzyKmers", "KmerToFuzzy"])
+            main_db.dbc.close()
+
+            print("{} mode: {} rows in {:.2f}s ({:.0f} rows/s)".format("bulk" if bulk else "default", rows, elapsed, rows / elapsed), file=sys.stderr)
+
+def subcommand_extend(args):
+    run_handler = DatabaseRun(args.db, args.output_dir, args.prefix, args.threads) 
 
-def main_database(fastas, k, threads=8):
-    counter = KmerCounterSQL("kmer_db", k, threads)
+    if not os.path.exists(run_handler.run_database_f):
+        raise ValueError("Run database {} does not exist. Use the run command to make it.".format(run_handler.run_database_f))
 
-    #counter.count_kmers(fastas)
-    #counter.generate_fuzzy_kmers()
-    counter.find_conserved_kmers(fuzzy=False)
-    #counter.find_potential_amplicons()
-    counter.get_amplicon_stats()
+    run_handler.add_genomes(args.genomes)
 
-def subcommand_main(args):
-    main_db = MainDatabase(args.db, args.k, args.threads, args.mismatches, args.stable)  
+    run_handler.dbc.close()
 
-    main_db.count_kmers(args.fastas, recalculate=args.force)
+def subcommand_check(args):
+    if not os.path.isfile(args.db):
+        raise ValueError("Main database {} does not exist.".format(args.db))
 
-    if args.fuzzy:
-        main_db.generate_fuzzy_kmers(recalculate=args.force)
+    params = MainDatabase.open_database(args.db)
+    k, mismatches, stable_bp = [params.execute("SELECT value FROM Params WHERE key = ?", (key,)).fetchone()[0] for key in ("k", "mismatches", "stable_bp")]
+    params.close()
 
+    main_db = MainDatabase(args.db, int(k), args.threads, int(mismatches), int(stable_bp))
+    problems = main_db.check_consistency()
     main_db.dbc.close()
 
+    if args.prefix:
+        run_handler = DatabaseRun(args.db, args.output_dir, args.prefix, args.threads)
+        if os.path.exists(run_handler.run_database_f):
+            run_handler.dbc.execute("ATTACH ? AS run_specific", (run_handler.run_database_f,))
+            problems += run_handler.check_consistency()
+        else:
+            problems.append("Run database {} does not exist.".format(run_handler.run_database_f))
+        run_handler.dbc.close()
+
+    for problem in problems:
+        LOG.error(problem)
+
+    if problems:
+        sys.exit(1)
+    else:
+        LOG.info("Database is consistent.")
+
 def subcommand_run(args):
     run_handler = DatabaseRun(args.db, args.output_dir, args.prefix, args.threads) 
 
@@ -1702,6 +2230,8 @@ if __name__ == "__main__":
     parser.add_argument("-fuzzy", help="use fuzzy tables with a particular number of mismatches (default is to not use fuzzy kmers because this is much faster", action="store_true")
     parser.add_argument("-mismatches", help="number of mismatches to allow in fuzzy kmers [%(default)s]", default=1)
     parser.add_argument("-stable", help="number of bp at each end to not allow to be fuzzy [%(default)s]", default=2)
+    parser.add_argument("-profile", help="write stage timers, counters, and sampled memory usage to this file at exit (.csv for CSV, otherwise JSON)")
+    parser.add_argument("-profile_interval", help="seconds between memory samples when profiling [%(default)s]", default=1.0, type=float)
 
     subparsers = parser.add_subparsers()
 
@@ -1709,6 +2239,10 @@ if __name__ == "__main__":
     parser_main.set_defaults(func=subcommand_main)
     parser_main.add_argument("-fastas", help="a bunch of fastas to compare", nargs="+", required=True)
     parser_main.add_argument("-k", help="value of k to use", required=True, type=int)
+    parser_main.add_argument("-bulk", help="bulk load mode: WAL journal, large cache/mmap, and the fuzzy kmer link index built after loading", action="store_true")
+
+    parser_benchmark = subparsers.add_parser("benchmark", help="time fuzzy kmer loading (rows/s) with and without -bulk on a copy of the database")
+    parser_benchmark.set_defaults(func=subcommand_benchmark)
 
 
     parser_run = subparsers.add_parser("run")
@@ -1719,5 +2253,20 @@ if __name__ == "__main__":
     parser_run.add_argument("-amp_frac_genomes", help="minimum fraction of genomes required to be a good amplicon [%(default)s]", default=1)
     parser_run.add_argument("-amp_min_len", help="heuristic minimum amplicon length to narrow results [%(default)s]", default=100)
     parser_run.add_argument("-amp_max_len", help="maximum amplicon length [%(default)s]", default=400)
+
+    parser_extend = subparsers.add_parser("extend", help="add genomes to an existing run without recalculating it")
+    parser_extend.set_defaults(func=subcommand_extend)
+    parser_extend.add_argument("-output_dir", help="the directory with the run [%(default)s]", default=os.getcwd())
+    parser_extend.add_argument("-prefix", help="prefix of the run to extend [%(default)s]", default="run")
+    parser_extend.add_argument("-genomes", help="genome names from the main table to add to the run", nargs='+', required=True)
+
+    parser_check = subparsers.add_parser("check", help="check that the main database (and optionally a run) is consistent")
+    parser_check.set_defaults(func=subcommand_check)
+    parser_check.add_argument("-output_dir", help="the directory with the run [%(default)s]", default=os.getcwd())
+    parser_check.add_argument("-prefix", help="prefix of a run to check as well")
     args = parser.parse_args()
+
+    if args.profile:
+        PROFILER.enable(args.profile, args.profile_interval)
+
     args.func(args)
@@ -64,14 +64,15 @@ class QueryMapper(object):
         # parse each hit in the SAM file
         alns_found = 0
         quality_alns = 0
-        for record in self.parse_SAM_file(sam_f):
-            alns_found += 1
-            if record.mapped and record.perc_id >= self.min_id:
-                qry_region = GenomeRegion.from_header(record.qname)
-    
-                if record.length >= self.min_len:
-                    self.regions[qry_region.index].report_hit(r_basename, record.rname, record.pos, record.length, record.perc_id)
-                    quality_alns += 1
+        for batch in self.parse_SAM_batches(sam_f):
+            alns_found += len(batch)
+
+            # drop unmapped, short and low identity hits as whole arrays
+            batch = batch.filter(batch.mapped & (batch.length >= self.min_len) & (batch.perc_id >= self.min_id))
+            for qname, rname, pos, length, perc_id in zip(batch.qname, batch.rname, batch.pos.tolist(), batch.length.tolist(), batch.perc_id.tolist()):
+                qry_region = GenomeRegion.from_header(qname)
+                self.regions[qry_region.index].report_hit(r_basename, rname, pos, length, perc_id)
+                quality_alns += 1
 
         LOG.info("{}({} quality) hits among {} splits found in {}".format(alns_found, quality_alns, len(self.regions), r_basename))
 
@@ -229,6 +230,13 @@ class QueryMapper(object):
             for record in samparser.parse(IN, mapq=0, aligned_only=True, local=True):
                 yield record
 
+    @staticmethod
+    def parse_SAM_batches(sam_f):
+        """ Yields SamBatches (column arrays) that meet the same minimum criteria as parse_SAM_file """
+        with open(sam_f, 'r') as IN:
+            for batch in samparser.parse_batches(IN, mapq=0, aligned_only=True, local=True):
+                yield batch
+
 
 class AmpliconAligner(object):
 
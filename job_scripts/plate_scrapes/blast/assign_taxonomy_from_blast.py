@@ -194,7 +194,8 @@ def main(blast_f, tree, checkm_f=None):
     
         taxid_assign = assign_tax_ids(tree, taxid_counts)
 
-        taxstr_counts = {taxid_assign[taxid].get_tax_string(): taxid_counts[taxid] for taxid in taxid_assign}
+        taxids = list(taxid_assign)
+        taxstr_counts = {taxstr: taxid_counts[taxid] for taxid, taxstr in zip(taxids, tree.get_tax_strings(taxids))}
 
         taxonomy = get_best_taxonomy(taxstr_counts, class_perc=.80)
 
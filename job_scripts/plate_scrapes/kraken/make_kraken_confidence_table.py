@@ -1,4 +1,3 @@
-
 # AUTHOR: Hunter Cameron
 # DATE: 1/8/2015
 # DESCRIPTION: Makes a table with kraken's assignment, confidence score, and contig length
@@ -7,34 +6,56 @@
 
 
 
-from mypyli.kraken import KrakenIO
+from mypyli.kraken import write_confidence_table
 from mypyli import taxtree
 import argparse 
+import os
+import sys
+import time
+import filecmp
 
-def create_table(kraken_f, out_f, tree):
-    KrakenIO.set_tree(tree)
-
+def create_table(kraken_f, out_f, tree, workers=1):
+    """ Writes the table and returns the number of reads. tree can be a TaxTree or a path to one. """
     with open(kraken_f, 'r') as IN, open(out_f, 'w') as OUT:
 
         OUT.write("\t".join(["contig", "length", "taxonomy", "confidence"]) + "\n")
-        for record in KrakenIO.parse(IN):
-            if record.classified:
-                tax = tree.lookup_taxid(record.taxid).get_tax_string()
-                conf = record.get_kraken_confidence()
-            else:
-                tax = "unclassified"
-                conf = "0/0"
-
-            OUT.write("\t".join([record.name, str(record.length), tax, str(conf)]) + "\n")
+        return write_confidence_table(IN, OUT, tree, workers=workers)
+
+def benchmark(kraken_f, out_f, tree_f, worker_counts):
+    """ Makes the table with each number of workers, reports reads/s and checks that the tables are identical """
+    first = None
+    for workers in worker_counts:
+        bench_f = "{}.{}_workers".format(out_f, workers)
+
+        start = time.time()
+        reads = create_table(kraken_f, bench_f, tree_f, workers)
+        elapsed = time.time() - start
+
+        print("{} workers: {} reads in {:.2f}s ({:.0f} reads/s)".format(workers, reads, elapsed, reads / elapsed), file=sys.stderr)
+
+        if first is None:
+            first = bench_f
+        else:
+            if not filecmp.cmp(first, bench_f, shallow=False):
+                raise AssertionError("Table made with {} workers differs from {}.".format(workers, first))
+            os.remove(bench_f)
+
+    os.rename(first, out_f)
             
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Makes a table with kraken's assignment, confidence score and contig length")
     parser.add_argument("-k", "--kraken", help="kraken output file", required=True)
     parser.add_argument("-o", "--out", help="name for output table", default="kraken_conf_table.txt")
-    parser.add_argument("-t", "--taxtree", help="taxtree pickle file to load", required=True)
+    parser.add_argument("-t", "--taxtree", help="taxtree pickle file to load (a binary tree is shared by all the workers)", required=True)
+    parser.add_argument("-w", "--workers", help="number of processes to use", type=int, default=1)
+    parser.add_argument("-benchmark", help="comma separated worker counts to time (Ex: 1,8,32)")
 
     args = parser.parse_args()
 
-    tree = taxtree.TaxTree.load_tree(args.taxtree)
-    create_table(args.kraken, args.out, tree)
+    if args.benchmark:
+        benchmark(args.kraken, args.out, args.taxtree, [int(w) for w in args.benchmark.split(",")])
+    else:
+        # workers load the tree themselves from the path
+        tree = args.taxtree if args.workers > 1 else taxtree.TaxTree.load_tree(args.taxtree)
+        create_table(args.kraken, args.out, tree, args.workers)
@@ -5,6 +5,7 @@ from mypyli import samparser, kraken, taxstring
 import argparse
 import pickle
 import sys
+import numpy as np
 
 def get_tax_assignments(kraken_f):
     """
@@ -14,16 +15,19 @@ def get_tax_assignments(kraken_f):
     """
     
     tax_dict = {}
-    for krakenr in kraken.KrakenRecord.parse_kraken_file(kraken_f, iterate=True):
-        #print(str(krakenr.classified))
-        if tax_dict.get(krakenr.name, 0):
-            if tax_dict[krakenr.name] != "unclassified":
-                continue
+    with open(kraken_f, 'r') as IN:
+        for batch in kraken.KrakenIO.parse_batches(IN):
+            classified = batch.filter(batch.classified)
+
+            # first classified hit for each name in the batch
+            names, first = np.unique(classified.name, return_index=True)
+            for name, taxid in zip(names, classified.taxid[first]):
+                if tax_dict.get(name, "unclassified") == "unclassified":
+                    tax_dict[name] = str(taxid)
+
+            for name in batch.name[~batch.classified]:
+                tax_dict.setdefault(name, "unclassified")
 
-        if krakenr.classified:
-            tax_dict[krakenr.name] = krakenr.tax_id
-        else:
-            tax_dict[krakenr.name] = "unclassified"
     return tax_dict
 
 def get_read_alignments(sam_f):
@@ -74,10 +78,12 @@ def link_contigs_with_tax(contig_dict, tax_dict):
 
     return linked_dict
 
-def lookup_tax_by_id(linked_dict):
+def lookup_tax_by_id(linked_dict, resolver=None):
     """
     Looks up a tax ids found in a dict of structure: linked_dict = {contig: {taxid: count}}
     Returns a dict = taxid: taxonomy
+
+    With a taxstring.TaxResolver the ids are looked up in a local TaxTree (Entrez is only a fallback).
     """
 
     #tax_ids = {k: 0 for k in [taxa for taxa in linked_dict.values()]}
@@ -93,7 +99,7 @@ def lookup_tax_by_id(linked_dict):
             tax_ids[taxid] = "unclassified"
         else:
             print(taxid)
-            taxstr = taxstring.TaxString(tax=taxid, is_id=True, lookup=True)
+            taxstr = taxstring.TaxString(tax=taxid, is_id=True, lookup=True, resolver=resolver)
             tax_ids[taxid] = taxstr.get_tax_string()
      #       if tax_values.get(taxstr.get_tax_string(), 0):
       #          print(("Same", tax_values[taxstr.get_tax_string()], taxid))
@@ -145,8 +151,11 @@ if __name__ == "__main__":
     parser.add_argument("-kraken", help="output file from kraken")
     parser.add_argument("-sam", help="sam file from aligning the reads to the contigs")
     parser.add_argument("-out", help="the output path for the pickled data structure", default="kraken2contig_pickle.txt")
-    parser.add_argument("-mode", help="the mode in which to run. The translate option requires the ability to conect to the NCBI servers (i.e. may not work with bsub).", required=True, choices=["link", "print", "both"], default="link")
+    parser.add_argument("-mode", help="the mode in which to run. The print option requires the ability to conect to the NCBI servers (i.e. may not work with bsub) unless -tree is given.", required=True, choices=["link", "print", "both"], default="link")
     parser.add_argument("-k2c", help="the kraken to contig pickle file")
+    parser.add_argument("-tree", help="TaxTree (pickle or binary) to look up taxids in offline")
+    parser.add_argument("-tax_cache", help="sqlite file to cache Entrez lookups in (for taxids not in the tree)", default="entrez_cache.sqlite")
+    parser.add_argument("-offline", help="never use Entrez; taxids must be in the tree or cache", action="store_true")
     args = parser.parse_args()
 
     # determine the mode and check for required arguments
@@ -181,5 +190,7 @@ if __name__ == "__main__":
                 linked_dict = pickle.load(open(args.k2c, 'rb'))
 
 
-        tax_ids = lookup_tax_by_id(linked_dict)
+        resolver = taxstring.TaxResolver(tree=args.tree, cache_db=args.tax_cache, entrez=not args.offline)
+
+        tax_ids = lookup_tax_by_id(linked_dict, resolver)
         print_kraken_otu_table(linked_dict, tax_ids)
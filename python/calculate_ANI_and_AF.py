@@ -3,11 +3,12 @@ import sys
 import argparse
 import logging
 import os
+import time
 from Bio import SeqIO 
-from Bio.SeqRecord import SeqRecord
 import subprocess
+import numpy as np
 
-from mypyli import samparser, parallelizer
+from mypyli import samparser, parallelizer, minhash
 
 logging.basicConfig()
 LOG = logging.getLogger()
@@ -16,6 +17,9 @@ LOG.setLevel("INFO")
 
 class QueryMapper(object):
 
+    # one row per split of the query; saved next to the split fasta and memory mapped when the splits are loaded
+    SPLIT_DTYPE = np.dtype([("index", np.int64), ("length", np.int64), ("contig", np.int64), ("offset", np.int64)])
+
     def __init__(self, query_f, out_dir=None, split_len=1000, min_id=.70, min_cov=.70):
         self.query_f = query_f
         self.q_basename = os.path.splitext(os.path.basename(query_f))[0]
@@ -38,7 +42,11 @@ class QueryMapper(object):
 
    
         self.split_f = self.out_dir + self.q_basename + ".split.fasta"
-        self.aligns = None
+        self.split_index_f = split_index_path(self.split_f)
+        self.splits = None
+
+        # alignment state of the splits against one reference at a time
+        self.accumulator = None
 
 
         self.parallel_id = None
@@ -48,22 +56,42 @@ class QueryMapper(object):
 
     def _setup(self):
         """ Sets up for processing by either splitting the query or loading the splits from a previous run"""
-        # either split the query or set the list from the last time to None
         if os.path.isfile(self.split_f):
-            self.aligns = []
             self._load_splits()
         else:
-            self.aligns = []
             self._split_query()
 
+        self.accumulator = AniAfAccumulator(self.splits["length"], self.min_id, self.min_cov)
+
     def _load_splits(self):
-        """ Loads splits from a previous run """
+        """ Loads splits from a previous run (the split index is made from the split fasta headers if it is missing) """
         LOG.info("Found existing split file. Loading that...")
-        with open(self.split_f, 'r') as IN:
-            for record in SeqIO.parse(IN, "fasta"):
-                split_data = record.description.split("_", 1)[0]
-                index, length = split_data.split("-len")
-                self.aligns.append(Alignment(int(index), int(length)))
+        if not os.path.isfile(self.split_index_f):
+            contigs = {}
+            splits = []
+            offset = 0
+            with open(self.split_f, 'r') as IN:
+                for line in IN:
+                    if line.startswith(">"):
+                        split_data, contig = line[1:].rstrip("\n").split("_", 1)
+                        index, length = split_data.split("-len")
+
+                        if contig not in contigs:
+                            contigs[contig] = len(contigs)
+                            offset = 0
+
+                        splits.append((int(index), int(length), contigs[contig], offset))
+                        offset += int(length)
+
+            self._save_split_index(np.array(splits, dtype=self.SPLIT_DTYPE))
+
+        self.splits = np.load(self.split_index_f, mmap_mode="r")
+
+    def _save_split_index(self, splits):
+        """ Writes the split index atomically """
+        tmp = self.split_index_f + ".tmp.npy"
+        np.save(tmp, splits)
+        os.rename(tmp, self.split_index_f)
 
     def _split_query(self):
         """ 
@@ -72,16 +100,19 @@ class QueryMapper(object):
         TODO: Add a small algorithm to calculate the actual split_len based on the
         length of the contig to get it as close as possible to the supplied split_len
 
-        Returns the total length of the sequences.
+        The split fasta is written under a temporary name and renamed when it is complete.
         """
 
         LOG.info("Splitting {} into pieces ~{}bp long.\nStoring as {}".format(self.query_f, self.split_len, self.split_f))
 
-        split_number = 0 
-        with open(self.query_f, 'r') as IN, open(self.split_f, 'w') as OUT:
+        splits = []
+
+        # only contigs that make splits are numbered, the same as when the index is made from the split headers
+        contig_number = 0
+        with open(self.query_f, 'r') as IN, open(self.split_f + ".tmp", 'w') as OUT:
             for seq_obj in SeqIO.parse(IN, 'fasta'):
                 header = seq_obj.id
-                seq = seq_obj.seq
+                seq = str(seq_obj.seq)
                 seq_len = len(seq)
             
                 if seq_len < self.split_len:
@@ -110,19 +141,19 @@ class QueryMapper(object):
                     # calc the actual length of the seq
                     sp_seq_len = len(sp_seq)
 
-                    # write a new header
-                    sp_header = str(split_number) + "-len{}".format(sp_seq_len) + "_" + header
-                    
-                    # write the seq
-                    sp_seq_obj = SeqRecord(sp_seq, id=sp_header, description='')
-                    SeqIO.write(sp_seq_obj, OUT, 'fasta')
-                    
-                    # make an alignment object
-                    self.aligns.append(Alignment(split_number, sp_seq_len))
-
-                    split_number += 1
+                    # write the seq with the split index and length prepended to the header
+                    OUT.write(">{}-len{}_{}\n{}\n".format(len(splits), sp_seq_len, header, sp_seq))
+
+                    splits.append((len(splits), sp_seq_len, contig_number, seq_indx))
                     seq_indx += split_len
 
+                contig_number += 1
+
+        self._save_split_index(np.array(splits, dtype=self.SPLIT_DTYPE))
+        os.rename(self.split_f + ".tmp", self.split_f)
+
+        self.splits = np.load(self.split_index_f, mmap_mode="r")
+
     def map_to_references(self, references, p_launcher=None, cpus=8):
         """ Maps the query to all references, optionally with the use of a parallelizer. """
         
@@ -151,94 +182,457 @@ class QueryMapper(object):
         af_per_ref = {}
         if self.mapped_files:
             for ref, mapped_file in self.mapped_files.items():
-
-                self.parse_SAM_file(mapped_file)
-
-                # calculate gANI and AF
-                total_length = 0
-                aln_total_length = 0
-                aln_aln_length = 0
-                id_x_aln_length = 0
-                num_aligned = 0
-                for aln in self.aligns:
-                    total_length += aln.length
-
-                    # add up all alignments
-                    if aln.aligned:
-                        num_aligned += 1
-                        aln_total_length += aln.length
-                        aln_aln_length += aln.aln_len
-                        id_x_aln_length += aln.aln_id * aln.aln_len
-
-                try:
-                    # the id is always divided by total length; not aligned length
-                    gANI = id_x_aln_length / aln_total_length
-                except ZeroDivisionError:
-                    gANI = 0
-
-                try:
-                    # AF is scaled to length, not number of fragments
-                    AF = aln_total_length / total_length
-                except ZeroDivisionError:
-                    AF = 0
-
-                # store the result in the dict
-                ani_per_ref[ref] = gANI
-                af_per_ref[ref] = AF
-
-                # write some output stats if in debug mode
-                LOG.debug("For '{}' by '{}':".format(self.q_basename, ref))
-                LOG.debug("\t{} of {} aligned.".format(num_aligned, len(self.aligns))) 
-                LOG.debug("\t{} of {} length aligned.".format(aln_total_length, total_length))
-                LOG.debug("\tANI={}\tAF={}\n".format(gANI, AF))
+                ani_per_ref[ref], af_per_ref[ref] = self.calculate_ani_and_af(mapped_file, ref)
 
         return ani_per_ref, af_per_ref
 
-    def parse_SAM_file(self, sam_f):
-        """ Finds the hits in SAM file and sets the aligns to found as appropriate"""
+    def calculate_ani_and_af(self, sam_f, ref=""):
+        """ Returns (gANI, AF) of the query against the reference it was mapped to in a SAM file """
+
+        self.parse_SAM_file(sam_f)
+        gANI, AF = self.accumulator.ani_and_af()
 
-        # reset all the aligns 
-        for aln in self.aligns:
-            aln.reset()
+        # write some output stats if in debug mode
+        LOG.debug("For '{}' by '{}':".format(self.q_basename, ref))
+        LOG.debug("\t{} of {} aligned.".format(self.accumulator.num_aligned(), len(self.splits))) 
+        LOG.debug("\tANI={}\tAF={}\n".format(gANI, AF))
+
+        return gANI, AF
+
+    def parse_SAM_file(self, sam_f):
+        """ Resets the alignment state and fills it with the best hit of each split in a SAM file """
+        self.accumulator.reset()
 
         with open(sam_f, 'r') as IN:
-            for record in samparser.parse(IN, mapq=1, aligned_only=True):
-                if record.mapped and record.perc_id >= self.min_id:
-                    split_number, length = record.qname.split("_", 1)[0].split("-")
-                    split_number = int(split_number)
-                    if (record.length / self.aligns[split_number].length) >= self.min_cov:
-                        self.aligns[split_number].report_found(record.perc_id, record.length)
+            self.accumulator.add_sam(IN)
   
 
-class Alignment(object):
-    """ Class used to record the splits of a query and if they align to a reference. """
+class AniAfAccumulator(object):
+    """ 
+    Keeps the best hit of each query fragment in arrays indexed by split number and calculates gANI and AF from them.
+
+    Hits are added a SamBatch at a time so a SAM stream (Ex: a mapper's stdout) never has to be written to disk. A hit
+    counts if it is at least min_id identical and covers at least min_cov of its fragment; the best hit of a fragment 
+    is the one with the most identical bases (identity x aligned length).
+    """
 
-    def __init__(self, index, length):
-        self.index = index
-        self.length = length
+    def __init__(self, lengths, min_id=.70, min_cov=.70):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.min_id = min_id
+        self.min_cov = min_cov
 
-        self.aligned = False
-        self.aln_len = 0
-        self.aln_id = 0
+        self.aligned = np.zeros(len(self.lengths), dtype=bool)
+        self.aln_id = np.zeros(len(self.lengths), dtype=np.float64)
+        self.aln_len = np.zeros(len(self.lengths), dtype=np.int64)
 
-    def __str__(self):
-        if self.aligned:
-            return "{}; len={}; aligned; aln_id={}; aln_len={}".format(self.index, self.length, self.aln_id, self.aln_len)
-        else:
-            return "{}; len={}; unaligned".format(self.index, self.length)
+    @classmethod
+    def from_split_file(cls, split_f, min_id=.70, min_cov=.70):
+        """ 
+        Makes an accumulator for the fragments of a split file. Lengths come from the split index if there is one, 
+        otherwise from the headers ('<split number>-len<length>_<contig>').
+        """
+        if os.path.isfile(split_index_path(split_f)):
+            return cls(np.load(split_index_path(split_f), mmap_mode="r")["length"], min_id, min_cov)
+
+        lengths = []
+        with open(split_f, 'r') as IN:
+            for line in IN:
+                if line.startswith(">"):
+                    lengths.append(int(line[1:].split("_", 1)[0].split("-len")[1]))
 
-    def report_found(self, aln_id, aln_len):
-        """ Sets the alignment to a found state"""
-        self.aligned = True
-        self.aln_id = aln_id
-        self.aln_len = aln_len
+        return cls(lengths, min_id, min_cov)
 
     def reset(self):
-        """ Resets the alignment to an unfound state """
-        self.aligned = False
-        self.aln_id = 0
-        self.aln_len = 0
+        """ Clears all the hits (by assignment so the arrays are reused across references) """
+        self.aligned[:] = False
+        self.aln_id[:] = 0
+        self.aln_len[:] = 0
+
+    def add_batch(self, batch):
+        """ Updates the best hits with the mapped records of a SamBatch """
+        perc_id = batch.perc_id
+        keep = batch.mapped & (perc_id >= self.min_id)
+        if not keep.any():
+            return
+
+        split_numbers = np.fromiter((int(qname.split("-", 1)[0]) for qname in batch.qname[keep]), dtype=np.int64, count=int(keep.sum()))
+        aln_id = perc_id[keep]
+        aln_len = batch.length[keep]
+
+        covered = (aln_len / self.lengths[split_numbers]) >= self.min_cov
+        split_numbers = split_numbers[covered]
+        aln_id = aln_id[covered]
+        aln_len = aln_len[covered]
+
+        # pick the best hit of each fragment in the batch (the first one on ties, like checking hits one by one)
+        score = aln_id * aln_len
+        order = np.lexsort((-score, split_numbers))
+        split_numbers = split_numbers[order]
+        first = np.ones(len(split_numbers), dtype=bool)
+        first[1:] = split_numbers[1:] != split_numbers[:-1]
+
+        best = order[first]
+        split_numbers = split_numbers[first]
+
+        # only hits better than the fragment's current best
+        better = ~self.aligned[split_numbers] | (score[best] > self.aln_id[split_numbers] * self.aln_len[split_numbers])
+        best = best[better]
+        split_numbers = split_numbers[better]
 
+        self.aligned[split_numbers] = True
+        self.aln_id[split_numbers] = aln_id[best]
+        self.aln_len[split_numbers] = aln_len[best]
+
+    def add_sam(self, sam_fh):
+        """ Adds all the hits from a SAM file handle or stream """
+        for batch in samparser.parse_batches(sam_fh, mapq=1, aligned_only=True):
+            self.add_batch(batch)
+
+    def num_aligned(self):
+        return int(self.aligned.sum())
+
+    def ani_and_af(self):
+        """ Returns (gANI, AF) """
+        aln_total_length = int(self.lengths[self.aligned].sum())
+        total_length = int(self.lengths.sum())
+
+        # the id is always divided by total length; not aligned length
+        gANI = float((self.aln_id * self.aln_len)[self.aligned].sum() / aln_total_length) if aln_total_length else 0.0
+
+        # AF is scaled to length, not number of fragments
+        AF = aln_total_length / total_length if total_length else 0.0
+
+        return gANI, AF
+
+
+class _TeeReader(object):
+    """ Wraps a stream so everything read from it is also written to a file """
+
+    def __init__(self, stream, out_fh):
+        self.stream = stream
+        self.out_fh = out_fh
+
+    def readlines(self, hint=-1):
+        lines = self.stream.readlines(hint)
+        self.out_fh.writelines(lines)
+        return lines
+
+
+class PairCache(object):
+    """ 
+    Persistent ANI/AF results for each query-reference pair. 
+    
+    The cache is a tab delimited file that a line is appended to as each pair finishes, so an interrupted
+    or extended run only computes the pairs it doesn't have. A pair is keyed by the names and sizes of both 
+    fastas and the split_len, min_id, and min_cov used; changing any of those computes the pair again.
+    """
+
+    HEADER = ["query", "query_size", "reference", "reference_size", "split_len", "min_id", "min_cov", "ani", "af"]
+
+    def __init__(self, cache_f):
+        self.cache_f = cache_f
+        self.results = {}
+
+        if os.path.isfile(self.cache_f):
+            with open(self.cache_f, 'r') as IN:
+                header = IN.readline().rstrip("\n").split("\t")
+                if header != self.HEADER:
+                    raise ValueError("'{}' is not an ANI/AF pair cache.".format(self.cache_f))
+
+                for line in IN:
+                    fields = line.rstrip("\n").split("\t")
+                    # skip a partly written last line
+                    if len(fields) != len(self.HEADER):
+                        continue
+
+                    self.results[tuple(fields[:-2])] = (float(fields[-2]), float(fields[-1]))
+
+            LOG.info("Loaded {} cached pairs from '{}'.".format(len(self.results), self.cache_f))
+        else:
+            with open(self.cache_f, 'w') as OUT:
+                OUT.write("\t".join(self.HEADER) + "\n")
+
+    @staticmethod
+    def key(query_f, ref_f, split_len, min_id, min_cov):
+        return (get_basename(query_f), str(os.path.getsize(query_f)), get_basename(ref_f), str(os.path.getsize(ref_f)), str(split_len), str(min_id), str(min_cov))
+
+    def get(self, key):
+        """ Returns the cached (ani, af) of a pair or None """
+        return self.results.get(key)
+
+    def add(self, key, ani, af):
+        self.results[key] = (ani, af)
+        with open(self.cache_f, 'a') as OUT:
+            OUT.write("\t".join(list(key) + [str(ani), str(af)]) + "\n")
+
+
+class AllByAllScheduler(object):
+    """ 
+    Computes ANI/AF for every query-reference pair that isn't already in a PairCache.
+
+    Each reference's mapping index is built once on disk and every query is mapped against the saved 
+    index instead of rebuilding it in memory (nodisk) for each pair. The pending queries of a reference 
+    are binned into mapping jobs that run through a Parallelizer (or one at a time without one), and 
+    the ANI and AF matrices are filled in as the jobs finish.
+
+    With a SketchLibrary, pairs are screened first: a pair whose Mash distance estimates an ANI below screen_ani 
+    isn't aligned and gets an ANI and AF of 0 (what an alignment with nothing mapped gives). Screened pairs 
+    aren't cached so lowering screen_ani aligns them on the next run.
+    """
+
+    def __init__(self, queries, references, cache, index_dir, split_len=1000, min_id=.70, min_cov=.70, cpus=4, keep_sam=False, sketches=None, screen_ani=0):
+        self.queries = queries
+        self.references = references
+        self.cache = cache
+        self.index_dir = index_dir
+
+        self.split_len = split_len
+        self.min_id = min_id
+        self.min_cov = min_cov
+        self.cpus = cpus
+        self.keep_sam = keep_sam
+
+        self.sketches = sketches
+        self.screen_ani = screen_ani
+
+        self.prog = "bbmap.sh" if split_len <= 500 else "mapPacBio.sh"
+
+        # {(query name, reference name): value}
+        self.ani = {}
+        self.af = {}
+
+        self.mappers = {}
+
+    def index_path(self, ref):
+        """ The index directory of a reference (indexes of bbmap and mapPacBio are kept apart) """
+        return os.path.join(self.index_dir, self.prog.split(".")[0], get_basename(ref))
+
+    def pending_pairs(self):
+        """ Fills the matrices from the cache and returns a dict of {reference: [queries without results]} """
+        pending = {}
+        for ref in self.references:
+            for qry in self.queries:
+                result = self.cache.get(PairCache.key(qry, ref, self.split_len, self.min_id, self.min_cov))
+                if result is None:
+                    pending.setdefault(ref, []).append(qry)
+                else:
+                    self.ani[(get_basename(qry), get_basename(ref))], self.af[(get_basename(qry), get_basename(ref))] = result
+
+        LOG.info("{} of {} pairs found in the cache.".format(len(self.queries) * len(self.references) - sum(len(queries) for queries in pending.values()), len(self.queries) * len(self.references)))
+
+        if self.sketches is not None and self.screen_ani > 0 and pending:
+            pending = self._screen(pending)
+
+        return pending
+
+    def _screen(self, pending):
+        """ Removes the pending pairs with a Mash estimated ANI below screen_ani and fills them with 0 """
+        queries = sorted(set(qry for queries in pending.values() for qry in queries))
+        references = sorted(pending)
+
+        LOG.info("Screening {} pairs with MinHash sketches...".format(sum(len(queries) for queries in pending.values())))
+        similarity = 1 - self.sketches.distances(queries, references)
+        qry_indx = {qry: indx for indx, qry in enumerate(queries)}
+
+        screened = {}
+        num_skipped = 0
+        for ref_indx, ref in enumerate(references):
+            for qry in pending[ref]:
+                if qry == ref or similarity[qry_indx[qry], ref_indx] >= self.screen_ani:
+                    screened.setdefault(ref, []).append(qry)
+                else:
+                    self.ani[(get_basename(qry), get_basename(ref))] = 0.0
+                    self.af[(get_basename(qry), get_basename(ref))] = 0.0
+                    num_skipped += 1
+
+        LOG.info("{} pairs are below an estimated ANI of {} and won't be aligned.".format(num_skipped, self.screen_ani))
+        return screened
+
+    def _mapper(self, qry):
+        """ Returns the QueryMapper for a query (splitting it the first time) """
+        if qry not in self.mappers:
+            self.mappers[qry] = QueryMapper(qry, split_len=self.split_len, min_id=self.min_id, min_cov=self.min_cov)
+        return self.mappers[qry]
+
+    def _job_args(self, ref, queries):
+        return {
+                'qry_split_fs': [self._mapper(qry).split_f for qry in queries],
+                'output_dirs': [self._mapper(qry).out_dir for qry in queries],
+                'prog': self.prog,
+                'reference': ref,
+                'index_path': self.index_path(ref),
+                'cpus': self.cpus,
+                'min_id': self.min_id,
+                'min_cov': self.min_cov,
+                'keep_sam': self.keep_sam
+                }
+
+    def _record(self, ref, results):
+        """ Adds the results of a finished mapping job ({split file: (ani, af)}) to the matrices and cache """
+        split_to_qry = {mapper.split_f: qry for qry, mapper in self.mappers.items()}
+
+        for split_f, (ani, af) in results.items():
+            qry = split_to_qry[split_f]
+
+            self.cache.add(PairCache.key(qry, ref, self.split_len, self.min_id, self.min_cov), ani, af)
+            self.ani[(get_basename(qry), get_basename(ref))] = ani
+            self.af[(get_basename(qry), get_basename(ref))] = af
+
+    def run(self, nodes=0, executor="lsf", queries_per_job=0, jobs_dir="ani_af_jobs"):
+        """ 
+        Computes all pending pairs. With nodes > 0, index builds and then mapping jobs run through Parallelizers 
+        with the executor (each run's Parallelizers get new output directories in jobs_dir), otherwise everything 
+        runs here one job at a time. 
+
+        queries_per_job is the most queries mapped in one job (0 maps all pending queries of a reference in one job).
+        """
+
+        pending = self.pending_pairs()
+        num_pairs = sum(len(queries) for queries in pending.values())
+        LOG.info("{} pairs to compute against {} references.".format(num_pairs, len(pending)))
+        if not pending:
+            return
+
+        # bin the queries of each reference
+        jobs = []
+        for ref, queries in pending.items():
+            bin_size = queries_per_job or len(queries)
+            for indx in range(0, len(queries), bin_size):
+                jobs.append((ref, queries[indx:indx+bin_size]))
+
+        # split all the queries before any job needs the splits
+        for qry in set(qry for queries in pending.values() for qry in queries):
+            self._mapper(qry)
+
+        builds = [ref for ref in pending if not reference_index_exists(self.index_path(ref))]
+        LOG.info("Building {} reference indexes...".format(len(builds)))
+
+        if nodes > 0:
+            os.makedirs(jobs_dir, exist_ok=True)
+            run_name = time.strftime("%Y%m%d-%H%M%S") + "_" + str(os.getpid())
+
+            builder = parallelizer.Parallelizer(build_reference_index, nodes, self.cpus, imports=["subprocess, os"], output_dir=os.path.join(jobs_dir, "index_" + run_name), job_prefix="ani_af_index_{}_".format(run_name), executor=executor)
+            for ref in builds:
+                builder.run({'prog': self.prog, 'reference': ref, 'index_path': self.index_path(ref), 'cpus': self.cpus})
+
+            for _ in builder.get_all_results(wait=True):
+                pass
+
+            LOG.info("Mapping {} pairs in {} jobs...".format(num_pairs, len(jobs)))
+            p_launcher = parallelizer.Parallelizer(map_queries_to_reference, nodes, self.cpus, imports=["subprocess, os", "numpy as np", "mypyli.samparser"], output_dir=os.path.join(jobs_dir, "map_" + run_name), job_prefix="ani_af_map_{}_".format(run_name), executor=executor)
+            for ref, queries in jobs:
+                p_launcher.run(self._job_args(ref, queries))
+
+            for ref, results in p_launcher.get_all_results(wait=True):
+                self._record(ref, results)
+
+        else:
+            for ref in builds:
+                build_reference_index(self.prog, ref, self.index_path(ref), self.cpus)
+
+            LOG.info("Mapping {} pairs in {} jobs...".format(num_pairs, len(jobs)))
+            for ref, queries in jobs:
+                self._record(*map_queries_to_reference(**self._job_args(ref, queries)))
+
+    def write_matrices(self, prefix):
+        """ Writes the ANI and AF matrices (queries as rows, references as columns) """
+        qrys = sorted(set(get_basename(qry) for qry in self.queries))
+        refs = sorted(set(get_basename(ref) for ref in self.references))
+
+        ani_out = prefix + ".ANI.tab"
+        af_out = prefix + ".AF.tab"
+        with open(ani_out, 'w') as ANI, open(af_out, 'w') as AF:
+            ANI.write("\t".join(["query"] + refs) + "\n")
+            AF.write("\t".join(["query"] + refs) + "\n")
+            for q in qrys:
+                ANI.write("\t".join([q] + [str(self.ani[(q, r)]) for r in refs]) + "\n")
+                AF.write("\t".join([q] + [str(self.af[(q, r)]) for r in refs]) + "\n")
+
+
+def split_index_path(split_f):
+    """ Returns the path of the split index saved next to a split fasta """
+    return os.path.splitext(split_f)[0] + ".index.npy"
+
+def get_basename(fasta_f):
+    """ Returns the name used for a fasta in the matrices """
+    return os.path.splitext(os.path.basename(fasta_f))[0]
+
+def reference_index_exists(index_path):
+    return os.path.isfile(os.path.join(index_path, "ref", "genome", "1", "summary.txt"))
+
+def build_reference_index(prog, reference, index_path, cpus):
+    """ Worker function to build the on disk mapping index of a reference (once) """
+
+    if os.path.isfile(os.path.join(index_path, "ref", "genome", "1", "summary.txt")):
+        return index_path
+
+    os.makedirs(index_path, exist_ok=True)
+
+    cmd = "{} ref={ref} path={path} threads={cpus}".format(prog, ref=reference, path=index_path, cpus=cpus)
+
+    print("Running:\n    {}".format(cmd))
+    code = subprocess.call(cmd, shell=True)
+
+    if code:
+        raise Exception("Building the index of '{}' failed".format(reference))
+
+    return index_path
+
+def map_queries_to_reference(qry_split_fs, output_dirs, prog, reference, index_path, cpus, min_id=.70, min_cov=.70, keep_sam=False):
+    """ 
+    Worker function to map a batch of query splits to one reference using its saved index. 
+
+    The mapper's SAM output is read from its stdout straight into an AniAfAccumulator. It is only written 
+    to a SAM file if keep_sam is set; SAM files from earlier runs are read instead of mapping again.
+    
+    Returns (reference, {split file: (ani, af)}).
+    """
+
+    r_basename = os.path.splitext(os.path.basename(reference))[0]
+
+    results = {}
+    for qry_split_f, output_dir in zip(qry_split_fs, output_dirs):
+        q_basename = os.path.splitext(os.path.basename(qry_split_f))[0]
+        q_basename = q_basename.rsplit(".split", 1)[0]      # second step to get the split suffix out
+
+        bbmap_f = output_dir + q_basename + "__--__" + r_basename + ".sam"
+
+        accumulator = AniAfAccumulator.from_split_file(qry_split_f, min_id, min_cov)
+
+        # use the SAM file if this was mapped before
+        if os.path.isfile(bbmap_f):
+            print("Found SAM file for '{}' by '{}'. Using it.".format(q_basename, r_basename))
+            with open(bbmap_f, 'r') as IN:
+                accumulator.add_sam(IN)
+
+            results[qry_split_f] = accumulator.ani_and_af()
+            continue
+
+        cmd = "{} path={path} in={split_f} local=t ssao=f secondary=f overwrite=t sam=1.4 threads={cpus} out=stdout.sam".format(
+                prog,
+                path=index_path,
+                split_f=qry_split_f,
+                cpus=cpus)
+
+        print("Running:\n    {}".format(cmd))
+        mapper = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+        if keep_sam:
+            # write to a temporary name so an interrupted run doesn't leave a partial SAM file that looks done
+            with open(bbmap_f + ".tmp.sam", 'w') as OUT:
+                accumulator.add_sam(_TeeReader(mapper.stdout, OUT))
+        else:
+            accumulator.add_sam(mapper.stdout)
+
+        if mapper.wait():
+            raise Exception("The bbmap command failed")
+
+        if keep_sam:
+            os.rename(bbmap_f + ".tmp.sam", bbmap_f)
+
+        results[qry_split_f] = accumulator.ani_and_af()
+
+    return reference, results
 
 def map_to_references(qry_split_f, split_length, references, cpus, output_dir):
     """ Worker function to map a batch of files, returns a dict of SAM files from the mapping """
@@ -288,57 +682,25 @@ def main(args):
 
     # switch between all-by-all and reference based 
     if args.ref:
-        LOG.debug("Using all in fastas as the reference group.")
+        LOG.debug("Using fastas supplied with -ref as the reference group.")
         refs = args.ref
     else:
-        LOG.debug("Using fastas supplied with -ref as the reference group.")
+        LOG.debug("Using all in fastas as the reference group.")
         refs = args.i
-    
-    # start a parallelizer if needed 
-    if args.nodes > 0:
-        p_launcher = parallelizer.Parallelizer(map_to_references, args.nodes, args.cpus, imports=["subprocess, os"], job_prefix="ani_af") 
-    else:
-        p_launcher = None
-    
-    # start all the mapping jobs
-    LOG.info("Beginning mapping all by all...")
-    mappers = []
-    for qry in args.i:
-        qm = QueryMapper(qry, split_len=args.split_len)
-        qm.map_to_references(refs, p_launcher, args.cpus)
-        mappers.append(qm)
 
+    cache = PairCache(args.cache or args.prefix + ".pairs.tab")
 
-    # process the results
-    LOG.info("Parsing SAM files...")
-    ani_and_af_matr = {}
-    for qm in mappers:
-        ani, af = qm.get_ani_and_af(p_launcher)
-        ani_and_af_matr[qm.q_basename] = {}
+    sketches = None
+    if args.screen_ani > 0:
+        sketches = minhash.SketchLibrary(args.sketch_dir or args.prefix + ".sketches", k=args.sketch_k, size=args.sketch_size)
 
-        for ref, value in ani.items():
-            ani_and_af_matr[qm.q_basename][ref] = (ani[ref], af[ref])
+    scheduler = AllByAllScheduler(args.i, refs, cache, args.index_dir or args.prefix + ".indexes", split_len=args.split_len, cpus=args.cpus, keep_sam=args.keep_sam, sketches=sketches, screen_ani=args.screen_ani)
 
-    qrys = sorted(ani_and_af_matr.keys())
-    refs = sorted(ani_and_af_matr[qrys[0]].keys())
+    LOG.info("Beginning mapping all by all...")
+    scheduler.run(args.nodes, args.executor, args.queries_per_job, args.prefix + ".jobs")
 
     # write the correlation table with tuples and also the classification table
-    ani_out = args.prefix + ".ANI.tab"
-    af_out = args.prefix + ".AF.tab"
-    with open(ani_out, 'w') as ANI, open(af_out, 'w') as AF:
-        ANI.write("\t".join(["query"] + refs) + "\n")
-        AF.write("\t".join(["query"] + refs) + "\n")
-        for q in qrys:
-            ani_arr = [q]
-            af_arr = [q]
-            for r in refs:
-                # add the val to be written to the quantified table
-                ani_arr.append(str(ani_and_af_matr[q][r][0]))
-                af_arr.append(str(ani_and_af_matr[q][r][1]))
-
-
-            ANI.write("\t".join(ani_arr) + "\n")
-            AF.write("\t".join(af_arr) + "\n")
+    scheduler.write_matrices(args.prefix)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculates ANI (average nucleotide identity) and AF (alignment fraction) between two genomes. This is done by breaking up each query genome into pieces and mapping those pieces back to the other genome in the pair. AF is the length of the fraction of pieces that map back. ANI is the average identity of the length that maps back. This script outputs two matrices where each cell is either ANI or AF. Optionally splits up the mapping across multiple nodes of an LSF cluster. This method is based on the paper 'Microbial species delineation using whole genome sequences' by Varghese et al http://nar.oxfordjournals.org/content/early/2015/07/06/nar.gkv657.full") 
@@ -348,7 +710,16 @@ if __name__ == "__main__":
     parser.add_argument("-split_len", help="approx length of fragment [%(default)s]", type=int, default=1000)
     parser.add_argument("-prefix", help="prefix for the tables [%(default)s]", default="genome_comparison")
     parser.add_argument("-nodes", help="the number of nodes to parallelize to, 0 for local only [%(default)s]", default=0, type=int)
+    parser.add_argument("-executor", help="where to run parallel mapping jobs; 'local' runs -nodes jobs at a time in a process pool on this machine [%(default)s]", choices=["lsf", "local"], default="lsf")
     parser.add_argument("-cpus", help="the number of cpus to use for mapping [%(default)s]", default=4, type=int)
+    parser.add_argument("-queries_per_job", help="most queries to map against a reference in one job, 0 for all of them [%(default)s]", default=0, type=int)
+    parser.add_argument("-index_dir", help="directory to keep the reference mapping indexes in [PREFIX.indexes]")
+    parser.add_argument("-keep_sam", help="also write the SAM file of each pair (by default mapper output is only streamed into the ANI/AF calculation)", action="store_true")
+    parser.add_argument("-screen_ani", help="only align pairs with a MinHash (Mash distance) estimated ANI of at least this, 0 to align every pair [%(default)s]", default=0, type=float)
+    parser.add_argument("-sketch_dir", help="directory of the reusable MinHash sketch library [PREFIX.sketches]")
+    parser.add_argument("-sketch_k", help="k for MinHash sketches [%(default)s]", default=21, type=int)
+    parser.add_argument("-sketch_size", help="number of hashes in each MinHash sketch [%(default)s]", default=1000, type=int)
+    parser.add_argument("-cache", help="per-pair results cache; pairs found in it aren't computed again [PREFIX.pairs.tab]")
     args = parser.parse_args()
 
     main(args)
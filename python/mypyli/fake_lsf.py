@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Stand-ins for the LSF bsub and bjobs commands so Parallelizer/LSFExecutor can be
+run and tested on a machine without LSF.
+
+Jobs run as background processes on the local machine and their state is kept as
+small files in $FAKE_LSF_DIR (default: a 'fake_lsf' directory in the temp dir).
+
+Only the options used in mypyli are understood:
+    bsub -q -n -R -M -J -o -e [command]
+    bjobs [-a] [-w] [-noheader] [-o "job_name stat jobid"] [-J pattern]
+
+Usage:
+    python -m mypyli.fake_lsf bsub -J myjob -o myjob.out -e myjob.err python script.py
+    python -m mypyli.fake_lsf bjobs -a -J "myjob*"
+
+    or, from python, write bsub/bjobs wrappers to a directory and point an LSFExecutor at them:
+
+    bsub, bjobs = fake_lsf.install("fake_bin")
+    executor = parallelizer.LSFExecutor(bsub=bsub, bjobs=bjobs)
+"""
+
+import os
+import sys
+import json
+import time
+import fnmatch
+import tempfile
+import subprocess
+
+
+def state_dir():
+    path = os.environ.get("FAKE_LSF_DIR", os.path.join(tempfile.gettempdir(), "fake_lsf"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def install(bin_dir):
+    """ Writes bsub and bjobs wrapper scripts to bin_dir and returns their paths """
+    os.makedirs(bin_dir, exist_ok=True)
+
+    paths = []
+    for command in ["bsub", "bjobs"]:
+        path = os.path.join(os.path.abspath(bin_dir), command)
+        with open(path, 'w') as OUT:
+            OUT.write("#!/bin/sh\nexec {} -m mypyli.fake_lsf {} \"$@\"\n".format(sys.executable, command))
+        os.chmod(path, 0o755)
+        paths.append(path)
+
+    return tuple(paths)
+
+def _job_path(job_id):
+    return os.path.join(state_dir(), "{}.json".format(job_id))
+
+def _read_job(job_id):
+    with open(_job_path(job_id), 'r') as IN:
+        return json.load(IN)
+
+def _write_job(job):
+    """ Writes the job state atomically so bjobs never sees a partial file """
+    tmp = _job_path(job['id']) + ".tmp"
+    with open(tmp, 'w') as OUT:
+        json.dump(job, OUT)
+    os.rename(tmp, _job_path(job['id']))
+
+def _new_job_id():
+    """ Claims the next free job id """
+    job_id = 1 + max([int(f.split(".")[0]) for f in os.listdir(state_dir()) if f.endswith(".json")] or [0])
+    while True:
+        try:
+            os.close(os.open(_job_path(job_id) + ".lock", os.O_CREAT | os.O_EXCL))
+            return job_id
+        except FileExistsError:
+            job_id += 1
+
+def bsub(args):
+    """ Parses bsub options and starts the command in the background """
+    options = {'-J': "NONAME", '-o': None, '-e': None, '-q': "normal"}
+    while args and args[0] in ("-q", "-n", "-R", "-M", "-J", "-o", "-e"):
+        options[args[0]] = args[1]
+        args = args[2:]
+
+    job_id = _new_job_id()
+    job = {
+            'id': job_id,
+            'name': options['-J'],
+            'queue': options['-q'],
+            'stat': "PEND",
+            'stdout': options['-o'].replace("%J", str(job_id)) if options['-o'] else None,
+            'stderr': options['-e'].replace("%J", str(job_id)) if options['-e'] else None,
+            'command': args,
+            'submit_time': time.strftime("%b %d %H:%M")
+            }
+    _write_job(job)
+
+    subprocess.Popen([sys.executable, "-m", "mypyli.fake_lsf", "_run", str(job_id)], start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    print("Job <{}> is submitted to queue <{}>.".format(job_id, job['queue']))
+
+def _run(job_id):
+    """ Runs a submitted job and writes an LSF style summary to its stdout log """
+    job = _read_job(job_id)
+    job['stat'] = "RUN"
+    _write_job(job)
+
+    with open(job['stdout'] or os.devnull, 'a') as OUT, open(job['stderr'] or os.devnull, 'a') as ERR:
+        code = subprocess.call(job['command'], stdout=OUT, stderr=ERR)
+
+        if code:
+            OUT.write("\nExited with exit code {}.\n".format(code))
+        else:
+            OUT.write("\nSuccessfully completed.\n")
+
+    job['stat'] = "EXIT" if code else "DONE"
+    _write_job(job)
+
+def bjobs(args):
+    """ Prints jobs matching -J like bjobs (unfinished jobs only unless -a) """
+    show_all = "-a" in args
+    header = "-noheader" not in args
+
+    pattern = "*"
+    if "-J" in args:
+        pattern = args[args.index("-J") + 1]
+
+    fields = None
+    if "-o" in args:
+        fields = args[args.index("-o") + 1].split()
+
+    jobs = []
+    for f in sorted(os.listdir(state_dir()), key=lambda f: f.split(".")[0]):
+        if not f.endswith(".json"):
+            continue
+        job = _read_job(f.split(".")[0])
+
+        if not fnmatch.fnmatchcase(job['name'], pattern):
+            continue
+        if not show_all and job['stat'] in ("DONE", "EXIT"):
+            continue
+
+        jobs.append(job)
+
+    if not jobs:
+        print("No {}job found".format("" if show_all else "unfinished "), file=sys.stderr)
+        return
+
+    if fields:
+        names = {'jobid': 'id', 'job_name': 'name', 'stat': 'stat', 'queue': 'queue'}
+        if header:
+            print(" ".join([field.upper() for field in fields]))
+        for job in jobs:
+            print(" ".join([str(job[names[field]]) for field in fields]))
+    else:
+        if header:
+            print("JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME")
+        for job in jobs:
+            print("{:<7} {:<7} {:<5} {:<10} {:<11} {:<11} {:<10} {}".format(job['id'], "user", job['stat'], job['queue'], "localhost", "localhost", job['name'], job['submit_time']))
+
+
+if __name__ == "__main__":
+    command, args = sys.argv[1], sys.argv[2:]
+
+    if command == "bsub":
+        bsub(args)
+    elif command == "bjobs":
+        bjobs(args)
+    elif command == "_run":
+        _run(args[0])
+    else:
+        raise ValueError("Unknown command '{}'. Use bsub or bjobs.".format(command))
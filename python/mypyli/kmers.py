@@ -0,0 +1,42 @@
+import numpy as np
+
+
+# 2 bit code for each byte; anything that isn't ACGT (N, lowercase, etc) is 4
+NT_CODES = np.full(256, 4, dtype=np.uint8)
+NT_CODES[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4)
+
+
+def encode_kmers(seq, k):
+    """
+    Returns arrays (positions, ids, reverse complement ids) for each kmer in seq (str or bytes) that has only ACGT.
+
+    Ids are the base 4 value of the kmer (A=0, C=1, G=2, T=3). Both ids are rolled across the whole sequence
+    at once, one shift per base of k. Kmers with a non ACGT base are masked out with a running count of
+    those bases (a window is kept if the count doesn't change across it).
+    """
+    if k > 32:
+        raise ValueError("k must be <= 32 to fit kmer ids in 64 bits.")
+
+    if isinstance(seq, str):
+        seq = seq.encode()
+
+    codes = NT_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(codes) + 1 - k
+    if n <= 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.uint64), np.array([], dtype=np.uint64)
+
+    non_acgt = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(codes == 4, out=non_acgt[1:])
+    positions = np.flatnonzero(non_acgt[k:] == non_acgt[:n])
+
+    # masked kmers get garbage ids but are dropped below
+    codes = codes.astype(np.uint64)
+    complements = np.uint64(3) - codes
+
+    kmer_ids = np.zeros(n, dtype=np.uint64)
+    rc_ids = np.zeros(n, dtype=np.uint64)
+    for indx in range(k):
+        kmer_ids = (kmer_ids << np.uint64(2)) | codes[indx:indx + n]
+        rc_ids |= complements[indx:indx + n] << np.uint64(2 * indx)
+
+    return positions, kmer_ids[positions], rc_ids[positions]
@@ -1,5 +1,8 @@
 
 import sys
+import collections
+import concurrent.futures
+import numpy as np
 from mypyli.taxtree import TaxTree
 
 
@@ -17,10 +20,25 @@ class KrakenIO(object):
         for line in kraken_fh:
             yield KrakenRecord(line)
 
+    @classmethod
+    def parse_batches(cls, kraken_fh, block_size=2**24):
+        """
+        Columnar version of parse. Reads the kraken output in blocks of ~block_size bytes 
+        and yields a KrakenBatch for each block.
+
+        KrakenRecord objects are only built if they are requested from the batch.
+        """
+        while True:
+            lines = kraken_fh.readlines(block_size)
+            if not lines:
+                return
+
+            yield KrakenBatch.from_lines(lines)
+
     def set_tree(tree):
         """ Sets the tree for the KrakenRecord objects to use. Accepts either file or TaxTree obj"""
         #print((type(tree), type(TaxTree())))
-        if type(tree) == type(TaxTree()):
+        if isinstance(tree, TaxTree):
             KrakenRecord.tree = tree
         else:
             KrakenRecord.tree = TaxTree.load_tree(tree)
@@ -52,21 +70,41 @@ class KrakenRecord(object):
 
     @staticmethod
     def print_count_matrix(record_list, outfile="kraken_taxonomy_counts.txt"):
-        counts = {}
-        for record in record_list:
-            if record.classified:
-                counts[record.tax_id] = counts.get(record.tax_id, {'count':0, 'length':0})
-                counts[record.tax_id]['count'] += 1
-                counts[record.tax_id]['length'] += int(record.length)
-            else:
-                counts['unclassified'] = counts.get('unclassified', {'count':0, 'length':0})
-                counts['unclassified']['count'] += 1
-                counts['unclassified']['length'] += int(record.length)
+        """ Writes the count and average length of each taxid. Accepts KrakenRecords or KrakenBatches. """
+        record_list = iter(record_list)
+        try:
+            first = next(record_list)
+        except StopIteration:
+            first = None
+
+        if isinstance(first, KrakenBatch):
+            batches = [first] + list(record_list)
+        else:
+            # group the records into a single batch
+            records = [first] + list(record_list) if first is not None else []
+            batches = [KrakenBatch.from_records(records)]
+
+        taxids, counts, lengths = count_taxids(batches)
 
         with open(outfile, 'w') as OUT:
             print("taxid\tcount\tavg_length")
-            for key, value  in counts.items():
-                OUT.write("\t".join([str(key), str(value['count']), str(value['length'] / value['count'])]) + "\n")
+            for taxid, count, length in zip(taxids, counts, lengths):
+                key = taxid if taxid else "unclassified"
+                OUT.write("\t".join([str(key), str(count), str(int(length) / int(count))]) + "\n")
+
+    @classmethod
+    def from_fields(cls, classified, name, taxid, length, id_hits, p_val=None):
+        """ Builds a record from already parsed fields (used by KrakenBatch) """
+        record = cls.__new__(cls)
+        record.classified = classified
+        record.name = name
+        record.taxid = taxid
+        record.length = length
+        if p_val is not None:
+            record.p_val = p_val
+        record.kmer_hits = id_hits
+
+        return record
 
 
     def __init__(self, line):
@@ -142,17 +180,247 @@ class KrakenRecord(object):
     def _convert_hits_to_dict(self):
         """ This converts the hits to a dict. But I'm leaving options open to convert to some sort of list because I might want to preserve the order in which kmers mapped to find misassembled contigs. """
         if type(self.kmer_hits) is str:
-            #print(self.kmer_hits)
-            kmer_dict = {}
-            for hit in self.kmer_hits.split(" "):
+            return decode_hits(self.kmer_hits)
+
+
+class KrakenBatch(object):
+    """
+    A block of kraken output stored as column arrays. Both the 5 column (kraken-filter) 
+    and 6 column (with P=) formats are read.
+
+    Columns:
+        classified  - bool
+        name        - read/contig name
+        taxid       - int (0 for unclassified)
+        length      - int
+        p_val       - float (NaN if the line had no P= column)
+        id_hits     - the raw id hits strings, decoded only when asked for (decode_hits)
+    """
+
+    def __init__(self, classified, name, taxid, length, p_val, id_hits):
+        self.classified = classified
+        self.name = name
+        self.taxid = taxid
+        self.length = length
+        self.p_val = p_val
+        self.id_hits = id_hits
+
+    @classmethod
+    def from_lines(cls, lines):
+        """ Builds a batch from a list of kraken output lines """
+        n = len(lines)
+        rows = [line.rstrip("\n").split("\t") for line in lines]
+
+        classified = np.fromiter((r[0] == "C" for r in rows), dtype=bool, count=n)
+        name = np.array([r[1] for r in rows], dtype=object)
+        taxid = np.fromiter((int(r[2]) for r in rows), dtype=np.int64, count=n)
+        length = np.fromiter((int(r[3]) for r in rows), dtype=np.int64, count=n)
+        p_val = np.fromiter((float(r[4][2:]) if len(r) == 6 else np.nan for r in rows), dtype=np.float64, count=n)
+        id_hits = np.array([r[-1] for r in rows], dtype=object)
+
+        return cls(classified, name, taxid, length, p_val, id_hits)
+
+    @classmethod
+    def from_records(cls, records):
+        """ Builds a batch from KrakenRecord objects """
+        n = len(records)
+        return cls(np.fromiter((r.classified for r in records), dtype=bool, count=n),
+                np.array([r.name for r in records], dtype=object),
+                np.fromiter((int(r.taxid) for r in records), dtype=np.int64, count=n),
+                np.fromiter((r.length for r in records), dtype=np.int64, count=n),
+                np.fromiter((getattr(r, "p_val", np.nan) for r in records), dtype=np.float64, count=n),
+                np.array([r.kmer_hits for r in records], dtype=object))
+
+    def __len__(self):
+        return len(self.classified)
+
+    def filter(self, mask):
+        """ Returns a new batch with only the rows where mask is True (or the rows at the given indices) """
+        return KrakenBatch(self.classified[mask], self.name[mask], self.taxid[mask], self.length[mask], self.p_val[mask], self.id_hits[mask])
+
+    def get_hits(self, indx):
+        """ Returns the {taxid: kmer count} dict for a single row """
+        return decode_hits(self.id_hits[indx])
+
+    def get_record(self, indx):
+        """ Returns a KrakenRecord for a single row """
+        p_val = None if np.isnan(self.p_val[indx]) else float(self.p_val[indx])
+        return KrakenRecord.from_fields(bool(self.classified[indx]), self.name[indx], str(self.taxid[indx]), int(self.length[indx]), self.id_hits[indx], p_val)
+
+    def records(self):
+        """ Yields a KrakenRecord for each row """
+        for indx in range(len(self)):
+            yield self.get_record(indx)
+
+    def taxid_counts(self):
+        """ 
+        Returns arrays (taxids, counts, total lengths) with one entry per taxid in order of first appearance. 
+        Unclassified reads are counted under taxid 0.
+        """
+        taxids = np.where(self.classified, self.taxid, 0)
+        return _grouped_sums(taxids, np.ones(len(taxids), dtype=np.int64), self.length)
+
+
+class ConfidenceEngine(object):
+    """
+    Computes kraken confidences (see KrakenRecord.get_kraken_confidence) for whole KrakenBatches.
+
+    Instead of an is_ancestor_of call for every hit, the subtree of each taxid is its pre-order
+    interval in the tree's ancestor index (a hit is in the subtree of the assigned taxid if its entry
+    falls in the assigned interval). Intervals are memoized by taxid so each is looked up once 
+    and the checks for a batch are done as array comparisons.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self._intervals = {}
+
+    def _interval(self, taxid):
+        try:
+            return self._intervals[taxid]
+        except KeyError:
+            try:
+                interval = self.tree.subtree_interval(taxid)
+            except KeyError:
+                print("Taxid {} not found in the TaxTree.".format(taxid))
+                raise
+
+            self._intervals[taxid] = interval
+            return interval
+
+    def confidences(self, batch):
+        """ Returns a list with the confidence of each read in the batch ("0/0" for unclassified reads) """
+        classified = np.flatnonzero(batch.classified)
+
+        # interval of the assigned taxid for each classified read
+        assigned = np.array([self._interval(str(batch.taxid[indx])) for indx in classified], dtype=np.int64).reshape(-1, 2)
+        starts = np.zeros(len(batch), dtype=np.int64)
+        ends = np.zeros(len(batch), dtype=np.int64)
+        starts[classified] = assigned[:, 0]
+        ends[classified] = assigned[:, 1]
+
+        # flatten the hits; unassigned (0) hits get an entry of -1 so they are never in a subtree
+        rows = []
+        entries = []
+        counts = []
+        for indx in classified:
+            for hit in batch.id_hits[indx].split(" "):
                 [taxid, count] = hit.split(":")
-                kmer_dict[taxid] = kmer_dict.get(taxid, 0) + int(count)
+                if taxid == "A":
+                    continue
+
+                rows.append(indx)
+                counts.append(int(count))
+                entries.append(-1 if taxid == "0" else self._interval(taxid)[0])
+
+        rows = np.array(rows, dtype=np.int64)
+        counts = np.array(counts, dtype=np.int64)
+        entries = np.array(entries, dtype=np.int64)
+
+        accurate = (entries >= starts[rows]) & (entries < ends[rows])
+        accurate_counts = np.bincount(rows, weights=counts * accurate, minlength=len(batch)).astype(np.int64)
+        total_counts = np.bincount(rows, weights=counts, minlength=len(batch)).astype(np.int64)
+
+        confidences = ["0/0"] * len(batch)
+        for indx in classified:
+            if not total_counts[indx]:
+                raise ZeroDivisionError("Read {} has no unambiguous k-mers.".format(batch.name[indx]))
+
+            confidences[indx] = int(accurate_counts[indx]) / int(total_counts[indx])
+
+        return confidences
+
+    def table_lines(self, batch):
+        """ Returns the confidence table (contig, length, taxonomy, confidence) lines for a batch """
+        taxes = self.tree.get_tax_strings([str(taxid) for taxid in batch.taxid])
+        confidences = self.confidences(batch)
+
+        lines = []
+        for indx in range(len(batch)):
+            tax = taxes[indx] if batch.classified[indx] else "unclassified"
+            lines.append("\t".join([batch.name[indx], str(batch.length[indx]), tax, str(confidences[indx])]) + "\n")
+
+        return lines
+
+
+# engine of each confidence table worker process
+_WORKER_ENGINE = None
+
+def _init_confidence_worker(tree):
+    global _WORKER_ENGINE
+    if not isinstance(tree, TaxTree):
+        tree = TaxTree.load_tree(tree)
+    _WORKER_ENGINE = ConfidenceEngine(tree)
+
+def _confidence_table_block(lines):
+    return "".join(_WORKER_ENGINE.table_lines(KrakenBatch.from_lines(lines)))
+
+def write_confidence_table(kraken_fh, out_fh, tree, workers=1, block_size=2**22):
+    """
+    Writes the kraken confidence table (contig, length, taxonomy, confidence) for a whole kraken file.
+
+    Blocks of ~block_size bytes are processed by a pool of workers (in order) if workers > 1. 
+    The tree can be a TaxTree or a path; a path to a binary tree is best for many workers because 
+    each worker memory maps the same file instead of getting its own copy.
+
+    Returns the number of reads written.
+    """
+    reads = 0
+    if workers <= 1:
+        _init_confidence_worker(tree)
+        for lines in iter(lambda: kraken_fh.readlines(block_size), []):
+            out_fh.write(_confidence_table_block(lines))
+            reads += len(lines)
+        return reads
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_confidence_worker, initargs=(tree,)) as pool:
+        # keep a few blocks per worker in flight so the whole file is never in memory
+        pending = collections.deque()
+        for lines in iter(lambda: kraken_fh.readlines(block_size), []):
+            pending.append(pool.submit(_confidence_table_block, lines))
+            reads += len(lines)
+
+            if len(pending) >= 2 * workers:
+                out_fh.write(pending.popleft().result())
+
+        while pending:
+            out_fh.write(pending.popleft().result())
+
+    return reads
+
+
+def decode_hits(id_hits):
+    """ Converts a raw id hits string (Ex: '562:13 0:4 A:2') to a {taxid: count} dict """
+    kmer_dict = {}
+    for hit in id_hits.split(" "):
+        [taxid, count] = hit.split(":")
+        kmer_dict[taxid] = kmer_dict.get(taxid, 0) + int(count)
+
+    return kmer_dict
+
+def _grouped_sums(keys, *values):
+    """ Sums each values array by key. Returns (unique keys, *sums) in order of first appearance of each key. """
+    uniques, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+
+    sums = [np.bincount(inverse.ravel(), weights=v, minlength=len(uniques)).astype(np.int64)[order] for v in values]
+    return [uniques[order]] + sums
+
+def count_taxids(batches):
+    """ Returns (taxids, counts, total lengths) summed over many KrakenBatches (see KrakenBatch.taxid_counts) """
+    per_batch = [batch.taxid_counts() for batch in batches]
+    if not per_batch:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    return _grouped_sums(*[np.concatenate(col) for col in zip(*per_batch)])
 
-            return kmer_dict
 
 if __name__ == "__main__":
 
-    records = KrakenRecord.parse_kraken_file(sys.argv[1])
-    [print(record) for record in records]
+    with open(sys.argv[1]) as IN:
+        batches = list(KrakenIO.parse_batches(IN))
+
+    for batch in batches:
+        [print(record) for record in batch.records()]
 
-    KrakenRecord.print_count_matrix(records)
+    KrakenRecord.print_count_matrix(batches)
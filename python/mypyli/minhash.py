@@ -0,0 +1,187 @@
+import os
+import json
+import numpy as np
+from mypyli.kmers import encode_kmers
+
+
+# pads short sketches in a 2D array; never a real hash because hashes are kept below it
+EMPTY = np.uint64(2**64 - 1)
+
+
+def read_fasta_seqs(fasta_f):
+    """ Yields the sequence (bytes) of each record in a fasta file """
+    seq = []
+    with open(fasta_f, 'rb') as IN:
+        for line in IN:
+            if line.startswith(b">"):
+                if seq:
+                    yield b"".join(seq)
+                seq = []
+            else:
+                seq.append(line.rstrip())
+
+    if seq:
+        yield b"".join(seq)
+
+def canonical_kmers(seq, k):
+    """
+    Returns an array of canonical kmer ids (the smaller of the kmer and its reverse complement) for each kmer of seq
+    that has only ACGT (either case).
+    """
+    positions, kmer_ids, rc_ids = encode_kmers(seq.upper(), k)
+    return np.minimum(kmer_ids, rc_ids)
+
+def hash_kmers(kmer_ids, seed=42):
+    """ Returns 64 bit hashes of kmer ids (the murmur3 finalizer of id ^ seed); the EMPTY value is never returned """
+    hashes = np.asarray(kmer_ids, dtype=np.uint64) ^ np.uint64(seed)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xff51afd7ed558ccd)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xc4ceb9fe1a85ec53)
+    hashes ^= hashes >> np.uint64(33)
+
+    return np.minimum(hashes, EMPTY - np.uint64(1))
+
+def bottom_hashes(hashes, size):
+    """ Returns the size smallest distinct hashes (sorted) without sorting all of them """
+    num_candidates = min(len(hashes), 2 * size)
+    while True:
+        # the smallest distinct hashes are all in the candidates once there are enough distinct candidates
+        candidates = np.unique(np.partition(hashes, num_candidates - 1)[:num_candidates]) if num_candidates else hashes
+        if len(candidates) >= size or num_candidates == len(hashes):
+            return candidates[:size]
+
+        num_candidates = min(len(hashes), 4 * num_candidates)
+
+def sketch_fasta(fasta_f, k=21, size=1000, seed=42):
+    """ Returns the bottom-k MinHash sketch of a fasta (sorted array of the size smallest distinct kmer hashes) """
+    sketch = np.array([], dtype=np.uint64)
+    for seq in read_fasta_seqs(fasta_f):
+        hashes = bottom_hashes(hash_kmers(canonical_kmers(seq, k), seed), size)
+        sketch = np.union1d(sketch, hashes)[:size]
+
+    return sketch
+
+def pad_sketches(sketches, size):
+    """ Stacks sketches into a (number of sketches, size) array padded with EMPTY """
+    matrix = np.full((len(sketches), size), EMPTY, dtype=np.uint64)
+    for indx, sketch in enumerate(sketches):
+        matrix[indx, :len(sketch)] = sketch[:size]
+    return matrix
+
+def jaccard(sketch, sketches, size):
+    """
+    Estimates the Jaccard index of one sketch against each row of a padded sketch matrix like Mash does: the
+    fraction of the bottom size hashes of the union of the two sketches that are in both.
+
+    The union of the sketch with every row is sorted at once; a hash in both sketches is next to itself.
+    """
+    if len(sketches) == 0:
+        return np.zeros(0)
+
+    merged = np.concatenate((np.broadcast_to(pad_sketches([sketch], size), sketches.shape), sketches), axis=1)
+    merged.sort(axis=1)
+
+    real = merged != EMPTY
+    shared = np.zeros(merged.shape, dtype=bool)
+    shared[:, 1:] = (merged[:, 1:] == merged[:, :-1]) & real[:, 1:]
+    distinct = real & ~shared
+
+    # the union sketch is the first size distinct hashes of each row
+    in_union = distinct & (np.cumsum(distinct, axis=1) <= size)
+    union_size = in_union.sum(axis=1)
+    threshold = np.where(union_size > 0, np.where(in_union, merged, 0).max(axis=1), 0)
+
+    num_shared = (shared & (merged <= threshold[:, None])).sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union_size > 0, num_shared / union_size, 0.0)
+
+def mash_distance(jaccard_index, k):
+    """ Converts Jaccard indexes to Mash distances (an estimate of 1 - ANI) """
+    jaccard_index = np.asarray(jaccard_index, dtype=np.float64)
+    with np.errstate(divide="ignore"):
+        distance = -1 / k * np.log(2 * jaccard_index / (1 + jaccard_index))
+
+    return np.where(jaccard_index > 0, np.clip(distance, 0.0, 1.0), 1.0)
+
+
+class SketchLibrary(object):
+    """
+    A directory of bottom-k sketches that can be reused across runs.
+
+    Each genome's sketch is saved as <name>.npy and library.json keeps the sketch parameters and the size of the
+    fasta each sketch was made from. A sketch is made again if the fasta changed size. The parameters of a
+    library can't be changed once it has sketches.
+    """
+
+    def __init__(self, library_dir, k=21, size=1000, seed=42):
+        self.library_dir = library_dir
+        self.k = k
+        self.size = size
+        self.seed = seed
+
+        self.info_f = os.path.join(self.library_dir, "library.json")
+        self.genomes = {}
+
+        os.makedirs(self.library_dir, exist_ok=True)
+
+        if os.path.isfile(self.info_f):
+            with open(self.info_f, 'r') as IN:
+                info = json.load(IN)
+
+            params = {'k': k, 'size': size, 'seed': seed}
+            if info['params'] != params:
+                raise ValueError("Sketch library '{}' was made with {} not {}. Use another library directory.".format(self.library_dir, info['params'], params))
+
+            self.genomes = info['genomes']
+
+    def _sketch_f(self, name):
+        return os.path.join(self.library_dir, name + ".npy")
+
+    def _save_info(self):
+        """ Writes library.json atomically """
+        tmp = self.info_f + ".tmp"
+        with open(tmp, 'w') as OUT:
+            json.dump({'params': {'k': self.k, 'size': self.size, 'seed': self.seed}, 'genomes': self.genomes}, OUT, indent=1)
+        os.rename(tmp, self.info_f)
+
+    @staticmethod
+    def genome_name(fasta_f):
+        return os.path.splitext(os.path.basename(fasta_f))[0]
+
+    def add(self, fasta_fs):
+        """ Sketches the fastas that aren't in the library (or that changed) and returns the number sketched """
+        num_sketched = 0
+        for fasta_f in fasta_fs:
+            name = self.genome_name(fasta_f)
+            fasta_size = os.path.getsize(fasta_f)
+
+            if self.genomes.get(name, {}).get('fasta_size') == fasta_size and os.path.isfile(self._sketch_f(name)):
+                continue
+
+            np.save(self._sketch_f(name), sketch_fasta(fasta_f, self.k, self.size, self.seed))
+            self.genomes[name] = {'fasta_size': fasta_size}
+            num_sketched += 1
+
+        if num_sketched:
+            self._save_info()
+
+        return num_sketched
+
+    def load(self, names):
+        """ Returns a padded sketch matrix with a row for each genome name """
+        return pad_sketches([np.load(self._sketch_f(name)) for name in names], self.size)
+
+    def distances(self, query_fs, reference_fs):
+        """ Returns a (queries, references) array of Mash distances, sketching any fastas not in the library """
+        self.add(list(query_fs) + list(reference_fs))
+
+        queries = self.load([self.genome_name(fasta_f) for fasta_f in query_fs])
+        references = self.load([self.genome_name(fasta_f) for fasta_f in reference_fs])
+
+        distances = np.ones((len(queries), len(references)))
+        for indx, query in enumerate(queries):
+            distances[indx] = mash_distance(jaccard(query[query != EMPTY], references, self.size), self.k)
+
+        return distances
@@ -1,11 +1,15 @@
 
 import inspect
+import re
 import dill as pickle
 import tempfile
 import os
 import sys
 import subprocess
 import time
+import concurrent.futures
+import atexit
+import threading
 from mypyli.samparser import SamRecord
 
 import logging
@@ -47,11 +51,17 @@ class LSFParallelizer(object):
             return False
 
 class Parallelizer(object):
-    """ Spawns a function on another LSF node """
-
-    devnull = open("/dev/null", 'w')
+    """ 
+    Spawns a function on another LSF node (or in a local process pool) 
+    
+    Where the jobs run is decided by the executor:
+        "lsf"   - submit each job with bsub and pass arguments/results as dill pickles (default)
+        "local" - run each job in a concurrent.futures process pool on this machine and 
+                  keep results in memory
+        or any object with the same methods as LSFExecutor/LocalExecutor.
+    """
 
-    def __init__(self, function, nodes, processors_per_node, imports=[], output_dir="paral_results", job_prefix="job"):
+    def __init__(self, function, nodes, processors_per_node, imports=[], output_dir="paral_results", job_prefix="job", executor="lsf"):
 
         # set function and optional imports
         self.function = function
@@ -63,24 +73,19 @@ class Parallelizer(object):
     
 
         self.output_dir = output_dir
-
-        # make directory if doesn't exist -- subject to unlikely race condition, leaving this for simplicity
-        if os.path.isdir(output_dir):
-            raise ValueError("Output directory '{}' already exists. Please delete it or supply a new output directory.".format(output_dir))
-        else:
-            os.mkdir(output_dir)
-
        
         self.jobs = {}
         self.job_prefix = job_prefix
         self.job_id = 1
 
-        
-        # pickle the function 
-        self.function_pkl = self.output_dir + "/" + "function.pkl"
-        with open(self.function_pkl, 'wb') as OUT:
-            pickle.dump(function, OUT)
+        if executor == "lsf":
+            self.executor = LSFExecutor()
+        elif executor == "local":
+            self.executor = LocalExecutor()
+        else:
+            self.executor = executor
 
+        self.executor.start(self)
 
     def run(self, job_args):
         """ 
@@ -94,32 +99,9 @@ class Parallelizer(object):
         job_id = self.job_id
         self.job_id += 1
         job_name = self.job_prefix + str(job_id)
-            
-        args_pkl = self.output_dir + "/" + job_name + "_arguments.pkl"
-        results_pkl = self.output_dir + "/" + job_name + "_results.pkl"
-        job_script = self.output_dir + "/" + job_name + "_script.py"
-        log_base = self.output_dir + "/" + job_name
-            
-        # pickle the batch
-        with open(args_pkl, 'wb') as OUT:
-            pickle.dump(job_args, OUT)
 
         # add the job to the registry
-        self.jobs[job_id] = LSFJob(job_id, job_name)
-        self.jobs[job_id].results = results_pkl
-
-
-        # write the script to execute on the compute node
-        with open(job_script, 'w') as OUT:
-            OUT.write(self.generate_script(args_pkl, results_pkl) + "\n")
-
-
-        # wait until there is a spot available
-        while self.count_jobs_in_queue() >= self.nodes:
-            time.sleep(60)
-
-        # run the job
-        self.execute_command(job_id, "python {}".format(job_script), log_base)
+        self.jobs[job_id] = self.executor.submit(job_id, job_name, job_args)
 
         return job_id
  
@@ -151,13 +133,12 @@ class Parallelizer(object):
 
             # block or return
             if wait:
-                time.sleep(60)
+                if jobs_remaining:
+                    self.executor.wait_any(jobs_remaining)
             else:
                 return 
 
 
-
-
     def get_results(self, job_id, wait=False):
         """ 
         Returns the results of a job or a ValueError if job has failed or a NotFinishedError is job is still in progress
@@ -181,7 +162,7 @@ class Parallelizer(object):
             if job.status == "in progress":
                 if wait:
                     LOG.debug("Waiting for result...")
-                    time.sleep(60)
+                    self.executor.wait_any([job])
                 else:
                     raise NotFinishedError("Job with id '{}' is still in progress.".format(job_id))
 
@@ -189,61 +170,118 @@ class Parallelizer(object):
                 raise ValueError("Job with id '{}' exited with error.".format(job_id))
 
             elif job.status == "completed":
-                with open(job.results, 'rb') as IN:
-                    return pickle.load(IN)
+                return self.executor.load_results(job)
 
             else:
                 raise ValueError("Job status '{}' unknown. -- Module error.".format(job.status))
 
 
-    #
-    ## Submitting jobs
-    #
-    def submit_to_lsf(self, iterable):
-        """ Submits jobs up until the maximum node count """
-        while self.count_jobs_in_queue() < self.nodes:
-            batch = next(iterable)
-            batch_name = self.batch_prefix + str(self.batch_number)
-            self.batch_number += 1
-            
-            
+class LSFExecutor(object):
+    """ Runs Parallelizer jobs on an LSF cluster using bsub and passes data through dill pickles on disk """
 
-            batch_pkl = self.output_dir + "/" + batch_name + "_arguments.pkl"
-            results_pkl = self.output_dir + "/" + batch_name + "_results.pkl"
-            batch_script = self.output_dir + "/" + batch_name + "_script.py"
-            log_base = self.output_dir + "/" + batch_name
-            
-            # pickle the batch
-            with open(batch_pkl, 'wb') as OUT:
-                pickle.dump(batch, OUT)
+    devnull = open("/dev/null", 'w')
+
+    def __init__(self, bsub="bsub", bjobs="bjobs", min_interval=1, max_interval=60):
+        self.parallelizer = None
+        self.function_pkl = None
+
+        # commands can be swapped out (Ex: for the stand-ins in mypyli.fake_lsf)
+        self.bsub = bsub
+        self.bjobs = bjobs
 
-            with open(batch_scrupt, 'w') as OUT:
-                OUT.write(self.generate_script(batch_pkl, results_pkl) + "\n")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.poller = None
 
-            self.execute_command(self, batch_name, "python {}".format(batch_script))
+    def start(self, parallelizer):
+        """ Sets up the output directory and pickles the function for a Parallelizer """
+        self.parallelizer = parallelizer
+        output_dir = parallelizer.output_dir
+
+        # make directory if doesn't exist -- subject to unlikely race condition, leaving this for simplicity
+        if os.path.isdir(output_dir):
+            raise ValueError("Output directory '{}' already exists. Please delete it or supply a new output directory.".format(output_dir))
+        else:
+            os.mkdir(output_dir)
 
-            self.submitted_jobs[job_name] = {'results': results_pkl}
+        # pickle the function (with the globals it uses so helpers defined in a script are available on the node)
+        self.function_pkl = output_dir + "/" + "function.pkl"
+        with open(self.function_pkl, 'wb') as OUT:
+            pickle.dump(parallelizer.function, OUT, recurse=True)
+
+        self.poller = LSFStatusPoller(parallelizer.job_prefix + "*", self.bjobs, self.min_interval, self.max_interval)
+
+    def submit(self, job_id, job_name, job_args):
+        """ Submits a job as soon as there is room in the queue and returns an LSFJob """
+        output_dir = self.parallelizer.output_dir
+
+        args_pkl = output_dir + "/" + job_name + "_arguments.pkl"
+        results_pkl = output_dir + "/" + job_name + "_results.pkl"
+        job_script = output_dir + "/" + job_name + "_script.py"
+        log_base = output_dir + "/" + job_name
             
-    def execute_command(self, job_id, python_command, log_base):
+        # pickle the batch
+        with open(args_pkl, 'wb') as OUT:
+            pickle.dump(job_args, OUT)
+
+        job = LSFJob(job_id, job_name, bjobs=self.bjobs)
+        job.results = results_pkl
+
+        # write the script to execute on the compute node
+        with open(job_script, 'w') as OUT:
+            OUT.write(self.generate_script(args_pkl, results_pkl) + "\n")
+
+
+        # wait until there is a spot available
+        while True:
+            unfinished = self.poller.unfinished_jobs()
+            if len(unfinished) < self.parallelizer.nodes:
+                break
+            self.wait_any(unfinished)
+
+        # run the job
+        self.execute_command(job, "python {}".format(job_script), log_base)
+        self.poller.register(job)
+
+        return job
+
+    def wait_any(self, jobs):
+        """ Blocks until the poller reports at least one of the jobs as finished """
+        concurrent.futures.wait([job.future for job in jobs], return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def load_results(self, job):
+        """ Loads the results pickled by the job """
+        with open(job.results, 'rb') as IN:
+            return pickle.load(IN)
+
+    #
+    ## Submitting jobs
+    #
+    def execute_command(self, job, python_command, log_base):
         """ Submits an LSF job """
-        lsf_command = self.generate_lsf_command(job_id, o=log_base + ".out", e=log_base + ".err")
+        lsf_command = self.generate_lsf_command(job, lsf_program=self.bsub, o=log_base + ".out", e=log_base + ".err")
 
         full_command = lsf_command + " " + python_command
 
-        subprocess.call(full_command.split(" "))
+        output = subprocess.check_output(full_command.split(" ")).decode()
+
+        # the LSF job id is unique, unlike job names which repeat across runs with the same prefix
+        match = re.search(r"Job <(\d+)> is submitted", output)
+        if match:
+            job.lsf_id = match.group(1)
+        else:
+            LOG.warning("Could not find the LSF job id in the bsub output: {}".format(output.strip()))
 
-        self.jobs[job_id].command = full_command
-        self.jobs[job_id].status = "in progress"
+        job.command = full_command
+        job.status = "in progress"
 
-    def generate_lsf_command(self, job_id, lsf_program="bsub", q="week", R="span[hosts=1]", M="30", o="%J.out", e="%J.err"):
+    def generate_lsf_command(self, job, lsf_program="bsub", q="week", R="span[hosts=1]", M="30", o="%J.out", e="%J.err"):
         """ Generates the lsf portion of the job submission """
 
-        job = self.jobs[job_id]
-
         command = " ".join([
                 lsf_program,
                 "-q", str(q),
-                "-n", str(self.processors_per_node),
+                "-n", str(self.parallelizer.processors_per_node),
                 "-R", str(R),
                 "-M", str(M),
                 "-J", str(job.name),
@@ -263,7 +301,7 @@ class Parallelizer(object):
         shebang = "#!/usr/bin/env python"
 
         # generate the import statements
-        imports = "\n".join(["import {}".format(i) for i in self.imports + ["dill"]])
+        imports = "\n".join(["import {}".format(i) for i in self.parallelizer.imports + ["dill", "os"]])
 
         # load the function and arguments 
         # load function
@@ -282,10 +320,12 @@ class Parallelizer(object):
         # run the function
         running = "results = function(**args)"
 
-        # store the results
+        # store the results; written to a temp file and renamed so the poller can 
+        # take the results file appearing as a sign the job completed
         storing = "\n".join([
-                    "with open('{}', 'wb') as OUT:".format(output_pkl),
-                    "    dill.dump(results, OUT)"
+                    "with open('{}.tmp', 'wb') as OUT:".format(output_pkl),
+                    "    dill.dump(results, OUT)",
+                    "os.rename('{0}.tmp', '{0}')".format(output_pkl)
                     ])
 
         script_code = "\n\n".join([shebang, imports, load_function, load_args, running, storing])
@@ -293,62 +333,210 @@ class Parallelizer(object):
         return script_code
 
 
-    #
-    ## Retrieving results
-    #
-    @classmethod
-    def wait_for_job(cls, job_name):
-        """ waits for job to complete, checks every 10 seconds """
-        while cls._job_running(job_name):
-            time.sleep(10)
+class LSFStatusPoller(object):
+    """ 
+    Tracks the state of many LSF jobs using a single batched bjobs call per check.
 
-    @classmethod
-    def check_jobs(cls, job_name):
+    Each registered job gets a concurrent.futures.Future (job.future) that is resolved 
+    with "completed" or "exited" once the job finishes, so callers can block on the 
+    futures or attach callbacks. Checks run on a background thread that backs off from 
+    min_interval to max_interval while nothing changes and stops when no jobs are left.
 
-        output = subprocess.check_output([
-                    "bjobs",
-                    "-J", "{job_name}".format(job_name=job_name)
-                ], stderr=cls.devnull).decode(sys.stdout.encoding) 
+    A job counts as completed as soon as its results file appears, even if bjobs hasn't 
+    caught up yet. Jobs that have fallen out of bjobs -a are resolved from their stdout log.
+    """
 
-        return output
-   
-    def count_jobs_in_queue(self):
-        """ Returns the number of jobs still listed in the queue """
-        result = self.check_jobs(self.job_prefix + "*")
-        
-        if result:
-            # have one line for each job (skip the header)
-            jobs = result.split("\n")[1:]
+    devnull = open("/dev/null", 'w')
+
+    def __init__(self, job_pattern, bjobs="bjobs", min_interval=1, max_interval=60):
+        self.job_pattern = job_pattern
+        self.bjobs = bjobs
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def register(self, job, callback=None):
+        """ Starts tracking a submitted job and returns its future """
+        job.future = concurrent.futures.Future()
+        if callback is not None:
+            job.future.add_done_callback(callback)
 
-            # - 1 because there is a header line
-            return len(jobs) - 1
+        with self.lock:
+            self.jobs[job.name] = job
 
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="LSFStatusPoller", daemon=True)
+                self.thread.start()
+
+        # check soon in case the job was quick
+        self.wakeup.set()
+
+        return job.future
+
+    def unfinished_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def query(self):
+        """ Returns a dict of {LSF job id: LSF state} from one bjobs call """
+        output = subprocess.run(self.bjobs.split(" ") + ["-a", "-noheader", "-o", "jobid stat", "-J", self.job_pattern], stdout=subprocess.PIPE, stderr=self.devnull).stdout.decode()
+
+        states = {}
+        for line in output.splitlines():
+            elements = line.split()
+            if len(elements) == 2:
+                states[elements[0]] = elements[1]
+
+        return states
+
+    def poll(self):
+        """ Checks all tracked jobs once. Returns the number of jobs that finished. """
+        states = self.query()
+
+        finished = 0
+        for job in self.unfinished_jobs():
+            status = self._job_status(job, states.get(job.lsf_id))
+
+            if status is not None:
+                with self.lock:
+                    del self.jobs[job.name]
+
+                LOG.debug("Job '{}' finished with status '{}'".format(job.id, status))
+                job.future.set_result(status)
+                finished += 1
+
+        return finished
+
+    @staticmethod
+    def _job_status(job, state):
+        """ Returns the finished status of a job or None if it is still in progress """
+        if job.results and os.path.isfile(job.results):
+            return "completed"
+        elif state == "DONE":
+            return "completed"
+        elif state == "EXIT":
+            return "exited"
+        elif state is None:
+            # job is no longer in bjobs history; status comes from the logs
+            return job.status_from_log()
         else:
-            return 0
+            return None
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self.lock:
+                if not self.jobs:
+                    self.thread = None
+                    return
+
+            # clear before polling so a job registered during the poll still wakes the next wait
+            self.wakeup.clear()
+            try:
+                finished = self.poll()
+            except Exception as e:
+                LOG.warning("Checking LSF job status failed: {}".format(e))
+                finished = 0
+
+            # adaptive back off; go back to checking quickly when something changes
+            if finished:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+
+            self.wakeup.wait(interval)
+
+
+class LocalExecutor(object):
+    """ 
+    Runs Parallelizer jobs in a local process pool. 
+    
+    The Parallelizer's nodes is the number of jobs to run at once. Arguments and results
+    are passed in memory and nothing is written to the output directory.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.pool = None
+        self.function_dump = None
+
+    def start(self, parallelizer):
+        """ Starts the process pool for a Parallelizer """
+        # dill the function once so lambdas/closures work the same as they do with LSF
+        self.function_dump = pickle.dumps(parallelizer.function, recurse=True)
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers or parallelizer.nodes)
+
+        # make sure the workers are cleaned up even if the caller never shuts the pool down
+        atexit.register(self.shutdown)
+
+    def submit(self, job_id, job_name, job_args):
+        """ Submits a job to the pool and returns a LocalJob """
+        job = LocalJob(job_id, job_name, self.pool.submit(_call_dilled_function, self.function_dump, job_args))
+        job.status = "in progress"
+
+        return job
+
+    def wait_any(self, jobs):
+        """ Blocks until at least one of the jobs is done """
+        concurrent.futures.wait([job.future for job in jobs], return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def load_results(self, job):
+        return job.future.result()
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+_FUNCTION_CACHE = {}
+
+def _call_dilled_function(function_dump, job_args):
+    """ Runs a dilled function in a pool worker (the function is only undilled once per worker) """
+    try:
+        function = _FUNCTION_CACHE[function_dump]
+    except KeyError:
+        function = _FUNCTION_CACHE.setdefault(function_dump, pickle.loads(function_dump))
+
+    return function(**job_args)
 
 
 class LSFJob(object):
 
     devnull = open("/dev/null", 'w')
 
-    def __init__(self, id, name):
+    def __init__(self, id, name, bjobs="bjobs"):
         self.id = id
         self.name = name
+
+        # command used to check the queue when no poller is tracking the job
+        self.bjobs = bjobs
         
         self.status = None
 
 
         self.results = None
+        self.lsf_id = None
         self.command = None
         self.stdout = None
         self.stderr = None
 
+        # set by an LSFStatusPoller if one is tracking this job
+        self.future = None
+
     def update_status(self):
-        """ Sets the job status by querying bjobs """
+        """ Sets the job status from the poller if there is one, otherwise by querying bjobs """
 
+        if self.future is not None:
+            if self.future.done():
+                status = self.future.result()
+            else:
+                status = "in progress"
 
         # check if job is still pending/running
-        if self._is_in_queue():
+        elif self._is_in_queue():
             status = "in progress"
 
         else:
@@ -371,12 +559,24 @@ class LSFJob(object):
         LOG.debug("Updating job '{}' status to '{}'".format(self.id, status))
         self.status = status
 
+    def status_from_log(self):
+        """ Returns the status written to the stdout log by LSF or None if it isn't there yet """
+        if self.stdout is None or not os.path.isfile(self.stdout):
+            return None
+
+        with open(self.stdout, 'r') as IN:
+            for line in IN:
+                if line == "Successfully completed.\n":
+                    return "completed"
+                elif line.startswith("Exited with exit code"):
+                    return "exited"
+
+        return None
 
     def _is_in_queue(self):
         """ Returns True if the job is in the queue; False otherwise """
 
-        output = subprocess.check_output([
-                    "bjobs",
+        output = subprocess.check_output(self.bjobs.split(" ") + [
                     "-J", "{job_name}".format(job_name=self.name)
                 ], stderr=self.devnull)  
 
@@ -386,6 +586,30 @@ class LSFJob(object):
             return False
 
 
+class LocalJob(object):
+    """ A job running in a LocalExecutor pool. Has the same status values as an LSFJob """
+
+    def __init__(self, id, name, future):
+        self.id = id
+        self.name = name
+        self.future = future
+
+        self.status = None
+
+    def update_status(self):
+        """ Sets the job status from the state of the future """
+        if not self.future.done():
+            status = "in progress"
+        elif self.future.exception() is not None:
+            LOG.error("Job '{}' raised: {}".format(self.id, repr(self.future.exception())))
+            status = "exited"
+        else:
+            status = "completed"
+
+        LOG.debug("Updating job '{}' status to '{}'".format(self.id, status))
+        self.status = status
+
+
 class ClassParallelizer(object):
     """ 
     Acts as an interface to break a class out of a program for parallel processing like a rough MPI.
@@ -1,31 +1,26 @@
-
 import re
 import sys
+import time
+import argparse
+import functools
+import numpy as np
 
-def parse(sam_fh, aligned_only=False, mapq=1, local=False):
-    for line in sam_fh:
-        if line.startswith("@"):
-            continue
-        # store all the basic sam attributes
-        aln_dict = {k: v for k, v in zip(['qname', 'flag', 'rname', 'pos', 'mapq', 'cigar', 'rnext', 'pnext', 'tlen', 'seq', 'qual'], line[:-1].split('\t')[:11])}
+# SAM 1.4 cigar operations in the column order used by SamBatch.cigar_ops
+CIGAR_OPS = "MIDNSHP=X"
 
-        aln_dict['pos'] = int(aln_dict['pos'])
-        aln_dict['mapq'] = int(aln_dict['mapq'])
-        aln_dict['flag'] = int(aln_dict['flag'])
+_NM_RE = re.compile(r"(?:^|\t)NM:i:(-?\d+)")
+_CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=X])")
 
-        # store the optional attribs
-        attrib_dict = {}
-        for attrib in line[:-1].split("\t")[11:]:
-            name, type, value = attrib.split(":")
+# number of distinct cigar strings to keep decoded; amplicon/split read mappings
+# reuse a few hundred strings so this is mostly to bound pathological inputs
+CIGAR_CACHE_SIZE = 2**16
 
-            if type == "f":
-                attrib_dict[name] = float(value)
-            elif type == "i":
-                attrib_dict[name] = int(value)
-            else:
-                attrib_dict[name] = value
 
-        aln_dict["attributes"] = attrib_dict
+def parse(sam_fh, aligned_only=False, mapq=1, local=False):
+    for line in sam_fh:
+        if line.startswith("@"):
+            continue
+        aln_dict = _line_to_dict(line)
 
         if aligned_only:
             if aln_dict['flag'] in [4, 516]:
@@ -36,6 +31,140 @@ def parse(sam_fh, aligned_only=False, mapq=1, local=False):
 
         yield SamRecord(aln_dict, local)
 
+def _line_to_dict(line):
+    """ Converts a single SAM line to the dict used to initialize a SamRecord """
+    # store all the basic sam attributes
+    aln_dict = {k: v for k, v in zip(['qname', 'flag', 'rname', 'pos', 'mapq', 'cigar', 'rnext', 'pnext', 'tlen', 'seq', 'qual'], line[:-1].split('\t')[:11])}
+
+    aln_dict['pos'] = int(aln_dict['pos'])
+    aln_dict['mapq'] = int(aln_dict['mapq'])
+    aln_dict['flag'] = int(aln_dict['flag'])
+
+    # store the optional attribs
+    attrib_dict = {}
+    for attrib in line[:-1].split("\t")[11:]:
+        name, type, value = attrib.split(":")
+
+        if type == "f":
+            attrib_dict[name] = float(value)
+        elif type == "i":
+            attrib_dict[name] = int(value)
+        else:
+            attrib_dict[name] = value
+
+    aln_dict["attributes"] = attrib_dict
+
+    return aln_dict
+
+@functools.lru_cache(maxsize=CIGAR_CACHE_SIZE)
+def cigar_op_counts(cigar):
+    """ Returns a tuple with the total length of each op in CIGAR_OPS. '*' (no alignment) is all zeros. """
+    counts = [0] * len(CIGAR_OPS)
+    if cigar == "*":
+        return tuple(counts)
+
+    m = _CIGAR_RE.findall(cigar)
+    if not m:
+        raise ValueError("Cigar string {} could not be parsed. It may be malformed.".format(cigar))
+
+    for count, op in m:
+        counts[CIGAR_OPS.index(op)] += int(count)
+
+    return tuple(counts)
+
+@functools.lru_cache(maxsize=CIGAR_CACHE_SIZE)
+def decode_cigar(cigar):
+    """ 
+    Returns (length, matches, mismatches, soft_clipped, indels) for a cigar string.
+
+    matches and mismatches are None for old style (M only) cigars because they need 
+    the edit distance of the record to be calculated.
+    """
+    if cigar == "*":
+        raise ValueError("Cigar string {} could not be parsed. It may be malformed.".format(cigar))
+
+    counts = dict(zip(CIGAR_OPS, cigar_op_counts(cigar)))
+    length = sum(counts.values())
+    indels = counts["I"] + counts["D"]
+
+    # check for format 1.4
+    if "=" in cigar:
+        return length, counts["="], counts["X"], counts["S"], indels
+    else:
+        return length, None, None, counts["S"], indels
+
+def decode_cigars(cigars, nm=None, local=False):
+    """ 
+    Batch version of decode_cigar for a whole column of cigars. Each distinct string is
+    decoded once (and through the cache).
+
+    nm is an array of edit distances (-1 for missing) needed for old style cigars.
+
+    Returns arrays of (length, matches, mismatches, soft_clipped). Rows with a '*' cigar are all 0.
+    """
+    uniques = {}
+    inverse = np.fromiter((uniques.setdefault(c, len(uniques)) for c in cigars), dtype=np.int64, count=len(cigars))
+
+    table = np.zeros((len(uniques), 5), dtype=np.int64)
+    old_style = np.zeros(len(uniques), dtype=bool)
+    for c, indx in uniques.items():
+        if c == "*":
+            continue
+
+        length, matches, mismatches, soft_clipped, indels = decode_cigar(c)
+        if matches is None:
+            old_style[indx] = True
+            table[indx] = (length, 0, 0, soft_clipped, indels)
+        else:
+            table[indx] = (length, matches, mismatches, soft_clipped, indels)
+
+    table = table[inverse]
+    old_style = old_style[inverse]
+
+    soft_clipped = table[:, 3]
+    if local:
+        length = table[:, 0] - soft_clipped
+    else:
+        length = table[:, 0]
+
+    matches = table[:, 1]
+    mismatches = table[:, 2]
+
+    if old_style.any():
+        if nm is None or (nm[old_style] < 0).any():
+            raise ValueError("Entry doesn't have the edit distance field 'NM' and is in the old style SAM format. It is impossible to calculate mismatches.")
+
+        # mismatches is the edit distance - insertions and deletions
+        mismatches[old_style] = nm[old_style] - table[old_style, 4]
+        matches[old_style] = length[old_style] - nm[old_style]
+
+    return length, matches, mismatches, soft_clipped
+
+def parse_batches(sam_fh, aligned_only=False, mapq=1, local=False, block_size=2**24):
+    """ 
+    Columnar version of parse. Reads the SAM file in blocks of ~block_size bytes and 
+    yields a SamBatch for each block with the same filters as parse applied as whole 
+    array masks.
+    
+    SamRecord objects are only built if they are requested from the batch.
+    """
+    while True:
+        lines = sam_fh.readlines(block_size)
+        if not lines:
+            return
+
+        batch = SamBatch.from_lines([line for line in lines if not line.startswith("@")], local)
+
+        keep = batch.mapq >= mapq
+        if aligned_only:
+            keep &= (batch.flag != 4) & (batch.flag != 516)
+
+        if not keep.all():
+            batch = batch.filter(keep)
+
+        if len(batch):
+            yield batch
+
 def parse_headers(sam_fh):
     headers = {'seqs': {}}
     for line in sam_fh:
@@ -50,6 +179,117 @@ def parse_headers(sam_fh):
             return headers
 
 
+class SamBatch(object):
+    """
+    A block of SAM records stored as column arrays.
+
+    Filtering is done on whole arrays (Ex: batch.filter(batch.mapq >= 20)) and 
+    SamRecord objects are only made for the rows that are asked for.
+    """
+
+    def __init__(self, lines, qname, flag, rname, pos, mapq, cigar, cigar_ops, nm, local=False):
+        self.lines = lines
+        self.qname = qname
+        self.flag = flag
+        self.rname = rname
+        self.pos = pos
+        self.mapq = mapq
+        self.cigar = cigar
+        # one row per record, one column per op in CIGAR_OPS
+        self.cigar_ops = cigar_ops
+        # edit distance; -1 if the record doesn't have an NM field
+        self.nm = nm
+
+        self.local = local
+
+        # hidden attribute to hold the decoded cigar columns
+        self._cigar_stats = None
+
+    @classmethod
+    def from_lines(cls, lines, local=False):
+        """ Builds a batch from a list of (non-header) SAM lines """
+        n = len(lines)
+        rows = [line.rstrip("\n").split("\t", 11) for line in lines]
+
+        qname = np.array([r[0] for r in rows], dtype=object)
+        flag = np.fromiter((int(r[1]) for r in rows), dtype=np.int32, count=n)
+        rname = np.array([r[2] for r in rows], dtype=object)
+        pos = np.fromiter((int(r[3]) for r in rows), dtype=np.int64, count=n)
+        mapq = np.fromiter((int(r[4]) for r in rows), dtype=np.int32, count=n)
+        cigar = np.array([r[5] for r in rows], dtype=object)
+
+        nm = np.full(n, -1, dtype=np.int64)
+        for indx, r in enumerate(rows):
+            if len(r) == 12:
+                m = _NM_RE.search(r[11])
+                if m:
+                    nm[indx] = int(m.group(1))
+
+        return cls(np.array(lines, dtype=object), qname, flag, rname, pos, mapq, cigar, cls._count_cigar_ops(cigar), nm, local)
+
+    @staticmethod
+    def _count_cigar_ops(cigars):
+        """ Returns an (n, 9) array of op lengths; each distinct cigar is only decoded once """
+        uniques = {}
+        inverse = np.fromiter((uniques.setdefault(c, len(uniques)) for c in cigars), dtype=np.int64, count=len(cigars))
+
+        table = np.array([cigar_op_counts(c) for c in uniques], dtype=np.int64).reshape(-1, len(CIGAR_OPS))
+
+        return table[inverse]
+
+    def __len__(self):
+        return len(self.flag)
+
+    @property
+    def mapped(self):
+        return self.flag != 4
+
+    @property
+    def soft_clipped(self):
+        return self.cigar_ops[:, CIGAR_OPS.index("S")]
+
+    @property
+    def length(self):
+        length = self.cigar_ops.sum(axis=1)
+        if self.local:
+            return length - self.soft_clipped
+        else:
+            return length
+
+    @property
+    def matches(self):
+        return self._get_cigar_stats()[1]
+
+    @property
+    def mismatches(self):
+        return self._get_cigar_stats()[2]
+
+    @property
+    def perc_id(self):
+        length, matches = self._get_cigar_stats()[:2]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(length > 0, matches / length, 0.0)
+
+    def _get_cigar_stats(self):
+        if self._cigar_stats is None:
+            self._cigar_stats = decode_cigars(self.cigar, self.nm, self.local)
+
+        return self._cigar_stats
+
+    def filter(self, mask):
+        """ Returns a new batch with only the rows where mask is True (or the rows at the given indices) """
+        return SamBatch(self.lines[mask], self.qname[mask], self.flag[mask], self.rname[mask], self.pos[mask], self.mapq[mask], self.cigar[mask], self.cigar_ops[mask], self.nm[mask], self.local)
+
+    def get_record(self, indx):
+        """ Returns a SamRecord view of a single row """
+        return SamRecord(_line_to_dict(self.lines[indx]), self.local)
+
+    def records(self):
+        """ Yields a SamRecord for each row """
+        for indx in range(len(self)):
+            yield self.get_record(indx)
+
+
 class SamRecord(object):
     """ 
     A single read in a SAM file
@@ -135,25 +375,15 @@ class SamRecord(object):
         self._perc_id = value
 
     def _parse_cigar(self):
-        cigar_stats = {k: 0 for k in ['M', 'I', 'D', 'N', 'S', 'H', 'P', '=', 'X']}
-        length = 0
-        m = re.findall("(\d+[MIDNSHP=X])", self.cigar)
-        if m:
-                
-            for group in m:
-                cigar_stats[group[-1]] = cigar_stats.get(group[-1], 0) + int(group[:-1])
-                length += int(group[:-1])
-                
-            self.length = length
-            self.soft_clipped = cigar_stats['S']
-                    
-        else:
-            raise ValueError("Cigar string {} could not be parsed. It may be malformed.".format(self.cigar))
-        
+        length, matches, mismatches, soft_clipped, indels = decode_cigar(self.cigar)
+
+        self.length = length
+        self.soft_clipped = soft_clipped
+
         # check for format 1.4
-        if "=" in self.cigar:
-            self.matches = cigar_stats['=']
-            self.mismatches = cigar_stats['X']
+        if matches is not None:
+            self.matches = matches
+            self.mismatches = mismatches
         else:   # old format
             # we can get something like mismatches from the edit distance
             try:
@@ -162,5 +392,35 @@ class SamRecord(object):
                 raise ValueError("Entry doesn't have the edit distance field 'NM' and is in the old style SAM format. It is impossible to calculate mismatches.")
 
             # mismatches is the edit distance - insertions and deletions
-            self.mismatches = edit_dist - (cigar_stats["I"] + cigar_stats["D"])
+            self.mismatches = edit_dist - indels
             self.matches = self.length - edit_dist
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the per-line SAM parser against the columnar block parser.")
+    parser.add_argument("-sam", help="SAM file to parse", required=True)
+    parser.add_argument("-mapq", help="minimum mapq [%(default)s]", type=int, default=1)
+    parser.add_argument("-min_id", help="minimum percent id (as a fraction) for an alignment to be counted [%(default)s]", type=float, default=.9)
+    parser.add_argument("-block_size", help="bytes to read per block for the columnar parser [%(default)s]", type=int, default=2**24)
+    args = parser.parse_args()
+
+    start = time.time()
+    records = 0
+    total_length = 0
+    with open(args.sam, 'r') as IN:
+        for record in parse(IN, aligned_only=True, mapq=args.mapq):
+            if record.perc_id >= args.min_id:
+                records += 1
+                total_length += record.length
+    per_line = time.time() - start
+    print("parse:          {} records; {} bp aligned; {:.2f}s ({:.0f} records/s)".format(records, total_length, per_line, records / per_line if per_line else 0))
+
+    start = time.time()
+    records = 0
+    total_length = 0
+    with open(args.sam, 'r') as IN:
+        for batch in parse_batches(IN, aligned_only=True, mapq=args.mapq, block_size=args.block_size):
+            keep = batch.perc_id >= args.min_id
+            records += int(keep.sum())
+            total_length += int(batch.length[keep].sum())
+    columnar = time.time() - start
+    print("parse_batches:  {} records; {} bp aligned; {:.2f}s ({:.0f} records/s)".format(records, total_length, columnar, records / columnar if columnar else 0))
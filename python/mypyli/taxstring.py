@@ -15,17 +15,152 @@ import re
 import difflib
 from Bio import Entrez
 import sys
+import os
+import json
+import sqlite3
+from mypyli import taxtree
+
+
+class TaxResolver(object):
+    """
+    Resolves taxids and tax names to taxonomy dicts for TaxString without going to NCBI.
+
+    Lookups are answered from a local TaxTree (a pickle, binary tree or one built from the 
+    NCBI dumps with taxtree.py). Anything the tree can't answer is looked up with Entrez 
+    (unless entrez=False) and the answer is stored in a sqlite cache so nothing is fetched twice,
+    even across runs.
+
+    Usage:
+        resolver = TaxResolver(tree="taxtree.pickle", cache_db="entrez_cache.sqlite")
+        TaxString.set_default_resolver(resolver)
+        tax = TaxString("1747", is_id=True, lookup=True)
+    """
+
+    def __init__(self, tree=None, cache_db=None, entrez=True, email='hjcamero@live.unc.edu'):
+        if isinstance(tree, str):
+            tree = taxtree.TaxTree.load_tree(tree)
+
+        self.tree = tree
+        self.entrez = entrez
+        self.email = email
+
+        self.cache = None
+        if cache_db:
+            self.cache = sqlite3.connect(cache_db)
+            self.cache.execute("CREATE TABLE IF NOT EXISTS entrez_lookups (query TEXT PRIMARY KEY, taxid TEXT, parent TEXT, taxonomy TEXT)")
+            self.cache.commit()
+
+    @staticmethod
+    def _node_to_taxdict(node):
+        """ Returns a tax dict (rank: name) like the one made from an Entrez record """
+        tax_dict = {}
+        for rank, name in node.get_taxonomy():
+            if rank == "superkingdom":
+                rank = "kingdom"
+            elif rank in ["no rank", "root"]:
+                continue
+
+            tax_dict[rank] = name
+
+        parent_id = node.parent.taxid if node.parent else None
+
+        return tax_dict, parent_id
+
+    def _from_cache(self, query):
+        if self.cache is None:
+            return None
+
+        row = self.cache.execute("SELECT taxid, parent, taxonomy FROM entrez_lookups WHERE query = ?", (query,)).fetchone()
+        if row is None:
+            return None
+        else:
+            return json.loads(row[2]), row[0], row[1]
+
+    def _to_cache(self, query, tax_dict, taxid, parent_id):
+        if self.cache is not None:
+            self.cache.execute("INSERT OR REPLACE INTO entrez_lookups VALUES (?, ?, ?, ?)", (query, taxid, parent_id, json.dumps(tax_dict)))
+            self.cache.commit()
+
+    def _tree_lookup(self, method, *args):
+        """ Calls a TaxTree lookup method; returns None if there is no tree or the lookup fails """
+        if self.tree is None:
+            return None
+
+        try:
+            return getattr(self.tree, method)(*args)
+        # the object tree raises a plain Exception for a missing taxstring
+        except Exception:
+            return None
+
+    def resolve_taxid(self, taxid):
+        """ Returns (tax_dict, parent_id) for a taxid """
+        taxid = str(taxid)
+
+        node = self._tree_lookup("lookup_taxid", taxid)
+        if node is not None:
+            return self._node_to_taxdict(node)
+
+        cached = self._from_cache("taxid:" + taxid)
+        if cached:
+            return cached[0], cached[2]
+
+        if not self.entrez:
+            raise LookupError("Taxid {} is not in the tree and Entrez lookups are off.".format(taxid))
+
+        tax_dict, parent_id = TaxString._taxid_to_taxdict(taxid, email=self.email)
+        self._to_cache("taxid:" + taxid, tax_dict, taxid, parent_id)
+
+        return tax_dict, parent_id
+
+    def resolve_name(self, tax):
+        """ Returns (tax_dict, taxid, parent_id) for a tax name or tax string (using its lowest element) """
+        tax = tax.split(";")[-1].strip()
+
+        # a rank prefix (k__Bacteria) narrows the tree lookup to that rank
+        if "__" in tax:
+            node = self._tree_lookup("lookup_taxstring", tax)
+        else:
+            node = self._tree_lookup("lookup_single_tax", tax)
+
+        if node is not None:
+            tax_dict, parent_id = self._node_to_taxdict(node)
+            return tax_dict, node.taxid, parent_id
+
+        cached = self._from_cache("name:" + tax)
+        if cached:
+            return cached
+
+        if not self.entrez:
+            raise LookupError("Tax {} is not in the tree and Entrez lookups are off.".format(tax))
+
+        tax_dict, taxid, parent_id = TaxString._tax_string_to_tax_dict(tax, self.email)
+        self._to_cache("name:" + tax, tax_dict, taxid, parent_id)
+
+        return tax_dict, taxid, parent_id
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
 
 class TaxString(object):
 
-    
+    # used for lookups instead of Entrez when set
+    resolver = None
+
+    @classmethod
+    def set_default_resolver(cls, resolver):
+        """ Sets the TaxResolver used for lookups by all TaxStrings """
+        cls.resolver = resolver
+
 
     @classmethod
     def _tax_string_to_tax_dict(cls, tax, email):
         
         # if tax is a full/partial string, get only lowest element
         if ";" in tax:
-            tax = tax.split[";"][-1]
+            tax = tax.split(";")[-1].strip()
         
         # if tax string is in the format: k__Bacteria; p__abcdef, get rank to use later
         if "__" in tax:
@@ -209,11 +344,17 @@ class TaxString(object):
             return "Never"
 
 
-    def __init__(self, tax="", is_id=False, name="", lookup=False, email=''):
+    def __init__(self, tax="", is_id=False, name="", lookup=False, email='', resolver=None):
     
+        resolver = resolver or self.resolver
 
-
-        if lookup:
+        if lookup and resolver:
+            if is_id:
+                self.taxid = tax
+                self.taxonomy, self.parent = resolver.resolve_taxid(tax)
+            else:
+                self.taxonomy, self.taxid, self.parent = resolver.resolve_name(tax)
+        elif lookup:
             if is_id:
                 self.taxid = tax
                 self.taxonomy, self.parent = self._taxid_to_taxdict(tax)
@@ -294,8 +435,31 @@ class TaxString(object):
             else:
                 raise AssertionError("No entry for rank: '{}' in entry: '{}'".format(rank, self.name))
 
-    def get_LCA(self, other):
-        """ Returns a tuple (rank, name) for the lowest common ancestor between two """
+    def _tree_node(self, tree):
+        """ Returns the node for this TaxString in a TaxTree, by taxid when known """
+        if self.taxid:
+            return tree.lookup_taxid(str(self.taxid))
+        else:
+            return tree.lookup_taxstring(self.get_tax_string())
+
+    def get_LCA(self, other, tree=None):
+        """ 
+        Returns a tuple (rank, name) for the lowest common ancestor between two 
+
+        If a TaxTree is given, the LCA comes from the tree's ancestor index instead of
+        comparing the taxonomy dicts (and nothing is looked up with Entrez).
+        """
+        if tree is not None:
+            lca = tree.lca(self._tree_node(tree), other._tree_node(tree))
+
+            # report the LCA at the first standard rank at or above it
+            while lca is not None:
+                if lca.rank in ["species", "genus", "family", "class", "order", "phylum", "kingdom"]:
+                    return lca.rank, lca.name
+                lca = lca.parent
+
+            return None, None
+
         tax1 = self.get_taxonomy()
         tax2 = other.get_taxonomy()
 
@@ -6,15 +6,37 @@ import argparse
 import re
 import difflib
 import pickle
+import time
+import json
+import mmap
+import numpy as np
 from Bio import Entrez
+from collections import OrderedDict
 import re
 
+try:
+    from collections.abc import Mapping
+except ImportError:     # py2
+    from collections import Mapping
+
+try:
+    import resource
+except ImportError:     # not available on windows
+    resource = None
+
+
+# first bytes of a binary (memory-mappable) CompactTaxTree file
+BINARY_MAGIC = b"MYPYTAX1"
+
 
 class TaxTree(object):
     """ A class to manage taxonomic relationships by acting as a container for TaxNode objects """
    
     taxRanks = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]
     taxRanksEx = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]
+
+    # max number of entries in each of the lineage and tax string caches
+    cache_size = 2**18
    
     def __init__(self, remote=False, email=None):
         self.taxnodes = {}
@@ -31,9 +53,13 @@ class TaxTree(object):
     # TREE UTILTY METHODS
     @classmethod
     def load_tree(cls, filename):
-        """ Loads and returns a pickled TaxTree """
+        """ Loads and returns a pickled TaxTree (or opens a binary CompactTaxTree) """
         with open(filename, 'rb') as IN:
-            tree = pickle.load(IN)
+            if IN.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+                tree = CompactTaxTree.open_binary(filename)
+            else:
+                IN.seek(0)
+                tree = pickle.load(IN)
         
         Entrez.email = tree.email
 
@@ -75,6 +101,123 @@ class TaxTree(object):
         else:
             self.taxnodes[taxnode.taxid] = taxnode
 
+            # the ancestor index no longer covers every node
+            self._ancestor_index = None
+            self.clear_caches()
+
+    def __getstate__(self):
+        # the ancestor index and caches are rebuilt when needed rather than stored
+        state = self.__dict__.copy()
+        for key in ["_ancestor_index", "_index_rows", "_index_nodes", "_lineage_cache", "_tax_string_cache"]:
+            state.pop(key, None)
+        return state
+
+    # CACHE METHODS
+
+    def clear_caches(self):
+        """ Empties the lineage and tax string caches. Needed if nodes are changed after they are added. """
+        self._lineage_cache = None
+        self._tax_string_cache = None
+
+    def _get_cache(self, name):
+        cache = getattr(self, name, None)
+        if cache is None:
+            cache = _BoundedCache(self.cache_size)
+            setattr(self, name, cache)
+
+        return cache
+
+    def get_lineage(self, node):
+        """ 
+        Returns the lineage of a node as a tuple of (rank, name) tuples from the root down.
+
+        Lineages are cached by taxid and built from the closest cached ancestor.
+        """
+        cache = self._get_cache("_lineage_cache")
+
+        # walk up until an ancestor with a known lineage
+        path = []
+        lineage = ()
+        while node is not None:
+            cached = cache.get(node.taxid)
+            if cached is not None:
+                lineage = cached
+                break
+            path.append(node)
+            node = node.parent
+
+        for node in reversed(path):
+            lineage = lineage + ((node.rank, node.name),)
+            cache.put(node.taxid, lineage)
+
+        return lineage
+
+    def get_tax_strings(self, taxids, missing=None, **kwargs):
+        """ 
+        Returns a list of tax strings for a list of taxids (kwargs are passed to TaxNode.get_tax_string).
+        
+        Each distinct taxid is looked up once; taxids not in the tree get the missing value.
+        """
+        tax_strings = {}
+        for taxid in taxids:
+            if taxid not in tax_strings:
+                try:
+                    tax_strings[taxid] = self.lookup_taxid(taxid).get_tax_string(**kwargs)
+                except KeyError:
+                    tax_strings[taxid] = missing
+
+        return [tax_strings[taxid] for taxid in taxids]
+
+    # ANCESTOR INDEX METHODS
+
+    def get_ancestor_index(self):
+        """ Returns the AncestorIndex of the tree, building it on first use (or after nodes were added) """
+        if getattr(self, "_ancestor_index", None) is None:
+            self._ancestor_index = self._build_ancestor_index()
+
+        return self._ancestor_index
+
+    def _build_ancestor_index(self):
+        self._index_nodes = list(self.taxnodes.values())
+        self._index_rows = {node.taxid: row for row, node in enumerate(self._index_nodes)}
+        parents = np.fromiter((self._index_rows[node.parent.taxid] if node.parent else -1 for node in self._index_nodes), dtype=np.int64, count=len(self._index_nodes))
+
+        return AncestorIndex(parents)
+
+    def _index_row(self, node):
+        """ Returns the ancestor index row of a TaxNode or taxid """
+        if isinstance(node, TaxNode):
+            return self._index_rows[node.taxid]
+        else:
+            return self._index_rows[str(node)]
+
+    def _index_node(self, row):
+        return self._index_nodes[row]
+
+    def subtree_interval(self, node):
+        """ 
+        Returns the pre-order (entry, exit) of a node (or taxid). A node is in its subtree
+        (or is the node itself) if entry <= its entry < exit.
+        """
+        index = self.get_ancestor_index()
+        row = self._index_row(node)
+
+        return int(index.entry[row]), int(index.exit[row])
+
+    def lca(self, node1, node2):
+        """ Returns the lowest common ancestor of two nodes (or taxids) in O(1). None if they don't share a root. """
+        index = self.get_ancestor_index()
+        row = index.lca(self._index_row(node1), self._index_row(node2))
+
+        return None if row < 0 else self._index_node(row)
+
+    def lca_many(self, nodes):
+        """ Returns the lowest common ancestor of any number of nodes (or taxids) in O(k). None if they don't share a root. """
+        index = self.get_ancestor_index()
+        row = index.lca_many([self._index_row(node) for node in nodes])
+
+        return None if row < 0 else self._index_node(row)
+
     # TREE LOOKUP METHODS
 
     def lookup_taxid(self, taxid):
@@ -310,7 +453,7 @@ class TaxNode(object):
         """ Sets the tree for all TaxNodes """
         cls.taxTree = tree
 
-    def __init__(self, taxid, name, rank, parent, children=[], taxtree=""):
+    def __init__(self, taxid, name, rank, parent, children=None, taxtree=""):
 
         # set the instance tree to the class TaxTree unless other is specified
         if taxtree:
@@ -328,7 +471,8 @@ class TaxNode(object):
         self.name = name
         self.rank = rank
         self.parent = parent
-        self.children = children
+        # each node needs its own list (a [] default would be shared by every node)
+        self.children = children if children is not None else []
 
         self.add_node_to_tree()
 
@@ -352,16 +496,7 @@ class TaxNode(object):
         """ Returns an array of tuples with each tuple containing the rank and name of a step in the lineage. 
         I picked array over dict because several of the entries don't have a rank and would have used the same key.
         """
-        # populate an array with all the lineage information
-        tax_ranks = [(self.rank, self.name)]
-        parent = self.parent
-        while parent:
-
-            tax_ranks = [(parent.rank, parent.name)] + tax_ranks
-
-            parent = parent.parent
-
-        return tax_ranks
+        return list(self.taxtree.get_lineage(self))
 
     def get_tax_string(self, extended=False, trim_to=None, truncate=True, include_root=False):
         """ 
@@ -374,14 +509,26 @@ class TaxNode(object):
                 include_root - include the root (Ex: root; k_Bacteria...)
 
             For example, to display a tax string at the genus level do: truncate=False, trim_to="genus".
+
+            Tax strings are cached on the tree for each combination of options.
         """
+        cache = self.taxtree._get_cache("_tax_string_cache")
+        key = (self.taxid, extended, trim_to, truncate, include_root)
+
+        tax_string = cache.get(key)
+        if tax_string is None:
+            tax_string = self._build_tax_string(extended, trim_to, truncate, include_root)
+            cache.put(key, tax_string)
 
+        return tax_string
+
+    def _build_tax_string(self, extended, trim_to, truncate, include_root):
         if extended:
             t_ranks = self.taxRanksEx
         else:
             t_ranks = self.taxRanks
   
-        taxonomy = self.get_taxonomy()
+        taxonomy = self.taxtree.get_lineage(self)
         
         #
         ## Now, I need some way to convert from a list of tuples to a dict or something I can order
@@ -428,14 +575,13 @@ class TaxNode(object):
         return "; ".join(tax_lst)
 
     def is_ancestor_of(self, tax_node):
-        """ Checks if node(self) is the parent of another node(tax_node) at any level in the ancestry """
-        parent = tax_node.parent
-
-        while parent:
-            if parent == self:
-                return True
-            parent = parent.parent
-        return False
+        """ 
+        Checks if node(self) is the parent of another node(tax_node) at any level in the ancestry 
+        
+        Uses the tree's ancestor index so this is just two integer comparisons.
+        """
+        tree = self.taxtree
+        return tree.get_ancestor_index().is_ancestor(tree._index_row(self), tree._index_row(tax_node))
 
     def get_tax_at_rank(self, rank, null=None):
         """ 
@@ -448,7 +594,7 @@ class TaxNode(object):
         if rank == "domain":
             rank = "kingdom"
 
-        for r, name in self.get_taxonomy():
+        for r, name in self.taxtree.get_lineage(self):
             if r == rank:
                 return name
         else:
@@ -458,6 +604,528 @@ class TaxNode(object):
                 return null
 
 
+class CompactTaxTree(TaxTree):
+    """ 
+    A TaxTree that stores its nodes as parallel numpy arrays instead of TaxNode objects.
+
+    Each node is a row index. The arrays are:
+        taxids      - taxid of each row
+        parents     - row of the parent (-1 for the root)
+        rank_codes  - index into rank_names
+        name_offsets- byte offsets into name_pool (row i's name is name_pool[name_offsets[i]:name_offsets[i+1]])
+
+    Lookups by name and by (name, rank) go through hash indexes that are built on first use.
+    Nodes are returned as TaxNodeView objects that support the TaxNode methods.
+
+    The tree can also be saved in a binary format (save_binary) that is opened with mmap
+    (open_binary or TaxTree.load_tree). Then the arrays are read straight from the page 
+    cache, so opening is nearly instant and every process on a node shares the same memory.
+    """
+
+    # sections of the binary format in the order they are written: (name, dtype)
+    BINARY_SECTIONS = [
+            ("taxids", "<i8"),
+            ("parents", "<i4"),
+            ("rank_codes", "<i2"),
+            ("name_offsets", "<i8"),
+            ("_row_of", "<i4"),
+            ("_child_offsets", "<i8"),
+            ("_child_rows", "<i4"),
+            ("name_pool", "|u1")
+            ]
+
+    def __init__(self, taxids, parents, rank_codes, rank_names, name_offsets, name_pool, remote=False, email=None):
+        super(CompactTaxTree, self).__init__(remote, email)
+
+        self.taxids = taxids
+        self.parents = parents
+        self.rank_codes = rank_codes
+        self.rank_names = rank_names
+        self.name_offsets = name_offsets
+        self.name_pool = name_pool
+
+        self._setup_indexes()
+
+    @classmethod
+    def from_lists(cls, taxids, parent_taxids, ranks, names, remote=False, email=None):
+        """ 
+        Builds a tree from parallel lists of taxids, parent taxids, ranks and names. 
+        
+        The root is the entry whose parent taxid is None (or not in taxids).
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+
+        # dense map from taxid to row to convert parent taxids to rows
+        row_of = np.full(int(taxids.max()) + 1, -1, dtype=np.int32)
+        row_of[taxids] = np.arange(len(taxids), dtype=np.int32)
+
+        parents = np.full(len(taxids), -1, dtype=np.int32)
+        for indx, parent in enumerate(parent_taxids):
+            if parent is not None and int(parent) < len(row_of):
+                parents[indx] = row_of[int(parent)]
+
+        rank_names = sorted(set(ranks))
+        rank_lookup = {rank: code for code, rank in enumerate(rank_names)}
+        rank_codes = np.fromiter((rank_lookup[rank] for rank in ranks), dtype=np.int16, count=len(ranks))
+
+        encoded = [name.encode("utf-8") for name in names]
+        name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+
+        return cls(taxids, parents, rank_codes, rank_names, name_offsets, b"".join(encoded), remote, email)
+
+    @classmethod
+    def from_tree(cls, tree):
+        """ Converts a TaxTree made of TaxNode objects to a CompactTaxTree """
+        taxids = []
+        parents = []
+        ranks = []
+        names = []
+        for node in tree.taxnodes.values():
+            taxids.append(int(node.taxid))
+            parents.append(node.parent.taxid if node.parent else None)
+            ranks.append(node.rank)
+            names.append(node.name)
+
+        return cls.from_lists(taxids, parents, ranks, names, tree.remote, tree.email)
+
+    def _setup_indexes(self, stored=None):
+        """ (Re)makes the indexes that aren't stored with the tree; stored is a dict of already made ones """
+        self.taxnodes = _CompactNodeMap(self)
+
+        # hash and ancestor indexes are built lazily
+        self._name_index = None
+        self._name_rank_index = None
+        self._ancestor_index = None
+
+        if stored:
+            self.__dict__.update(stored)
+            return
+
+        self._row_of = np.full(int(self.taxids.max()) + 1, -1, dtype=np.int32)
+        self._row_of[self.taxids] = np.arange(len(self.taxids), dtype=np.int32)
+
+        # children as CSR arrays: children of row i are _child_rows[_child_offsets[i]:_child_offsets[i+1]]
+        has_parent = self.parents >= 0
+        self._child_rows = np.flatnonzero(has_parent)[np.argsort(self.parents[has_parent], kind="stable")].astype(np.int32)
+        counts = np.bincount(self.parents[has_parent], minlength=len(self.taxids))
+        self._child_offsets = np.zeros(len(self.taxids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._child_offsets[1:])
+
+    def __getstate__(self):
+        # only store the arrays, the indexes are rebuilt on load
+        state = self.__dict__.copy()
+        for key in ["taxnodes", "_row_of", "_child_rows", "_child_offsets", "_name_index", "_name_rank_index", "_mmap", "_ancestor_index", "_lineage_cache", "_tax_string_cache"]:
+            state.pop(key, None)
+
+        # a name pool from an mmap'd file is a memoryview which can't be pickled
+        state["name_pool"] = bytes(state["name_pool"])
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup_indexes()
+
+    def __len__(self):
+        return len(self.taxids)
+
+    # BINARY FORMAT METHODS
+
+    def save_binary(self, filename):
+        """ 
+        Saves the tree in the binary format. Can be opened with CompactTaxTree.open_binary or TaxTree.load_tree
+
+        Layout: magic, 8 byte header length, JSON header, then each section in BINARY_SECTIONS 
+        as a fixed-width little endian array starting on an 8 byte boundary.
+        """
+        arrays = []
+        sections = {}
+        offset = 0
+        for name, dtype in self.BINARY_SECTIONS:
+            if name == "name_pool":
+                array = np.frombuffer(bytes(self.name_pool), dtype=dtype)
+            else:
+                array = np.ascontiguousarray(getattr(self, name), dtype=dtype)
+
+            sections[name] = [offset, dtype, len(array)]
+            arrays.append(array)
+            offset = _align8(offset + array.nbytes)
+
+        header = json.dumps({'rank_names': self.rank_names, 'remote': self.remote, 'email': self.email, 'sections': sections}).encode("utf-8")
+
+        with open(filename, 'wb') as OUT:
+            OUT.write(BINARY_MAGIC)
+            OUT.write(len(header).to_bytes(8, "little"))
+            OUT.write(header)
+
+            data_start = _align8(OUT.tell())
+            OUT.write(b"\0" * (data_start - OUT.tell()))
+            for (name, dtype), array in zip(self.BINARY_SECTIONS, arrays):
+                OUT.write(b"\0" * (data_start + sections[name][0] - OUT.tell()))
+                OUT.write(array.tobytes())
+
+    @classmethod
+    def open_binary(cls, filename):
+        """ Opens a tree saved with save_binary. Arrays are views of a read-only mmap of the file. """
+        with open(filename, 'rb') as IN:
+            mm = mmap.mmap(IN.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError("{} is not a binary TaxTree file.".format(filename))
+
+        header_start = len(BINARY_MAGIC) + 8
+        header_len = int.from_bytes(mm[len(BINARY_MAGIC):header_start], "little")
+        header = json.loads(mm[header_start:header_start + header_len].decode("utf-8"))
+        data_start = _align8(header_start + header_len)
+
+        arrays = {}
+        for name, (offset, dtype, count) in header['sections'].items():
+            if name == "name_pool":
+                arrays[name] = memoryview(mm)[data_start + offset:data_start + offset + count]
+            else:
+                arrays[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=data_start + offset)
+
+        tree = cls.__new__(cls)
+        TaxTree.__init__(tree, header['remote'], header['email'])
+        tree.taxids = arrays['taxids']
+        tree.parents = arrays['parents']
+        tree.rank_codes = arrays['rank_codes']
+        tree.rank_names = header['rank_names']
+        tree.name_offsets = arrays['name_offsets']
+        tree.name_pool = arrays['name_pool']
+        tree._mmap = mm
+        tree._setup_indexes({k: arrays[k] for k in ["_row_of", "_child_offsets", "_child_rows"]})
+
+        return tree
+
+    # ROW ACCESS METHODS
+
+    def get_name(self, row):
+        return bytes(self.name_pool[self.name_offsets[row]:self.name_offsets[row + 1]]).decode("utf-8")
+
+    def get_rank(self, row):
+        return self.rank_names[self.rank_codes[row]]
+
+    def get_children(self, row):
+        return self._child_rows[self._child_offsets[row]:self._child_offsets[row + 1]]
+
+    def row_of(self, taxid):
+        """ Returns the row for a taxid or raises a KeyError """
+        try:
+            row = self._row_of[int(taxid)]
+        except (IndexError, ValueError):
+            row = -1
+
+        if row < 0:
+            raise KeyError(taxid)
+
+        return int(row)
+
+    def _build_name_indexes(self):
+        """ Makes the lowercased name -> rows and (lowercased name, rank) -> row indexes """
+        name_index = {}
+        name_rank_index = {}
+        for row in range(len(self.taxids)):
+            name = self.get_name(row).lower()
+            name_index.setdefault(name, []).append(row)
+            name_rank_index.setdefault((name, self.get_rank(row)), row)
+
+        self._name_index = {name: tuple(rows) for name, rows in name_index.items()}
+        self._name_rank_index = name_rank_index
+
+    # TREE CONSTRUCTION METHODS
+
+    def add_node(self, taxnode):
+        raise ValueError("CompactTaxTree is read-only. Add nodes to a TaxTree and convert it with CompactTaxTree.from_tree.")
+
+    # ANCESTOR INDEX METHODS
+
+    def _build_ancestor_index(self):
+        # rows of the index are the rows of the tree
+        return AncestorIndex(self.parents)
+
+    def _index_row(self, node):
+        if isinstance(node, TaxNodeView):
+            return node.row
+        else:
+            return self.row_of(node)
+
+    def _index_node(self, row):
+        return TaxNodeView(self, int(row))
+
+    # TREE LOOKUP METHODS
+
+    def lookup_taxid(self, taxid):
+        """ Looks up a TaxNodeView by it's id. Raises a KeyError if taxid is not in Tree """
+        return TaxNodeView(self, self.row_of(taxid))
+
+    def lookup_single_tax(self, tax):
+        """ Looks up a single tax term (with no rank info) using the name index """
+        if self._name_index is None:
+            self._build_name_indexes()
+
+        rows = self._name_index.get(tax.lower(), ())
+
+        if len(rows) == 1:
+            return TaxNodeView(self, rows[0])
+        elif len(rows) < 1:
+            raise LookupError("Tax: {} was not found in the tree.".format(tax))
+        else:
+            raise LookupError("Tax: {} returned multiple matches in the tree.".format(tax))
+
+    def lookup_taxstring(self, taxstring):
+        """ 
+        Looks up a TaxNodeView by the lowest rank in a taxstring using the (name, rank) index.
+        Returns the node or raises exception.
+        """
+        if self._name_rank_index is None:
+            self._build_name_indexes()
+
+        taxonomy = self._taxstring2dict(taxstring)
+
+        for rank in reversed(TaxTree.taxRanks):
+            if rank in taxonomy:
+                row = self._name_rank_index.get((taxonomy[rank].lower(), rank))
+                if row is not None:
+                    return TaxNodeView(self, row)
+                elif self.remote:
+                    return self._remote_lookup(taxonomy)
+                else:
+                    raise Exception("Taxstring {} not found in Tree".format(taxstring))
+
+
+def _align8(offset):
+    return (offset + 7) // 8 * 8
+
+
+class _CompactNodeMap(Mapping):
+    """ Read-only {taxid: TaxNodeView} mapping so code using tree.taxnodes keeps working """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __getitem__(self, taxid):
+        return self.tree.lookup_taxid(taxid)
+
+    def __iter__(self):
+        for taxid in self.tree.taxids:
+            yield str(taxid)
+
+    def __len__(self):
+        return len(self.tree.taxids)
+
+
+class TaxNodeView(TaxNode):
+    """ 
+    A lightweight TaxNode for a row of a CompactTaxTree. 
+
+    Views are made when a node is looked up and aren't stored anywhere. Two views of the 
+    same row compare equal.
+    """
+
+    def __init__(self, tree, row):
+        self.tree = tree
+        self.row = row
+
+    def __eq__(self, other):
+        return isinstance(other, TaxNodeView) and other.tree is self.tree and other.row == self.row
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tree), self.row))
+
+    @property
+    def taxtree(self):
+        return self.tree
+
+    @property
+    def taxid(self):
+        return str(self.tree.taxids[self.row])
+
+    @property
+    def name(self):
+        return self.tree.get_name(self.row)
+
+    @property
+    def rank(self):
+        return self.tree.get_rank(self.row)
+
+    @property
+    def parent(self):
+        parent = self.tree.parents[self.row]
+        if parent < 0:
+            return None
+        else:
+            return TaxNodeView(self.tree, int(parent))
+
+    @property
+    def children(self):
+        return [TaxNodeView(self.tree, int(row)) for row in self.tree.get_children(self.row)]
+
+    def add_node_to_tree(self):
+        raise ValueError("CompactTaxTree is read-only.")
+
+    def add_child(self, child):
+        raise ValueError("CompactTaxTree is read-only.")
+
+
+class _BoundedCache(object):
+    """ A dict-like cache that drops the least recently used entry once it holds max_size entries """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+
+        # re-insert to mark as most recently used
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class AncestorIndex(object):
+    """ 
+    Precomputed ancestry for a tree given as an array of parent rows (-1 for a root).
+
+    Each row gets a depth and a pre-order (DFS) entry/exit interval so row a is an ancestor 
+    of row b if entry[a] < entry[b] < exit[a]. LCA queries use a sparse table range minimum 
+    query over the depths in pre-order which is made on the first LCA query 
+    (it takes n * log2(n) ints).
+
+    Everything is built with numpy one depth level at a time (no recursion).
+    """
+
+    def __init__(self, parents):
+        parents = np.asarray(parents, dtype=np.int64)
+        n = len(parents)
+        self.parents = parents
+
+        # depth by walking every row up one level at a time
+        depth = np.zeros(n, dtype=np.int64)
+        ancestor = parents.copy()
+        active = np.flatnonzero(ancestor >= 0)
+        while len(active):
+            depth[active] += 1
+            ancestor[active] = parents[ancestor[active]]
+            active = active[ancestor[active] >= 0]
+
+            if len(active) and depth[active[0]] > n:
+                raise ValueError("Tree has a cycle in its parents.")
+
+        max_depth = int(depth.max()) if n else 0
+
+        # rows grouped by depth
+        by_depth = np.argsort(depth, kind="stable")
+        level_starts = np.searchsorted(depth[by_depth], np.arange(max_depth + 2))
+        levels = [by_depth[level_starts[d]:level_starts[d + 1]] for d in range(max_depth + 1)]
+
+        # subtree sizes from the deepest level up
+        size = np.ones(n, dtype=np.int64)
+        for rows in reversed(levels[1:]):
+            size += np.bincount(parents[rows], weights=size[rows], minlength=n).astype(np.int64)
+
+        # offset of each row among its siblings (siblings are in row order)
+        sib_order = np.argsort(parents, kind="stable")
+        sib_sizes = size[sib_order]
+        before = np.cumsum(sib_sizes) - sib_sizes
+        sib_parents = parents[sib_order]
+        group_start = np.ones(n, dtype=bool)
+        group_start[1:] = sib_parents[1:] != sib_parents[:-1]
+        group_id = np.cumsum(group_start) - 1
+        offset = np.empty(n, dtype=np.int64)
+        offset[sib_order] = before - before[np.flatnonzero(group_start)][group_id]
+
+        # pre-order entry from the top level down
+        entry = np.empty(n, dtype=np.int64)
+        entry[levels[0]] = offset[levels[0]]
+        for rows in levels[1:]:
+            entry[rows] = entry[parents[rows]] + 1 + offset[rows]
+
+        self.depth = depth
+        self.entry = entry
+        self.exit = entry + size
+
+        # row at each pre-order position
+        self.order = np.empty(n, dtype=np.int64)
+        self.order[entry] = np.arange(n)
+
+        self._sparse_table = None
+
+    def is_ancestor(self, row1, row2):
+        """ True if row1 is a (strict) ancestor of row2 """
+        return self.entry[row1] < self.entry[row2] < self.exit[row1]
+
+    def _build_sparse_table(self):
+        """ table[k][i] is the pre-order position with the lowest depth in [i, i + 2**k) """
+        pre_depth = self.depth[self.order]
+        n = len(pre_depth)
+
+        table = [np.arange(n, dtype=np.int32)]
+        k = 1
+        while (1 << k) <= n:
+            prev = table[-1]
+            left = prev[:n - (1 << k) + 1]
+            right = prev[(1 << (k - 1)):(1 << (k - 1)) + n - (1 << k) + 1]
+            table.append(np.where(pre_depth[left] <= pre_depth[right], left, right))
+            k += 1
+
+        self._pre_depth = pre_depth
+        self._sparse_table = table
+
+    def _min_depth_position(self, start, end):
+        """ Returns the pre-order position with the lowest depth in [start, end] """
+        k = (end - start + 1).bit_length() - 1
+        left = self._sparse_table[k][start]
+        right = self._sparse_table[k][end - (1 << k) + 1]
+
+        return left if self._pre_depth[left] <= self._pre_depth[right] else right
+
+    def lca(self, row1, row2):
+        """ Returns the row of the lowest common ancestor of two rows or -1 if they are in different trees """
+        if row1 == row2:
+            return row1
+
+        if self.entry[row1] > self.entry[row2]:
+            row1, row2 = row2, row1
+
+        if self.entry[row2] < self.exit[row1]:
+            return row1
+
+        if self._sparse_table is None:
+            self._build_sparse_table()
+
+        # the shallowest row between the two in pre-order is a child of the LCA
+        position = self._min_depth_position(int(self.entry[row1]) + 1, int(self.entry[row2]))
+        return int(self.parents[self.order[position]])
+
+    def lca_many(self, rows):
+        """ Returns the row of the lowest common ancestor of many rows (or -1) """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            raise ValueError("At least one row is needed to find an LCA.")
+
+        entries = self.entry[rows]
+
+        # the LCA of the first and last rows in pre-order is the LCA of all of them
+        return self.lca(int(rows[entries.argmin()]), int(rows[entries.argmax()]))
+
+
 class TaxLookup(object):
     """ Handles the Entrez interface/lookup of taxids/taxstrings """
 
@@ -552,100 +1220,133 @@ class TaxLookup(object):
 # with an absolute path (mypyli.taxtree.TaxTree) so when this module is 
 # imported, it is not required to import * (just import mypyli.taxtree).
 # There may be a better way to do this but this is the best I've found.
-def build_tree_from_NCBI(names_f, nodes_f, remote=False, email=None):
-    """ Builds and returns a TaxTree built from the NCBI names.dmp and nodes.dmp files """
+def build_tree_from_NCBI(names_f, nodes_f, remote=False, email=None, binary_out=None, compact=False, root_taxid="131567", chunk_size=2**24):
+    """ 
+    Builds and returns a TaxTree built from the NCBI names.dmp and nodes.dmp files 
+
+    The dumps are streamed in chunks of ~chunk_size bytes and the tree is built in a single 
+    breadth first pass from the root (children are always added after their parent) so the 
+    build is linear in the number of nodes. Throughput and peak memory are reported to stderr.
+    
+    If compact is True, a CompactTaxTree is built straight from the parsed columns without 
+    making any TaxNode objects. If binary_out is given, the compact tree is also written 
+    there in the binary format.
+    """
     
     from mypyli import taxtree
 
-    
-    data_dict = {}
+    start = time.time()
 
     # get the names for each taxid
+    names = {}
+    lines = 0
     with open(names_f, 'r') as IN:
-        for line in IN:
-            elements = line.split("\t|\t")
-            # replace the line break of the last element
-            elements[-1] = elements[-1].rstrip("\t|\n")
+        for chunk in _iter_line_chunks(IN, chunk_size):
+            for line in chunk:
+                elements = line.split("\t|\t")
 
-            if elements[-1] == "scientific name":
-                data_dict[elements[0]] = {'name': elements[1]}
-    
-    # get parent for each taxid         
-    with open(nodes_f, 'r') as IN:
-        for line in IN:
-            elements = line.split("\t|\t")
-            elements[-1] = elements[-1].rstrip("\t|\n")
-
-            id=elements[0]
-            parent=elements[1]
-            rank=elements[2]
+                # the last element still has the line break
+                if elements[-1].rstrip("\t|\n") == "scientific name":
+                    names[elements[0]] = elements[1]
 
-            if not parent:
-                print("Warning: taxid {} doesn't have parent".format(id))
-
-            data_dict[id].update({'parent': parent, 'rank': rank})
-
-    # build the TaxTree
+            lines += len(chunk)
+    _report_progress("Read {} lines from {}".format(lines, names_f), lines, start)
     
-    tree = taxtree.TaxTree(remote, email)
-    taxtree.TaxNode.set_default_tree(tree)
-  
-    # make a parent to id dict
+    # get the rank for each taxid and the children of each parent
+    ranks = {}
     parent2child = {}
-    for taxid, data in data_dict.items():
-        parent2child[data['parent']] = parent2child.get(data['parent'], []) + [taxid]
-
-
-    # add the root node
-    taxtree.TaxNode(taxid="131567", name="cellular organisms", rank="root", parent=None)
-
-    print("Adding nodes...", file=sys.stderr)
-    tree = _add_nodes_recurs(["131567"], parent2child, data_dict, tree)
+    lines = 0
+    step_start = time.time()
+    with open(nodes_f, 'r') as IN:
+        for chunk in _iter_line_chunks(IN, chunk_size):
+            for line in chunk:
+                taxid, parent, rank = line.split("\t|\t", 3)[:3]
 
-    return tree
+                if not parent:
+                    print("Warning: taxid {} doesn't have parent".format(taxid))
 
-def _add_nodes_recurs(to_add, parent2child, data_dict, tree):
-    """ 
-    Adds nodes to a TaxTree from a dict (used in the build_tree_from_NCBI method)
-    
-    Dictionary is expected to look like this  id_dict = {taxid: {'name': id_name; 'rank': id_rank, 'parent': parent_id}}
+                ranks[taxid] = rank
 
-    Where each 'parent' in each entry is another entry.
+                # NCBI's root is its own parent
+                if parent != taxid:
+                    children = parent2child.get(parent)
+                    if children is None:
+                        parent2child[parent] = [taxid]
+                    else:
+                        children.append(taxid)
 
-    Initial call will look like _add_nodes_recurs([root_taxid], parent2child, id_dict, tree)
-            
-        Where parent2child is essentially the inverse of id_dict, so, {parent_id: [children]}
-        and tree is a TaxTree with a single root node whose id is an entry in parent2child
-        and to_add is a list containing only the taxid of the root node.
+            lines += len(chunk)
+    _report_progress("Read {} lines from {}".format(lines, nodes_f), lines, step_start)
 
-    """
-    from mypyli import taxtree
+    # order the taxids so every parent comes before its children
+    print("Adding nodes...", file=sys.stderr)
+    step_start = time.time()
+    order = [root_taxid]
+    parent_of = {root_taxid: None}
+    indx = 0
+    while indx < len(order):
+        parent = order[indx]
+        for child in parent2child.get(parent, ()):
+            parent_of[child] = parent
+            order.append(child)
+        indx += 1
+
+    # I prefer Bacteria (a superkingdom under the root) to be listed as a kingdom.
+    # If you want it as it appears in the taxonomy, remove this conversion.
+    def get_rank(taxid):
+        rank = ranks[taxid]
+        if rank == "superkingdom" and parent_of[taxid] == root_taxid:
+            return "kingdom"
+        return rank
+
+    if compact or binary_out:
+        tree = taxtree.CompactTaxTree.from_lists(
+                [int(taxid) for taxid in order],
+                [parent_of[taxid] for taxid in order],
+                ["root"] + [get_rank(taxid) for taxid in order[1:]],
+                [names[taxid] for taxid in order],
+                remote, email)
+
+        if binary_out:
+            tree.save_binary(binary_out)
+
+    else:
+        tree = taxtree.TaxTree(remote, email)
+        taxtree.TaxNode.set_default_tree(tree)
+
+        # add the root node
+        taxtree.TaxNode(taxid=root_taxid, name=names[root_taxid], rank="root", parent=None)
+
+        for taxid in order[1:]:
+            pnode = tree.taxnodes[parent_of[taxid]]
+            cnode = taxtree.TaxNode(taxid, name=names[taxid], rank=get_rank(taxid), parent=pnode)
+            pnode.add_child(cnode)
 
+    _report_progress("Built tree with {} nodes".format(len(order)), len(order), step_start)
+    _report_progress("Finished building tree", len(order), start)
 
-    next_add = []
-    for parent in to_add:
-        pnode = tree.lookup_taxid(parent)
-        for child in parent2child.get(parent, []):
-            entry = data_dict.get(child, None)
-            
-            # check if superkingdom should be changed to kingdom
-            # I prefer to do this because the Bacteria entry is listed as superkingdom
-            # and I would like it to be listed as kingdom instead.
-            # If you want it as it appears in the taxonomy, comment out this if statement
-            if entry['rank'] == "superkingdom":
-                if pnode.rank == "root":
-                    entry['rank'] = "kingdom"
+    return tree
 
-            cnode = taxtree.TaxNode(child, name=entry['name'], rank=entry['rank'], parent=pnode)
+def _iter_line_chunks(fh, chunk_size):
+    """ Yields lists of lines totaling ~chunk_size bytes """
+    while True:
+        lines = fh.readlines(chunk_size)
+        if not lines:
+            return
+        yield lines
 
-            pnode.add_child(cnode)
-            next_add.append(child)
+def _report_progress(message, items, start):
+    """ Prints a message with the rate since start and the peak memory use """
+    elapsed = time.time() - start
+    rate = items / elapsed if elapsed else float("inf")
 
-    print("Processed {} nodes.".format(len(tree.taxnodes)))
-    if next_add:
-        tree = _add_nodes_recurs(next_add, parent2child, data_dict, tree)
+    if resource is None:
+        peak = "unknown"
+    else:
+        # ru_maxrss is in KB on linux
+        peak = "{:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
 
-    return tree
+    print("{} in {:.1f}s ({:.0f}/s); peak memory {}".format(message, elapsed, rate, peak), file=sys.stderr)
 
 
 
@@ -660,6 +1361,8 @@ if __name__ == "__main__":
     parser.add_argument("-out", help="filename for pickled output file", default="TaxTree.pickle")
     parser.add_argument("-remote", help="allow connection to NCBI servers to lookup missing info", action="store_true")
     parser.add_argument("-email", help="email address to use for Entrez (required if -remote is given)")
+    parser.add_argument("-compact", help="save the tree as a CompactTaxTree (numpy arrays; much faster to load)", action="store_true")
+    parser.add_argument("-binary", help="save the tree in the memory-mapped binary format instead of as a pickle (fastest to load; implies -compact)", action="store_true")
     args = parser.parse_args()
 
     if args.remote:
@@ -669,5 +1372,8 @@ if __name__ == "__main__":
         print("="*70 + "\nWarning! A TaxTree is being generated using the -remote option. This tree will use the email address '{}' when executing Entrez searches. Therefore, this tree should not be shared with others whom should not execute searches using the provided email address.\n".format(args.email) + "="*70)
     
     
-    tree = build_tree_from_NCBI(args.names, args.nodes, args.remote, args.email)
-    tree.save_tree(args.out)
+    if args.binary:
+        build_tree_from_NCBI(args.names, args.nodes, args.remote, args.email, binary_out=args.out)
+    else:
+        tree = build_tree_from_NCBI(args.names, args.nodes, args.remote, args.email, compact=args.compact)
+        tree.save_tree(args.out)
@@ -9,6 +9,7 @@ import re
 import subprocess
 import tempfile
 import time
+import numpy as np
 
 def parse_query_from_command(command):
     match = re.search("-query ([^ ]+)", command)
@@ -27,46 +28,99 @@ def parse_out_from_command(command):
         print("-out not found")
         return None
 
-def split_fasta_file(fasta, bins, out):
-    if not os.path.isdir(out):
-        os.makedirs(out)
+def index_fasta(fasta):
+    """ 
+    Returns arrays (starts, ends, residues) with the byte range and number of residues of each record in a fasta.
 
-    # count seqs in fasta -- probably a faster way to do this (without calling to grep)
+    The file is read once as bytes; only header lines are looked for, nothing is parsed into records.
+    """
+    starts = []
+    residues = []
+    position = 0
     count = 0
-    with open(fasta, 'rU') as IN:
+    with open(fasta, 'rb') as IN:
         for line in IN:
-            if line.startswith(">"):
-                count += 1
-
-    bin_size = (count // bins) + 1
+            if line.startswith(b">"):
+                if starts:
+                    residues.append(count)
+                starts.append(position)
+                count = 0
+            else:
+                count += len(line.rstrip())
+
+            position += len(line)
+
+    if starts:
+        residues.append(count)
+
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.append(starts[1:], position).astype(np.int64)
+    return starts, ends, np.array(residues, dtype=np.int64)
+
+def balance_shards(weights, shards):
+    """ 
+    Splits consecutive records into at most shards groups of about equal total weight. 
     
-    # split the seqs
+    Returns the index of the first record of each (non empty) shard. A record goes to the shard its 
+    midpoint on the cumulative weight falls in, so records keep their order.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(weights) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    total = weights.sum()
+    if total == 0:
+        weights = np.ones(len(weights))
+        total = len(weights)
+
+    midpoints = np.cumsum(weights) - weights / 2
+    shard_of_record = np.minimum((midpoints / total * shards).astype(np.int64), shards - 1)
+
+    return np.flatnonzero(np.concatenate(([True], shard_of_record[1:] != shard_of_record[:-1])))
+
+def split_fasta_file(fasta, bins, out, balance="residues"):
+    """ 
+    Splits a fasta into at most bins files and returns their paths. 
+    
+    Shards are balanced by total residues (BLAST time grows with query length) or by number of records 
+    and each one is a consecutive run of records copied straight from the fasta's bytes.
+    """
+    if not os.path.isdir(out):
+        os.makedirs(out)
+
     print("Splitting FASTA file...", file=sys.stderr)
-    files = []
-    with open(fasta, 'rU') as IN:
-        record_iter = SeqIO.parse(IN, "fasta")
+    starts, ends, residues = index_fasta(fasta)
 
-        for indx, bin in enumerate(_bin_generator(record_iter, bin_size)):
+    if balance == "residues":
+        weights = residues
+    elif balance == "records":
+        weights = np.ones(len(starts))
+    else:
+        raise ValueError("balance must be 'residues' or 'records' not '{}'".format(balance))
+
+    firsts = balance_shards(weights, bins)
+    lasts = np.append(firsts[1:], len(starts)) - 1
+
+    files = []
+    with open(fasta, 'rb') as IN:
+        for indx, (first, last) in enumerate(zip(firsts, lasts)):
             out_file = out + fasta.split("/")[-1] + "_" + str(indx)
-            with open(out_file, 'w') as OUT:
-                print("   Splitting to {}".format(out_file), file=sys.stderr)
-                SeqIO.write(bin, OUT, 'fasta')
-                files.append(out_file)
+            with open(out_file, 'wb') as OUT:
+                print("   Splitting to {} ({} records, {} residues)".format(out_file, last - first + 1, residues[first:last + 1].sum()), file=sys.stderr)
+
+                # the records of a shard are one byte range of the fasta
+                IN.seek(starts[first])
+                remaining = ends[last] - starts[first]
+                while remaining:
+                    chunk = IN.read(min(remaining, 2**24))
+                    OUT.write(chunk)
+                    remaining -= len(chunk)
+
+            files.append(out_file)
 
     print("", file=sys.stderr)
     return files
 
-def _bin_generator(iterator, bin_size):
-    bin = []
-    for item in iterator:
-        bin.append(item)
-        if len(bin) >= bin_size:
-            yield bin
-            bin = []
-    # return any left overs
-    if bin:
-        yield bin
-
 def lsf_blast(fa_file, command, queue, out, rand_id):
     
     bsub_command = "bsub -o parallel_blast.out -e parallel_blast.err -J {} -q {}".format(rand_id, queue)
@@ -100,6 +154,16 @@ def wait_until_finished(job_name):
         output = subprocess.check_output(["bjobs", "-J", job_name], stderr=open("/dev/null", 'w'))
     return True
 
+def count_unfinished_jobs(job_name):
+    """ Returns the number of jobs named job_name that are pending or running """
+    output = subprocess.check_output(["bjobs", "-noheader", "-J", job_name], stderr=open("/dev/null", 'w')).decode()
+    return len([line for line in output.splitlines() if line.strip()])
+
+def wait_for_free_node(job_name, nodes, interval=30):
+    """ Blocks until fewer than nodes jobs named job_name are pending or running """
+    while count_unfinished_jobs(job_name) >= nodes:
+        time.sleep(interval)
+
 def concatenate_split_results(in_outs, output):
     print("Concatenating split results...", file=sys.stderr)
     
@@ -160,6 +224,8 @@ if __name__ == "__main__":
     parser.add_argument("-c", help="blast command; hint: wrap this in quotes", required=True)
     parser.add_argument("-out", help="directory for the output", default="./")
     parser.add_argument("-q", help="the queue", default="week")
+    parser.add_argument("-balance", help="what to balance the query shards by [%(default)s]", choices=["residues", "records"], default="residues")
+    parser.add_argument("-overshard", help="make this many shards per node; at most -n shards run at once and the next one is submitted when one finishes so nodes that finish early pick up more of the work [%(default)s]", type=int, default=1)
     args = parser.parse_args()
 
     query = parse_query_from_command(args.c)
@@ -170,14 +236,18 @@ if __name__ == "__main__":
     tmp_out = tempfile.mkdtemp(prefix="fasplit_", dir=os.path.abspath(args.out))
     rand_id = tmp_out.split("/")[-1]
     
-    files = split_fasta_file(os.path.abspath(query), args.n, tmp_out + "/")
+    files = split_fasta_file(os.path.abspath(query), args.n * args.overshard, tmp_out + "/", args.balance)
 
     # ensures the blast command can be run successfully
     check_blast_command(args.c, os.path.abspath(query), tmp_out)
 
     print("Submitting BLAST jobs...", file=sys.stderr)
     in_outs = []
-    for fa_file in files:
+    for indx, fa_file in enumerate(files):
+        # hold extra shards until a node frees up so only -n jobs run at once
+        if indx >= args.n:
+            wait_for_free_node(rand_id, args.n)
+
         in_out_tup = lsf_blast(fa_file, args.c, args.q, tmp_out + "/", rand_id)
         in_outs.append(in_out_tup)
 